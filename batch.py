@@ -0,0 +1,236 @@
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Iterator, Optional, TypeAlias
+from segments import Box, Point, get_segment_array, get_array_filename
+from graphmaker import get_graph, SIMPLIFY_EPSILON
+from compactgraph import CompactGraph
+from monuments import get_monuments, load_monuments
+from viewer import export_png, export_kml
+from routes import find_routes, choose_backend
+from tiles import set_tile_source, TileSource
+from exports import submit_export, wait_for_exports, failed_exports
+from metrics import enable_metrics, metrics_enabled, profile_mode, get_metrics, merge_metrics, reset_metrics, Snapshot
+import tiles
+import csv, json, os, time
+
+
+Timings: TypeAlias = dict[str, float]
+
+MONUMENTS_FILENAME = "monuments.dat"
+
+
+@dataclass
+class Job:
+    """A region to process: its graph is built and the routes from each start point to its monuments are saved."""
+    name: str
+    box: Box
+    starts: list[Point] = field(default_factory=list)
+    num_clusters: int = 100
+    method: str = "kmeans"
+    render: bool = False
+
+
+@dataclass
+class JobResult:
+    """What happened with a job: the seconds spent in each stage, the routes that found monuments and the error, if any."""
+    name: str
+    timings: Timings = field(default_factory=dict)
+    routes_found: int = 0
+    error: Optional[str] = None
+
+
+@contextmanager
+def timed(timings: Timings, stage: str) -> Iterator[None]:
+    """Add the seconds spent in the block to the time of the stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def load_jobs(filename: str) -> list[Job]:
+    """
+    Load the jobs from a JSON or a CSV file.
+    JSON: a list of {"name", "box": [lat1, lon1, lat2, lon2], "starts": [[lat, lon], ...], "clusters", "method", "render"}.
+    CSV: a header with name, lat1, lon1, lat2, lon2, start_lat, start_lon and optionally clusters, method and render.
+    CSV rows with the same name are the same job, with one start point per row.
+    Raises ValueError, with the job or line, if an entry is missing a field or has a wrong value.
+    """
+    if filename.endswith(".csv"):
+        return load_csv_jobs(filename)
+    with open(filename, "r") as file:
+        data = json.load(file)
+    jobs = []
+    for i, entry in enumerate(data):
+        try:
+            jobs.append(Job(str(entry["name"]), make_box(entry["box"]),
+                            [Point(*map(float, start)) for start in entry.get("starts", [])],
+                            int(entry.get("clusters", 100)), entry.get("method", "kmeans"), bool(entry.get("render", False))))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"job {i} of {filename}: {e!r}") from e
+    return jobs
+
+
+def load_csv_jobs(filename: str) -> list[Job]:
+    """Load the jobs from a CSV file (see load_jobs)."""
+    jobs: dict[str, Job] = {}
+    with open(filename, "r", newline="") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            try:
+                name = row["name"]
+                if name not in jobs:
+                    box = make_box([row["lat1"], row["lon1"], row["lat2"], row["lon2"]])
+                    jobs[name] = Job(name, box, [], int(row.get("clusters") or 100), row.get("method") or "kmeans",
+                                     (row.get("render") or "").lower() in ("1", "true", "yes"))
+                if row.get("start_lat") and row.get("start_lon"):
+                    jobs[name].starts.append(Point(float(row["start_lat"]), float(row["start_lon"])))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"line {reader.line_num} of {filename}: {e!r}") from e
+    return list(jobs.values())
+
+
+def make_box(coordinates: list) -> Box:
+    """Create a box from the latitude and longitude of its bottom left and top right corners."""
+    lat1, lon1, lat2, lon2 = map(float, coordinates)
+    return Box(Point(lat1, lon1), Point(lat2, lon2))
+
+
+def get_segments_filename(box: Box, data_dir: str) -> str:
+    """Return the name of the segments file of a box, so every job with the same box shares it."""
+    corners = (box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon)
+    return os.path.join(data_dir, "segments_" + "_".join(f"{corner:g}" for corner in corners) + ".dat")
+
+
+def prepare_segments(box: Box, data_dir: str) -> int:
+    """Get the segments of the box into its binary file (downloading them if needed). Returns how many there are."""
+    os.makedirs(data_dir, exist_ok=True)
+    return len(get_segment_array(box, get_segments_filename(box, data_dir)))
+
+
+def prepare_graph(box: Box, num_clusters: int, method: str, data_dir: str, rebuild: bool = False,
+                  chunk_size: Optional[int] = None) -> CompactGraph:
+    """Get the graph of the segments of the box as a CompactGraph (see graphmaker.get_graph)."""
+    return get_graph(get_array_filename(get_segments_filename(box, data_dir)), num_clusters, method, SIMPLIFY_EPSILON, rebuild,
+                     compact=True, chunk_size=chunk_size)
+
+
+def run_jobs(jobs: list[Job], data_dir: str = ".", output_dir: str = ".", workers: int = 1, rebuild: bool = False) -> list[JobResult]:
+    """
+    Run the jobs and print the time spent in each stage.
+    Segments and monuments are downloaded first, once for every different box, as their caches are shared.
+    Then the jobs are grouped by graph and every group runs in a pool of processes, so each graph is built once.
+    The processes render with the current tile source and, if metrics are enabled, send theirs back to this one.
+    """
+    results = {job.name: JobResult(job.name) for job in jobs}
+    segments_timings: dict[str, Timings] = {}
+    segments_errors: dict[str, str] = {}
+    for job in jobs:
+        filename = get_segments_filename(job.box, data_dir)
+        if filename not in segments_timings:
+            segments_timings[filename] = {}
+            try:
+                with timed(segments_timings[filename], "segments"):
+                    if prepare_segments(job.box, data_dir) == 0:
+                        segments_errors[filename] = "no segments in the box"
+            except Exception as e:
+                segments_errors[filename] = f"the segments could not be downloaded: {e}"
+        results[job.name].timings.update(segments_timings[filename])
+        results[job.name].error = segments_errors.get(filename)
+
+    monuments_filename = os.path.join(data_dir, MONUMENTS_FILENAME)
+    if any(job.starts for job in jobs):
+        timings: Timings = {}
+        with timed(timings, "monuments"):
+            get_monuments(jobs[0].box, monuments_filename)
+        for job in jobs:
+            results[job.name].timings.update(timings)
+
+    groups: dict[tuple, list[Job]] = {}
+    for job in jobs:
+        if results[job.name].error is None:
+            groups.setdefault((get_segments_filename(job.box, data_dir), job.num_clusters, job.method), []).append(job)
+        else:
+            print_result(results[job.name])
+    initargs = (tiles.tile_source, metrics_enabled(), profile_mode())
+    with ProcessPoolExecutor(max(1, workers), initializer=init_worker, initargs=initargs) as executor:
+        futures = [executor.submit(run_job_group, group, data_dir, output_dir, monuments_filename, rebuild)
+                   for group in groups.values()]
+        for future in as_completed(futures):
+            group_results, snapshot = future.result()
+            merge_metrics(snapshot)
+            for result in group_results:
+                result.timings = results[result.name].timings | result.timings
+                results[result.name] = result
+                print_result(result)
+    return list(results.values())
+
+
+def init_worker(source: TileSource, collect_metrics: bool, profile: Optional[str]) -> None:
+    """Prepare a process of the pool with the tile source and the metrics settings of the parent."""
+    set_tile_source(source)
+    if collect_metrics:
+        enable_metrics(profile)
+
+
+def run_job_group(jobs: list[Job], data_dir: str, output_dir: str, monuments_filename: str,
+                  rebuild: bool) -> tuple[list[JobResult], Snapshot]:
+    """
+    Run jobs that share the same graph in this process: the graph is built (or loaded) once.
+    Returns their results and the metrics collected while running them.
+    """
+    reset_metrics()
+    results = [JobResult(job.name) for job in jobs]
+    graph: Optional[CompactGraph] = None
+    timings: Timings = {}
+    try:
+        with timed(timings, "graph"):
+            graph = prepare_graph(jobs[0].box, jobs[0].num_clusters, jobs[0].method, data_dir, rebuild)
+    except Exception as e:
+        for result in results:
+            result.error = f"the graph could not be built: {e}"
+    # The jobs of a group share the box, so all their routes can use the route trees of its monuments
+    num_queries = sum(len(job.starts) for job in jobs)
+    for job, result in zip(jobs, results):
+        result.timings.update(timings)
+        if graph is not None:
+            run_job(job, graph, output_dir, monuments_filename, result, num_queries)
+    return results, get_metrics()
+
+
+def run_job(job: Job, graph: CompactGraph, output_dir: str, monuments_filename: str, result: JobResult,
+            num_queries: int = 1) -> None:
+    """
+    Save the routes from every start point of the job and, if asked, the graph images. The routing backend is chosen
+    for the num_queries routes of the jobs that share the graph (see routes.choose_backend).
+    The files are written in the background while the next routes are computed (see exports.submit_export).
+    """
+    directory = os.path.join(output_dir, job.name)
+    os.makedirs(directory, exist_ok=True)
+    exports = []
+    try:
+        if job.render:
+            exports += [submit_export(export_png, os.path.join(directory, "graph.png"), graph),
+                        submit_export(export_kml, os.path.join(directory, "graph.kml"), graph)]
+        if job.starts:
+            monuments = load_monuments(job.box, monuments_filename)
+            backend = choose_backend(graph, num_queries, monuments)
+            with timed(result.timings, "routes"):
+                for i, start in enumerate(job.starts):
+                    found = find_routes(graph, start, monuments, os.path.join(directory, f"routes_{i}"), backend, exports=exports)
+                    result.routes_found += found == 1
+    except Exception as e:
+        result.error = str(e)
+    with timed(result.timings, "exports"):
+        failed = failed_exports(wait_for_exports(exports))
+    if failed and result.error is None:
+        result.error = "could not save " + ", ".join(os.path.basename(export.filename) for export in failed)
+
+
+def print_result(result: JobResult) -> None:
+    """Print the time spent in each stage of a job."""
+    stages = ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in result.timings.items())
+    status = f"error: {result.error}" if result.error else f"{result.routes_found} routes with monuments"
+    print(f"{result.name}: {stages} ({status})")
@@ -0,0 +1,429 @@
+from segments import get_page_lines, is_valid, show_segments, get_segment_array, SegmentArray, Box, Point, TILE_SIZE
+from graphmaker import (make_graph, set_edge_weights, simplify_graph, convert_segments_to_numpy, cluster_points,
+                        build_compact_graph, CLUSTERING_METHODS, SIMPLIFY_EPSILON, Graph)
+from compactgraph import CompactGraph
+from monuments import load_monuments
+from routes import find_shortest_paths, prepare_route_trees, find_routes, choose_backend
+from viewer import export_png, export_kml
+from tiles import TileSource, set_tile_source
+from files import atomic_write
+from typing import Any, Callable
+from math import acos, degrees
+from datetime import datetime, timedelta, timezone
+import gpxpy, gpxpy.gpx, random, sys, time, tracemalloc, os, tempfile, json, subprocess, multiprocessing, http.server, urllib.parse, haversine
+import networkx as nx
+import numpy as np
+
+
+def make_synthetic_gpx(num_points: int, points_per_segment: int = 1000, seed: int = 0,
+                       origin: tuple[float, float] = (41.0, 1.0), extent: float = 0.5) -> str:
+    """
+    Create a GPX document with random walks of num_points points in total, some of them too old or too far apart.
+    The walks start inside the square of the given size (degrees) whose bottom left corner is the (lat, lon) origin.
+    """
+    rng = random.Random(seed)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<gpx version="1.0" creator="OpenStreetMap.org" xmlns="http://www.topografix.com/GPX/1/0">']
+    for first in range(0, num_points, points_per_segment):
+        lat, lon = origin[0] + rng.random() * extent, origin[1] + rng.random() * extent
+        moment = datetime(rng.choice([2012, 2016, 2020]), 1, 1, tzinfo=timezone.utc)
+        lines.append("<trk><trkseg>")
+        for _ in range(min(points_per_segment, num_points - first)):
+            lat += rng.gauss(0, 0.0006)
+            lon += rng.gauss(0, 0.0006)
+            moment += timedelta(seconds=rng.randint(1, 30))
+            lines.append(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><time>{moment:%Y-%m-%dT%H:%M:%SZ}</time></trkpt>')
+        lines.append("</trkseg></trk>")
+    lines.append("</gpx>")
+    return "\n".join(lines)
+
+
+def get_page_lines_per_pair(gpx: gpxpy.gpx.GPX) -> str:
+    """Return the valid segments of a parsed GPX page validating one pair of points at a time."""
+    lines: list[str] = []
+    for track in gpx.tracks:
+        for segment in track.segments:
+            if all(point.time is not None for point in segment.points):
+                segment.points.sort(key=lambda p: p.time)  # type: ignore
+                for i in range(len(segment.points) - 1):
+                    p1, p2 = segment.points[i], segment.points[i + 1]
+                    if is_valid(p1, p2):
+                        lines.append(f"{p1.latitude},{p1.longitude},{p2.latitude},{p2.longitude}\n")
+    return "".join(lines)
+
+
+def benchmark_validation(num_points: int) -> None:
+    """Compare the pairs per second validated by the per-pair and the vectorized paths."""
+    gpx = gpxpy.parse(make_synthetic_gpx(num_points))
+    num_pairs = sum(len(segment.points) - 1 for track in gpx.tracks for segment in track.segments)
+    results: list[str] = []
+    for name, function in (("per pair", get_page_lines_per_pair), ("vectorized", get_page_lines)):
+        start = time.perf_counter()
+        results.append(function(gpx))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {elapsed:.2f} s, {num_pairs / elapsed:,.0f} pairs/s")
+    print(f"Same output: {results[0] == results[1]} ({results[0].count(chr(10))} valid pairs)")
+
+
+def make_synthetic_segments(num_segments: int, segments_per_track: int = 500, seed: int = 0) -> SegmentArray:
+    """Create an (N, 4) array of segments (lat1, lon1, lat2, lon2) following random walks inside a 0.5 degree box."""
+    rng = np.random.default_rng(seed)
+    num_tracks = -(-num_segments // segments_per_track)
+    starts = np.array([41.0, 1.0]) + rng.random((num_tracks, 1, 2)) * 0.5
+    walks = starts + np.cumsum(rng.normal(0, 0.0004, (num_tracks, segments_per_track + 1, 2)), axis=1)
+    segments = np.concatenate((walks[:, :-1], walks[:, 1:]), axis=2)
+    return segments.reshape(-1, 4)[:num_segments]
+
+
+def benchmark_clustering(num_segments: int, num_clusters: int) -> None:
+    """Report time, memory peak and resulting graph size of every clustering method on the same segments."""
+    segments = make_synthetic_segments(num_segments)
+    configurations = [(method, None) for method in CLUSTERING_METHODS] + [("minibatch", min(100_000, 2 * num_segments // 10))]
+    for method, sample_size in configurations:
+        tracemalloc.start()
+        start = time.perf_counter()
+        graph = make_graph(segments, num_clusters, method=method, sample_size=sample_size)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        name = method if sample_size is None else f"{method} (sample {sample_size})"
+        components = nx.number_connected_components(graph) if len(graph) > 0 else 0
+        print(f"{name:>26}: {elapsed:7.2f} s, peak {peak / 2**20:7.1f} MiB, "
+              f"{graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, {components} components")
+
+
+def make_synthetic_graph(num_nodes: int, seed: int = 0) -> Graph:
+    """Create a connected graph like the ones of make_graph: a grid of jittered (lon, lat) positions with some edges removed."""
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_nodes)))
+    grid = nx.convert_node_labels_to_integers(nx.grid_2d_graph(side, side), label_attribute='cell')
+    for node, data in grid.nodes(data=True):
+        row, col = data.pop('cell')
+        data['pos'] = np.array([1.0 + col * 0.002, 41.0 + row * 0.002]) + rng.normal(0, 0.0004, 2)
+    removable = [edge for edge in grid.edges() if rng.random() < 0.2]
+    grid.remove_edges_from(removable)
+    graph = grid.subgraph(max(nx.connected_components(grid), key=len)).copy()
+    set_edge_weights(graph)
+    return graph
+
+
+def benchmark_routing(num_nodes: int, num_targets: int) -> None:
+    """Compare networkx Dijkstra with the CSR backend from the same source to random targets."""
+    graph = make_synthetic_graph(num_nodes)
+    nodes = list(graph.nodes())
+    rng = np.random.default_rng(1)
+    source = nodes[int(rng.integers(len(nodes)))]
+    targets = {nodes[i] for i in rng.choice(len(nodes), num_targets, replace=False).tolist()}
+    find_shortest_paths(graph, source, targets, "csr")  # Build the cached CSR matrix
+    results = []
+    for backend in ("networkx", "csr"):
+        start = time.perf_counter()
+        distances, paths = find_shortest_paths(graph, source, targets, backend)
+        elapsed = time.perf_counter() - start
+        results.append(({target: round(distances[target], 9) for target in targets if target in distances},
+                        {target: paths[target] for target in targets if target in paths}))
+        print(f"{backend:>15}: {elapsed * 1000:9.2f} ms")
+    print(f"{len(graph)} nodes, same distances: {all(result[0] == results[0][0] for result in results)}, "
+          f"same paths: {all(result[1] == results[0][1] for result in results)}")
+
+
+def benchmark_route_trees(num_nodes: int, num_monuments: int, num_queries: int) -> None:
+    """Report the cost of precomputing the shortest path trees of the monuments and the time per query against Dijkstra."""
+    graph = make_synthetic_graph(num_nodes)
+    nodes = list(graph.nodes())
+    rng = np.random.default_rng(2)
+    monuments = {nodes[i] for i in rng.choice(len(nodes), num_monuments, replace=False).tolist()}
+    sources = [nodes[i] for i in rng.integers(len(nodes), size=num_queries).tolist()]
+    find_shortest_paths(graph, sources[0], monuments, "csr")  # Build the cached CSR matrix
+    start = time.perf_counter()
+    prepare_route_trees(graph, monuments)
+    print(f"Preprocessing: {(time.perf_counter() - start) * 1000:.1f} ms for {num_monuments} monuments and {len(graph)} nodes")
+    results = []
+    for backend in ("csr", "trees"):
+        start = time.perf_counter()
+        results.append([find_shortest_paths(graph, source, monuments, backend) for source in sources])
+        elapsed = time.perf_counter() - start
+        print(f"{backend:>6}: {elapsed / num_queries * 1000:9.3f} ms per query")
+    same = all(np.allclose([a[0][m] for m in a[0]], [b[0][m] for m in a[0]]) and a[0].keys() == b[0].keys()
+               for a, b in zip(*results))
+    print(f"Same distances as Dijkstra: {same}")
+
+
+def simplify_graph_per_node(graph: Graph, epsilon: float) -> Graph:
+    """Simplify the graph in a single pass, checking and removing one node at a time."""
+    nodes_to_remove = []
+    for node in list(graph.nodes):
+        neighbors = list(graph.neighbors(node))
+        if len(neighbors) == 2:
+            p1, p2, p3 = graph.nodes[neighbors[0]]['pos'], graph.nodes[node]['pos'], graph.nodes[neighbors[1]]['pos']
+            vector1, vector2 = np.array(p1) - np.array(p2), np.array(p3) - np.array(p2)
+            cos_angle = np.dot(vector1, vector2) / (np.linalg.norm(vector1) * np.linalg.norm(vector2))
+            if abs(degrees(acos(cos_angle)) - 180) < epsilon:
+                nodes_to_remove.append((node, neighbors[0], neighbors[1]))
+    for node, neighbor1, neighbor2 in nodes_to_remove:
+        if graph.has_node(node) and graph.has_node(neighbor1) and graph.has_node(neighbor2):
+            if not graph.has_edge(neighbor1, neighbor2):
+                graph.add_edge(neighbor1, neighbor2)
+            graph.remove_node(node)
+    return graph
+
+
+def make_chained_graph(num_nodes: int, points_per_edge: int, seed: int = 0) -> Graph:
+    """Create a synthetic graph (see make_synthetic_graph) with every edge split into a chain of nearly collinear nodes."""
+    rng = np.random.default_rng(seed)
+    graph = make_synthetic_graph(num_nodes, seed)
+    label = max(graph.nodes()) + 1
+    for u, v in list(graph.edges()):
+        steps = np.linspace(0, 1, points_per_edge + 2)[1:-1, None]
+        positions = graph.nodes[u]['pos'] + steps * (graph.nodes[v]['pos'] - graph.nodes[u]['pos'])
+        positions += rng.normal(0, 0.00002, positions.shape)
+        chain = list(range(label, label + points_per_edge))
+        label += points_per_edge
+        graph.add_nodes_from((node, {'pos': position}) for node, position in zip(chain, positions))
+        graph.remove_edge(u, v)
+        nx.add_path(graph, [u] + chain + [v])
+    set_edge_weights(graph)
+    return graph
+
+
+def benchmark_simplification(num_nodes: int, points_per_edge: int) -> None:
+    """Report the nodes, edges, length and time of the single pass per-node simplification and the vectorized one on the same graph."""
+    graph = make_chained_graph(num_nodes, points_per_edge)
+    length = sum(weight for _, _, weight in graph.edges(data='weight'))
+    print(f"{'before':>10}: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, {length:.1f} km")
+    for name, function in (("per node", simplify_graph_per_node), ("vectorized", simplify_graph)):
+        simplified = graph.copy()
+        start = time.perf_counter()
+        function(simplified, 20)
+        elapsed = time.perf_counter() - start
+        if function is simplify_graph_per_node:
+            # The per-node pass leaves its new edges without weight: they get their straight length, as make_graph used to do
+            set_edge_weights(simplified)
+        length = sum(weight for _, _, weight in simplified.edges(data='weight'))
+        print(f"{name:>10}: {elapsed:7.3f} s, {simplified.number_of_nodes()} nodes, {simplified.number_of_edges()} edges, {length:.1f} km")
+
+
+def make_compact_grid_graph(num_nodes: int, seed: int = 0) -> CompactGraph:
+    """Create a graph like make_synthetic_graph (a jittered grid with some edges removed) directly as a CompactGraph."""
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_nodes)))
+    rows, cols = np.divmod(np.arange(side * side), side)
+    positions = np.column_stack((1.0 + cols * 0.002, 41.0 + rows * 0.002)) + rng.normal(0, 0.0004, (side * side, 2))
+    cells = np.arange(side * side).reshape(side, side)
+    starts = np.concatenate((cells[:, :-1].ravel(), cells[:-1, :].ravel()))
+    ends = np.concatenate((cells[:, 1:].ravel(), cells[1:, :].ravel()))
+    kept = rng.random(len(starts)) >= 0.2
+    starts, ends = starts[kept], ends[kept]
+    weights = haversine.haversine_vector(positions[starts][:, ::-1], positions[ends][:, ::-1])
+    return CompactGraph.from_edges(np.arange(side * side), positions, starts, ends, weights)
+
+
+def benchmark_graph_memory(num_nodes: int) -> None:
+    """
+    Report the memory per node of a CompactGraph and of the networkx graph with the same nodes and edges (as make_graph
+    used to return it), measured with tracemalloc, and the time to route and to convert between them.
+    """
+    tracemalloc.start()
+    compact = make_compact_grid_graph(num_nodes)
+    compact_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    graph = compact.to_networkx()
+    elapsed = time.perf_counter() - start
+    graph_bytes = tracemalloc.get_traced_memory()[0] - compact_bytes
+    tracemalloc.stop()
+    n = compact.number_of_nodes()
+    print(f"{n} nodes, {compact.number_of_edges()} edges")
+    print(f"{'compact':>10}: {compact.nbytes / n:8.1f} bytes per node (arrays), {compact_bytes / n:8.1f} bytes per node (traced)")
+    print(f"{'networkx':>10}: {graph_bytes / n:8.1f} bytes per node, built from the compact graph in {elapsed:.2f} s")
+    start = time.perf_counter()
+    CompactGraph.from_networkx(nx.Graph(graph))
+    print(f"networkx -> compact without the cached arrays: {time.perf_counter() - start:.2f} s")
+    del graph
+    source, targets = 0, set(np.random.default_rng(1).choice(n, 50, replace=False).tolist())
+    start = time.perf_counter()
+    distances, _ = find_shortest_paths(compact, source, targets, "csr")
+    print(f"Dijkstra on the compact graph: {time.perf_counter() - start:.2f} s, {len(distances)} targets reached")
+
+
+def benchmark_rendering(max_segments: int) -> None:
+    """Compare the render time of staticmap lines and the batched renderer for growing numbers of segments, without network."""
+    with tempfile.TemporaryDirectory() as directory:
+        # A folder without tiles: every tile is blank, so only drawing is measured
+        set_tile_source(TileSource(os.path.join(directory, "{z}/{x}/{y}.png"), os.path.join(directory, "cache")))
+        num_segments = 1000
+        while num_segments <= max_segments:
+            segments = make_synthetic_segments(num_segments)
+            times = []
+            for fast in (False, True):
+                start = time.perf_counter()
+                show_segments(segments, os.path.join(directory, "segments.png"), fast)
+                times.append(time.perf_counter() - start)
+            print(f"{num_segments:>9} segments: staticmap {times[0]:7.2f} s, batched {times[1]:7.2f} s")
+            num_segments *= 10
+
+
+def serve_synthetic_trackpoints(points_per_box: int, url: "multiprocessing.Queue[str]") -> None:
+    """Run a SyntheticTrackpoints server forever, putting its URL in the queue once it is listening."""
+    server = SyntheticTrackpoints(points_per_box)
+    url.put(server.url)
+    server.serve_forever()
+
+
+class SyntheticTrackpoints(http.server.ThreadingHTTPServer):
+    """A local stand-in of the OpenStreetMap trackpoints API: the first page of every box has points_per_box synthetic points."""
+
+    def __init__(self, points_per_box: int) -> None:
+        super().__init__(("127.0.0.1", 0), SyntheticTrackpointsHandler)
+        self.points_per_box = points_per_box
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/trackpoints"
+
+
+class SyntheticTrackpointsHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the requests of pages of trackpoints of a SyntheticTrackpoints server."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        min_lon, min_lat, max_lon, _ = map(float, query["bbox"][0].split(","))
+        points = self.server.points_per_box if query["page"][0] == "0" else 0  # type: ignore
+        seed = int(min_lat * 1000) * 100_000 + int(min_lon * 1000)
+        body = make_synthetic_gpx(points, 500, seed, (min_lat, min_lon), max_lon - min_lon).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def make_synthetic_monuments(filename: str, num_monuments: int, box: Box, seed: int = 0) -> None:
+    """Write a monuments file with num_monuments random monuments, a tenth of them inside the box and the rest around it."""
+    rng = np.random.default_rng(seed)
+    lat_extent = box.top_right.lat - box.bottom_left.lat
+    lon_extent = box.top_right.lon - box.bottom_left.lon
+    inside = rng.random(num_monuments) < 0.1
+    scale = np.where(inside, 1.0, 10.0)[:, None]
+    coordinates = (np.array([box.bottom_left.lat, box.bottom_left.lon]) + rng.random((num_monuments, 2)) * scale * [lat_extent, lon_extent]
+                   - np.where(inside, 0.0, 4.5)[:, None] * [lat_extent, lon_extent])
+    with open(filename, "w") as file:
+        for i, (lat, lon) in enumerate(coordinates.tolist()):
+            file.write(f"Monument {i} - {lat},{lon}\n")
+
+
+def run_stage(results: dict[str, dict[str, float]], stage: str, function: Callable[..., Any], *arguments: Any) -> Any:
+    """Run a stage of the pipeline, keeping its time and its memory peak in MiB in results, and return what it returns."""
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = function(*arguments)
+    elapsed = time.perf_counter() - start
+    results[stage] = {"seconds": elapsed}
+    if tracemalloc.is_tracing():
+        results[stage]["peak_mib"] = (tracemalloc.get_traced_memory()[1] - current) / 2**20
+        print(f"{stage:>18}: {elapsed:8.3f} s, peak {results[stage]['peak_mib']:8.1f} MiB")
+    else:
+        print(f"{stage:>18}: {elapsed:8.3f} s")
+    return value
+
+
+def benchmark_pipeline(points_per_tile: int, num_clusters: int, num_monuments: int, num_starts: int, trace_memory: int) -> None:
+    """
+    Time every stage of the whole pipeline on a synthetic region of 4x4 segment tiles, without network: the segments come
+    from a local stand-in of the trackpoints API and the map tiles from an empty local directory (blank tiles).
+    If trace_memory is 1, the memory peak of every stage is measured too, which makes Python-heavy stages slower.
+    The results are appended to the history in BENCHMARK_HISTORY and compared with the last run with the same arguments.
+    """
+    box = Box(Point(41.0, 1.0), Point(41.0 + 4 * TILE_SIZE, 1.0 + 4 * TILE_SIZE))
+    results: dict[str, dict[str, float]] = {}
+    history_filename = os.path.abspath(BENCHMARK_HISTORY)
+    # The server runs in another process, so making the pages doesn't count as time or memory of the pipeline
+    server_url = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_synthetic_trackpoints, args=(points_per_tile, server_url), daemon=True)
+    server.start()
+    url = server_url.get()
+    previous_directory = os.getcwd()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            set_tile_source(TileSource(os.path.join(directory, "{z}/{x}/{y}.png"), os.path.join(directory, "map_tiles")))
+            segments = run_stage(results, "get_segments", get_segment_array, box, "segments.dat", url)
+            points = run_stage(results, "graph.convert", convert_segments_to_numpy, segments)
+            centroids, labels = run_stage(results, "graph.cluster", cluster_points, points, num_clusters, "kmeans")
+            graph = run_stage(results, "graph.build", build_compact_graph, centroids, labels)
+            graph = run_stage(results, "graph.simplify", simplify_graph, graph, SIMPLIFY_EPSILON)
+            make_synthetic_monuments("monuments.dat", num_monuments, box)
+            monuments = run_stage(results, "load_monuments", load_monuments, box, "monuments.dat")
+            rng = np.random.default_rng(0)
+            starts = [Point(box.bottom_left.lat + lat * 4 * TILE_SIZE, box.bottom_left.lon + lon * 4 * TILE_SIZE)
+                      for lat, lon in rng.random((num_starts, 2)).tolist()]
+            backend = choose_backend(graph, len(starts), monuments)
+            run_stage(results, "find_routes", lambda: [find_routes(graph, start, monuments, f"routes_{i}", backend=backend)
+                                                       for i, start in enumerate(starts)])
+            run_stage(results, "export_png", export_png, graph, "graph.png")
+            run_stage(results, "export_kml", export_kml, graph, "graph.kml")
+    finally:
+        tracemalloc.stop()
+        os.chdir(previous_directory)
+        server.terminate()
+    print(f"{len(segments)} segments, {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, {len(monuments)} monuments in the box")
+    arguments = {"points_per_tile": points_per_tile, "num_clusters": num_clusters, "num_monuments": num_monuments,
+                 "num_starts": num_starts, "trace_memory": trace_memory}
+    record_history(history_filename, "pipeline", arguments, results)
+
+
+def record_history(filename: str, name: str, arguments: dict[str, int], results: dict[str, dict[str, float]]) -> None:
+    """Append the results of a benchmark to the JSON history and print the change of every stage since the last run with the same arguments."""
+    try:
+        with open(filename, "r") as file:
+            history = json.load(file)
+    except (OSError, ValueError):
+        history = []
+    previous = next((run for run in reversed(history) if run["benchmark"] == name and run["arguments"] == arguments), None)
+    if previous is not None:
+        print(f"Compared with {previous['version']} ({previous['date']}):")
+        for stage, result in results.items():
+            if stage in previous["stages"] and previous["stages"][stage]["seconds"] > 0:
+                ratio = result["seconds"] / previous["stages"][stage]["seconds"]
+                # Stages that take a few milliseconds are too noisy to be marked
+                slower = ratio > 1.2 and result["seconds"] > 0.05
+                print(f"{stage:>18}: {ratio:6.2f}x time{'  <-- slower' if slower else ''}")
+    history.append({"benchmark": name, "version": get_version(), "date": datetime.now().isoformat(timespec="seconds"),
+                    "arguments": arguments, "stages": results})
+    with atomic_write(filename) as file:
+        json.dump(history, file, indent=1)
+
+
+def get_version() -> str:
+    """Return the git commit of the code being measured, or "unknown"."""
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=directory, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# File where the pipeline benchmark keeps the results of every run
+BENCHMARK_HISTORY = "benchmark_history.json"
+
+BENCHMARKS = {
+    "validation": (benchmark_validation, [1_000_000]),
+    "clustering": (benchmark_clustering, [200_000, 1000]),
+    "routing": (benchmark_routing, [100_000, 50]),
+    "route_trees": (benchmark_route_trees, [100_000, 50, 100]),
+    "simplification": (benchmark_simplification, [10_000, 10]),
+    "rendering": (benchmark_rendering, [100_000]),
+    "graph_memory": (benchmark_graph_memory, [1_000_000]),
+    "pipeline": (benchmark_pipeline, [20_000, 500, 10_000, 5, 1]),
+}
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark.py <benchmark> [arguments...]
+    name = sys.argv[1] if len(sys.argv) > 1 else "validation"
+    function, defaults = BENCHMARKS[name]
+    arguments = [int(argument) for argument in sys.argv[2:]] + defaults[len(sys.argv[2:]):]
+    function(*arguments)
@@ -0,0 +1,150 @@
+from scipy.sparse import csr_matrix
+from typing import Optional
+import networkx as nx
+import numpy as np
+import haversine
+
+
+class CompactGraph:
+    """
+    An undirected weighted graph stored in a few arrays instead of Python dicts: the node labels, their (lon, lat)
+    positions as one contiguous (n, 2) array and the adjacency in CSR format (indptr, indices and float32 weights),
+    with each edge stored in both directions. Rows are the positions of the nodes in the nodes array.
+    The graph dict holds the same caches as the attributes of a networkx graph (see routes.get_csr), so it must not be
+    modified once it is used.
+    """
+    __slots__ = ("nodes", "positions", "indptr", "indices", "weights", "graph", "_index")
+
+    def __init__(self, nodes: np.ndarray, positions: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                 weights: np.ndarray) -> None:
+        # np.asarray doesn't copy arrays (or memory maps) that already have the right type
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.graph: dict = {}
+        self._index: Optional[dict[int, int]] = None
+
+    @classmethod
+    def from_edges(cls, nodes: np.ndarray, positions: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                   weights: np.ndarray) -> "CompactGraph":
+        """Create a graph from its nodes and the rows of the two ends of each edge (each edge given once)."""
+        num_nodes = len(nodes)
+        index_type = np.int32 if num_nodes < 2**31 else np.int64
+        rows = np.concatenate((starts, ends)).astype(np.int64)
+        columns = np.concatenate((ends, starts)).astype(index_type)
+        order = np.lexsort((columns, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_nodes)))).astype(index_type)
+        return cls(nodes, positions, indptr, columns[order], np.concatenate((weights, weights))[order])
+
+    @classmethod
+    def from_networkx(cls, graph: nx.Graph) -> "CompactGraph":
+        """
+        Return the compact form of a networkx graph with 'pos' node attributes. Graphs made by to_networkx give back the
+        graph they were made from without copying. Edges without weight get their haversine length in km.
+        """
+        compact = graph.graph.get('compact')
+        if compact is not None:
+            return compact
+        nodes = list(graph.nodes())
+        index = {node: i for i, node in enumerate(nodes)}
+        positions = np.array([pos for _, pos in graph.nodes(data='pos')], dtype=np.float64).reshape(-1, 2)
+        edges = np.array([(index[u], index[v], np.nan if weight is None else weight)
+                          for u, v, weight in graph.edges(data='weight')], dtype=np.float64).reshape(-1, 3)
+        starts, ends, weights = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64), edges[:, 2]
+        missing = np.isnan(weights)
+        if missing.any():
+            weights[missing] = edge_lengths(positions[starts[missing]], positions[ends[missing]])
+        compact = cls.from_edges(np.array(nodes, dtype=np.int64), positions, starts, ends, weights)
+        graph.graph['compact'] = compact
+        return compact
+
+    def to_networkx(self) -> nx.Graph:
+        """
+        Return a networkx graph with the same nodes and edges. The 'pos' of every node is a view of a row of the
+        positions, and the CSR matrix (the arrays of this graph, not a copy) is cached as routes.get_csr expects.
+        """
+        graph = nx.Graph()
+        nodes = self.nodes.tolist()
+        graph.add_nodes_from((node, {'pos': position}) for node, position in zip(nodes, self.positions))
+        starts, ends, weights = self.edge_arrays()
+        graph.add_weighted_edges_from(zip(self.nodes[starts].tolist(), self.nodes[ends].tolist(), weights.tolist()))
+        graph.graph['csr'] = self.csr(), nodes, self.index
+        graph.graph['compact'] = self
+        return graph
+
+    @property
+    def index(self) -> dict[int, int]:
+        """The row of each node, built the first time it's needed."""
+        if self._index is None:
+            self._index = {node: i for i, node in enumerate(self.nodes.tolist())}
+        return self._index
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the arrays of the graph."""
+        return sum(array.nbytes for array in (self.nodes, self.positions, self.indptr, self.indices, self.weights))
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, node: int) -> bool:
+        return node in self.index
+
+    def number_of_nodes(self) -> int:
+        """Return the number of nodes."""
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        """Return the number of edges."""
+        return len(self.indices) // 2
+
+    def degrees(self) -> np.ndarray:
+        """Return the number of edges of every row."""
+        return np.diff(self.indptr)
+
+    def csr(self) -> csr_matrix:
+        """Return the weighted adjacency matrix, sharing the arrays of the graph."""
+        return csr_matrix((self.weights, self.indices, self.indptr), shape=(len(self.nodes), len(self.nodes)), copy=False)
+
+    def edge_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the rows of the two ends and the weight of every edge, each edge once (the first row is the lowest)."""
+        rows = np.repeat(np.arange(len(self.nodes)), self.degrees())
+        upper = rows < self.indices
+        return rows[upper], np.asarray(self.indices[upper], dtype=np.int64), self.weights[upper]
+
+    def position(self, node: int) -> np.ndarray:
+        """Return the (lon, lat) position of a node."""
+        return self.positions[self.index[node]]
+
+    def neighbors(self, node: int) -> list[int]:
+        """Return the nodes joined to a node by an edge."""
+        row = self.index[node]
+        return self.nodes[self.indices[self.indptr[row]:self.indptr[row + 1]]].tolist()
+
+    def weight(self, u: int, v: int) -> float:
+        """Return the weight of the edge between two nodes. Raises KeyError if there is no such edge."""
+        row, column = self.index[u], self.index[v]
+        start, end = self.indptr[row], self.indptr[row + 1]
+        # The columns of each row are sorted
+        position = start + int(np.searchsorted(self.indices[start:end], column))
+        if position == end or self.indices[position] != column:
+            raise KeyError((u, v))
+        return float(self.weights[position])
+
+
+def edge_lengths(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Return the haversine length in km of the edges between two (n, 2) arrays of (lon, lat) positions."""
+    # haversine expects (lat, lon)
+    return haversine.haversine_vector(starts[:, ::-1], ends[:, ::-1])
+
+
+def as_compact(graph: nx.Graph | CompactGraph) -> CompactGraph:
+    """Return the graph as a CompactGraph (see CompactGraph.from_networkx)."""
+    return graph if isinstance(graph, CompactGraph) else CompactGraph.from_networkx(graph)
+
+
+def as_networkx(graph: nx.Graph | CompactGraph) -> nx.Graph:
+    """Return the graph as a networkx graph, converting it if it's a CompactGraph."""
+    return graph.to_networkx() if isinstance(graph, CompactGraph) else graph
@@ -0,0 +1,68 @@
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Optional
+import threading
+
+
+# Maximum number of files written at the same time. Renders mostly wait for tiles and disk, so threads are enough.
+EXPORT_WORKERS = 4
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+@dataclass
+class ExportResult:
+    """The file an export wrote, and the error that stopped it, if any."""
+    filename: str
+    error: Optional[str] = None
+
+
+def set_export_workers(workers: int) -> None:
+    """Change the number of files written at the same time. Exports already submitted keep running."""
+    global _executor, EXPORT_WORKERS
+    with _executor_lock:
+        EXPORT_WORKERS = max(1, workers)
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the executor of the exports, creating it the first time."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(EXPORT_WORKERS, thread_name_prefix="export")
+        return _executor
+
+
+def submit_export(export: Callable[..., None], filename: str, *args) -> Future[ExportResult]:
+    """
+    Run export(*args, filename) in the background. The future never raises: the error is in its result,
+    so one file that can't be written doesn't stop the others.
+    """
+    return get_executor().submit(run_export, export, filename, *args)
+
+
+def run_export(export: Callable[..., None], filename: str, *args) -> ExportResult:
+    """Run an export and catch its error."""
+    try:
+        export(*args, filename)
+        return ExportResult(filename)
+    except Exception as e:
+        return ExportResult(filename, f"{type(e).__name__}: {e}")
+
+
+def wait_for_exports(futures: Iterable[Future[ExportResult]]) -> list[ExportResult]:
+    """Wait until the exports finish, print the ones that failed and return all the results."""
+    results = [future.result() for future in futures]
+    for result in results:
+        if result.error is not None:
+            print(f"Error saving {result.filename}: {result.error}")
+    return results
+
+
+def failed_exports(results: Iterable[ExportResult]) -> list[ExportResult]:
+    """Return the exports that failed."""
+    return [result for result in results if result.error is not None]
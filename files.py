@@ -0,0 +1,22 @@
+from contextlib import contextmanager
+from typing import IO, Iterator
+import contextlib, os, threading
+
+
+@contextmanager
+def atomic_write(filename: str, mode: str = "w") -> Iterator[IO]:
+    """
+    Open a temporary file next to filename and replace filename with it when the block ends, so the file is either the
+    old one or the complete new one, even if the program stops while writing it. If the block raises, the temporary file
+    is removed and filename is not changed.
+    """
+    # Other threads and processes may be writing the same file
+    temporary = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, mode) as file:
+            yield file
+        os.replace(temporary, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
@@ -1,136 +1,507 @@
-from sklearn.cluster import KMeans
-from segments import Point, Segments
-from math import acos, degrees
-from typing import TypeAlias
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+from segments import (Point, Segments, SegmentArray, load_segment_array, iter_segment_chunks, count_segments,
+                      SEGMENT_CHUNK_SIZE)
+from metrics import stage, count
+from files import atomic_write
+from compactgraph import CompactGraph, as_compact, edge_lengths
+from math import sqrt
+from typing import TypeAlias, Optional, Callable, Iterator
+from functools import partial
 import networkx as nx
 import numpy as np
+import hashlib, json, os
 
 
 Graph: TypeAlias = nx.Graph
-Matrix: TypeAlias = list[list[int]]
-Nodes: TypeAlias = list[tuple[int, int, int]]
-Edges: TypeAlias = list[tuple[int, int]]
 Array: TypeAlias = np.ndarray
 Points: TypeAlias = list[Point]
+PointChunks: TypeAlias = Callable[[], Iterator[Array]]
+Labeler: TypeAlias = Callable[[Array], Array]
 
+CLUSTERING_METHODS = ("kmeans", "minibatch", "grid")
 
-def make_graph(segments: Segments, num_clusters: int) -> Graph:
-    """Create and simplify a graph from the segments"""
-    points = convert_segments_to_numpy(segments)
-    centroids, labels = perform_kmeans_clustering(points, num_clusters)
-    graph = build_graph(centroids, labels)
-    simplified_graph = simplify_graph(graph, epsilon=20)
+# Maximum deviation from 180 degrees of the nodes removed by simplify_graph
+SIMPLIFY_EPSILON = 20
 
-    return simplified_graph
+# Points used to fit KMeans when the graph is built by chunks without a sample size (see make_graph_from_file)
+CHUNKED_SAMPLE_SIZE = 500_000
 
+# Version of the format of the saved graphs: saved graphs of other versions are rebuilt
+GRAPH_FORMAT_VERSION = 2
 
-def convert_segments_to_numpy(segments: Segments) -> Array:
-    """Convert a list of segments to a numpy array of points"""
+
+def make_graph(segments: Segments | SegmentArray, num_clusters: int, method: str = "kmeans",
+               n_jobs: Optional[int] = None, sample_size: Optional[int] = None, epsilon: float = SIMPLIFY_EPSILON,
+               compact: bool = False) -> Graph | CompactGraph:
+    """
+    Create and simplify a graph from the segments (a list of segments or an (N, 4) array of lat1, lon1, lat2, lon2).
+    The points are clustered with the chosen method (see cluster_points). The graph is built as a CompactGraph and
+    converted to networkx unless compact is True.
+    """
+    with stage("make_graph"):
+        points = convert_segments_to_numpy(segments)
+        with stage("make_graph.cluster"):
+            centroids, labels = cluster_points(points, num_clusters, method, n_jobs, sample_size)
+        with stage("make_graph.build"):
+            graph = build_compact_graph(centroids, labels)
+        count("clusters", len(centroids))
+        count("graph_edges", graph.number_of_edges())
+        with stage("make_graph.simplify"):
+            simplified_graph = simplify_graph(graph, epsilon)
+
+    return simplified_graph if compact else simplified_graph.to_networkx()
+
+
+def make_graph_from_file(segments_filename: str, num_clusters: int, method: str = "kmeans",
+                         chunk_size: int = SEGMENT_CHUNK_SIZE, n_jobs: Optional[int] = None, sample_size: Optional[int] = None,
+                         epsilon: float = SIMPLIFY_EPSILON, compact: bool = False) -> Graph | CompactGraph:
+    """
+    Create and simplify the graph of the segments of a .npy or text file like make_graph, reading chunk_size segments at
+    a time, so the memory used grows with the number of clusters and edges but not with the number of segments.
+    The centroids are fitted first (see fit_centroids_by_chunks). Then the points of every chunk get their labels and the
+    segments joining each pair of clusters are added up. With the same centroids, the graph is the same as make_graph's:
+    always with the grid method (up to the rounding of the centroids), but KMeans and MiniBatchKMeans start from random
+    centroids, so they only match when their random_state is fixed.
+    """
+    def read_chunks() -> Iterator[Array]:
+        return (convert_segments_to_numpy(segments) for segments in iter_segment_chunks(segments_filename, chunk_size))
+
+    with stage("make_graph"), threadpool_limits(n_jobs):
+        with stage("make_graph.cluster"):
+            num_points = 2 * count_segments(segments_filename)
+            centroids, labeler = fit_centroids_by_chunks(read_chunks, num_points, num_clusters, method, sample_size)
+        with stage("make_graph.label"):
+            pairs, counts = count_crossings_by_chunks(read_chunks, labeler, len(centroids))
+        with stage("make_graph.build"):
+            graph = build_graph_from_crossings(centroids, pairs, counts)
+        count("clusters", len(centroids))
+        count("graph_edges", graph.number_of_edges())
+        with stage("make_graph.simplify"):
+            simplified_graph = simplify_graph(graph, epsilon)
+
+    return simplified_graph if compact else simplified_graph.to_networkx()
+
+
+def get_graph(segments_filename: str, num_clusters: int, method: str = "kmeans", epsilon: float = SIMPLIFY_EPSILON,
+              rebuild: bool = False, compact: bool = False, chunk_size: Optional[int] = None) -> Graph | CompactGraph:
+    """
+    Get the graph of the segments of a binary .npy file (see make_graph). The graph is saved next to the file the first time,
+    and later it is loaded memory-mapped instead of being made again, as long as the segments, the number of clusters,
+    the method, epsilon and the way it is built are the same. If rebuild is True, the graph is always made again.
+    If chunk_size is given, the graph is made reading that many segments at a time (see make_graph_from_file), with the
+    centroids fitted on a sample of CHUNKED_SAMPLE_SIZE points, so it is saved as another graph than the one made in memory.
+    The directory of the saved graph and its key are kept in the graph attributes, so the files derived from the graph
+    (like the route trees, see routes.prepare_route_trees) can be saved next to it.
+    """
+    directory = get_graph_directory(segments_filename, num_clusters, method, epsilon)
+    saved_key = read_graph_key(directory)
+    build, sample_size = ("chunked", CHUNKED_SAMPLE_SIZE) if chunk_size is not None else ("memory", None)
+    key = get_graph_key(segments_filename, num_clusters, method, epsilon, saved_key, build, sample_size)
+    if not rebuild and saved_key is not None and is_same_graph(saved_key, key):
+        if saved_key != key:
+            # Same content with another modification time: remember it so the file isn't hashed again
+            write_graph_key(directory, key)
+        count("graphs_loaded")
+        with stage("load_graph"):
+            graph = load_graph(directory, compact)
+    else:
+        if chunk_size is not None:
+            graph = make_graph_from_file(segments_filename, num_clusters, method, chunk_size, epsilon=epsilon, compact=True)
+        else:
+            graph = make_graph(load_segment_array(segments_filename), num_clusters, method, epsilon=epsilon, compact=True)
+        save_graph(graph, directory, key)
+        graph = graph if compact else graph.to_networkx()
+    graph.graph['directory'], graph.graph['key'] = directory, key
+    return graph
+
+
+def get_graph_directory(segments_filename: str, num_clusters: int, method: str, epsilon: float) -> str:
+    """Return the directory where the graph of the segments is saved."""
+    return f"{os.path.splitext(segments_filename)[0]}.graph-{num_clusters}-{method}-{epsilon:g}"
+
+
+def get_graph_key(segments_filename: str, num_clusters: int, method: str, epsilon: float, saved_key: Optional[dict],
+                  build: str = "memory", sample_size: Optional[int] = None) -> dict:
+    """
+    Return the key of the graph: the SHA-256 of the segments file, the parameters of make_graph and how it was built
+    ("memory" or "chunked", and the sample size of the centroids), plus the size and modification time of the file.
+    The file is only hashed again if its size or modification time differ from the saved key.
+    """
+    status = os.stat(segments_filename)
+    key = {"version": GRAPH_FORMAT_VERSION, "num_clusters": num_clusters, "method": method, "epsilon": epsilon,
+           "build": build, "sample_size": sample_size}
+    saved_key = saved_key or {}
+    if saved_key.get("size") == status.st_size and saved_key.get("mtime") == status.st_mtime:
+        key["sha256"] = saved_key.get("sha256")
+    else:
+        key["sha256"] = hash_file(segments_filename)
+    return key | {"size": status.st_size, "mtime": status.st_mtime}
+
+
+def is_same_graph(key1: dict, key2: dict) -> bool:
+    """Check if two keys belong to the same graph, whatever the modification time of the segments file."""
+    return all(key1.get(field) == key2.get(field)
+               for field in ("version", "num_clusters", "method", "epsilon", "build", "sample_size", "sha256"))
+
+
+def hash_file(filename: str) -> str:
+    """Return the SHA-256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_graph_key(directory: str) -> Optional[dict]:
+    """Return the key of the graph saved in the directory, or None if there is no complete saved graph."""
+    try:
+        with open(os.path.join(directory, "key.json"), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_graph(graph: Graph | CompactGraph, directory: str, key: dict) -> None:
+    """
+    Save the graph in the directory as .npy arrays: the arrays of its CompactGraph (the node labels, their (lon, lat)
+    positions and the weighted adjacency matrix in CSR format). The key is written last, so an interrupted save is never loaded.
+    The files of a previous graph in the directory are removed first, with the files derived from it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    try:
+        os.remove(os.path.join(directory, "key.json"))
+    except FileNotFoundError:
+        pass
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    compact = as_compact(graph)
+    arrays = {"nodes": compact.nodes, "positions": compact.positions,
+              "indptr": compact.indptr, "indices": compact.indices, "weights": compact.weights}
+    for name, array in arrays.items():
+        with atomic_write(os.path.join(directory, f"{name}.npy"), "wb") as file:
+            np.save(file, array)
+    write_graph_key(directory, key)
+
+
+def write_graph_key(directory: str, key: dict) -> None:
+    """Write the key of the graph saved in the directory."""
+    with atomic_write(os.path.join(directory, "key.json")) as file:
+        json.dump(key, file, indent=1)
+
+
+def load_graph(directory: str, compact: bool = False) -> Graph | CompactGraph:
+    """
+    Load a graph saved by save_graph as a CompactGraph of memory-mapped arrays, converted to networkx unless compact
+    is True (the CSR matrix is then cached in the graph attributes, so routing doesn't have to build it again).
+    """
+    arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+              for name in ("nodes", "positions", "indptr", "indices", "weights")]
+    graph = CompactGraph(*arrays)
+    return graph if compact else graph.to_networkx()
+
+
+def convert_segments_to_numpy(segments: Segments | SegmentArray) -> Array:
+    """Convert the segments to a numpy array of points, with the start and end of each segment in consecutive rows"""
+    if isinstance(segments, np.ndarray):
+        # Points are (lon, lat), as the points of a list of segments loaded from a file
+        return np.asarray(segments[:, [1, 0, 3, 2]], dtype=np.float64).reshape(-1, 2)
     points = [point for segment in segments for point in (segment.start, segment.end)]
     points_array = np.array([[point.lat, point.lon] for point in points])
     return points_array
 
 
-def perform_kmeans_clustering(points: Array, num_clusters: int) -> tuple[Array, Array]:
+def cluster_points(points: Array, num_clusters: int, method: str = "kmeans",
+                   n_jobs: Optional[int] = None, sample_size: Optional[int] = None) -> tuple[Array, Array]:
+    """
+    Cluster the points using at most n_jobs threads (all of them if None). The methods are:
+    - "kmeans": full-batch KMeans.
+    - "minibatch": MiniBatchKMeans, much faster and lighter for millions of points.
+    - "grid": snap the points to a grid of about num_clusters cells over their bounding box.
+    With kmeans and minibatch, if sample_size is given, the centroids are fitted on that many random points and then every point is assigned to its closest centroid.
+    """
+    with threadpool_limits(n_jobs):
+        if method == "kmeans":
+            return perform_kmeans_clustering(points, num_clusters, sample_size)
+        if method == "minibatch":
+            return perform_minibatch_kmeans_clustering(points, num_clusters, sample_size)
+        if method == "grid":
+            return perform_grid_clustering(points, num_clusters)
+    raise ValueError(f"Unknown clustering method: {method}. Use one of {', '.join(CLUSTERING_METHODS)}.")
+
+
+def perform_kmeans_clustering(points: Array, num_clusters: int, sample_size: Optional[int] = None) -> tuple[Array, Array]:
     """ Perform KMeans clustering on the points. """
     kmeans = KMeans(num_clusters)
-    kmeans.fit(points)
-    centroids = kmeans.cluster_centers_
-    labels = kmeans.labels_
+    return fit_clusters(kmeans, points, sample_size)
+
+
+def perform_minibatch_kmeans_clustering(points: Array, num_clusters: int, sample_size: Optional[int] = None) -> tuple[Array, Array]:
+    """Perform MiniBatchKMeans clustering on the points."""
+    return fit_clusters(make_minibatch_kmeans(num_clusters), points, sample_size)
+
+
+def make_minibatch_kmeans(num_clusters: int) -> MiniBatchKMeans:
+    """Create the MiniBatchKMeans model used for num_clusters clusters."""
+    return MiniBatchKMeans(num_clusters, batch_size=max(1024, 4 * num_clusters), n_init=3)
+
+
+def fit_clusters(kmeans: KMeans | MiniBatchKMeans, points: Array, sample_size: Optional[int]) -> tuple[Array, Array]:
+    """Fit the model on the points (or on a random sample of sample_size points) and return the centroids and the labels of all the points."""
+    if sample_size is None or sample_size >= len(points):
+        kmeans.fit(points)
+        return kmeans.cluster_centers_, kmeans.labels_
+    sample = choose_sample(len(points), sample_size)
+    kmeans.fit(points[sample])
+    return kmeans.cluster_centers_, kmeans.predict(points)
 
+
+def choose_sample(num_points: int, sample_size: int) -> Array:
+    """Choose the indices of sample_size random points, always the same ones for the same number of points."""
+    return np.random.default_rng(0).choice(num_points, sample_size, replace=False)
+
+
+def perform_grid_clustering(points: Array, num_clusters: int) -> tuple[Array, Array]:
+    """Snap the points to square cells (about num_clusters over the bounding box) and use the mean of each non-empty cell as its centroid."""
+    low, high = points.min(axis=0), points.max(axis=0)
+    extent = high - low
+    cell_size = grid_cell_size(extent, num_clusters)
+    cells = np.floor((points - low) / cell_size).astype(np.int64)
+    _, labels = np.unique(cells, axis=0, return_inverse=True)
+    labels = labels.ravel()
+    counts = np.bincount(labels)
+    centroids = np.column_stack([np.bincount(labels, weights=points[:, i]) / counts for i in range(points.shape[1])])
     return centroids, labels
 
 
-def build_graph(centroids: Array, labels: Array) -> Graph:
-    """Build a graph based on the centroids and their labels"""
-    graph = nx.Graph()
-    add_nodes_to_graph(graph, centroids)
-    edges = create_edges(labels)
-    graph.add_edges_from(edges)
-    remove_nodes_with_no_edges(graph)
-    
+def grid_cell_size(extent: Array, num_clusters: int) -> float:
+    """Return the side of the square cells that split a bounding box of the given extent into about num_clusters cells."""
+    return max(sqrt(float(np.prod(extent)) / num_clusters), float(extent.max()) / num_clusters, 1e-9)
+
+
+def build_compact_graph(centroids: Array, labels: Array) -> CompactGraph:
+    """
+    Build the graph of the clusters joined by at least two segments, with the haversine length of each edge as its weight.
+    Nodes are the labels of the clusters with at least one edge, in increasing order.
+    """
+    pairs, counts = count_crossings(labels)
+    return build_graph_from_crossings(centroids, pairs, counts)
+
+
+def build_graph_from_crossings(centroids: Array, pairs: Array, counts: Array) -> CompactGraph:
+    """Build the CompactGraph of the centroids with an edge between the pairs of clusters joined by at least two segments."""
+    pairs = pairs[counts >= 2]
+    nodes = np.unique(pairs)
+    starts, ends = np.searchsorted(nodes, pairs[:, 0]), np.searchsorted(nodes, pairs[:, 1])
+    positions = np.asarray(centroids, dtype=np.float64)[nodes].reshape(-1, 2)
+    weights = edge_lengths(positions[starts], positions[ends]) if len(nodes) else np.empty(0)
+    return CompactGraph.from_edges(nodes, positions, starts, ends, weights)
+
+
+def count_crossings(labels: Array) -> tuple[Array, Array]:
+    """
+    Count the segments joining each pair of different clusters, given the labels of the start and end of each segment in consecutive positions.
+    Returns the (cluster1, cluster2) pairs with cluster1 < cluster2, sorted, and their counts (a sparse adjacency matrix).
+    """
+    starts, ends = np.asarray(labels[0::2], dtype=np.int64), np.asarray(labels[1::2], dtype=np.int64)
+    crossing = starts != ends
+    low, high = np.minimum(starts, ends)[crossing], np.maximum(starts, ends)[crossing]
+    # Each pair is packed into a single integer so that counting them is a 1D np.unique
+    num_clusters = int(high.max()) + 1 if len(high) > 0 else 1
+    keys, counts = np.unique(low * num_clusters + high, return_counts=True)
+    return np.column_stack((keys // num_clusters, keys % num_clusters)), counts
+
+
+def set_edge_weights(graph: Graph) -> None:
+    """Set the weight of every edge to its haversine length in km, computed for all the edges at once."""
+    edges = list(graph.edges())
+    if not edges:
+        return
+    starts = np.array([graph.nodes[u]['pos'] for u, _ in edges])
+    ends = np.array([graph.nodes[v]['pos'] for _, v in edges])
+    lengths = edge_lengths(starts, ends)
+    nx.set_edge_attributes(graph, dict(zip(edges, lengths.tolist())), 'weight')
+
+
+def simplify_graph(graph: Graph | CompactGraph, epsilon: float) -> Graph | CompactGraph:
+    """
+    Simplify the graph by removing nodes with exactly two edges if the angle between the edges is near 180 degrees.
+    Whole chains of such nodes are collapsed, round after round, until no node can be removed. The weight of each
+    merged edge is the sum of the weights of the edges it replaces (edges without weight get their haversine length).
+    A networkx graph is changed in place; a CompactGraph is returned as a new one.
+    """
+    if isinstance(graph, CompactGraph):
+        starts, ends, weights = graph.edge_arrays()
+        removed, starts, ends, weights = simplify_edges(graph.positions, starts, ends, weights.astype(np.float64), epsilon)
+        # Rows of the kept nodes after removing the others
+        rows = np.cumsum(~removed) - 1
+        return CompactGraph.from_edges(graph.nodes[~removed], graph.positions[~removed], rows[starts], rows[ends], weights)
+    # The cached arrays of the graph won't match it anymore
+    for cache in ('compact', 'csr', 'spatial_index', 'route_trees', 'directory', 'key'):
+        graph.graph.pop(cache, None)
+    edge_list = list(graph.edges(data='weight'))
+    if any(weight is None for _, _, weight in edge_list):
+        set_edge_weights(graph)
+        edge_list = list(graph.edges(data='weight'))
+    nodes = list(graph.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    positions = np.array([pos for _, pos in graph.nodes(data='pos')], dtype=np.float64).reshape(-1, 2)
+    edges = np.array([(index[u], index[v], weight) for u, v, weight in edge_list], dtype=np.float64).reshape(-1, 3)
+    starts, ends, weights = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64), edges[:, 2]
+    removed, starts, ends, weights = simplify_edges(positions, starts, ends, weights, epsilon)
+    graph.remove_nodes_from([nodes[i] for i in np.flatnonzero(removed).tolist()])
+    graph.add_weighted_edges_from(zip([nodes[i] for i in starts.tolist()], [nodes[i] for i in ends.tolist()], weights.tolist()))
+
     return graph
 
 
-def add_nodes_to_graph(graph: Graph, centroids: Array) -> None:
-    """Add nodes to the graph based on centroids."""
-    for i, centroid in enumerate(centroids):
-        graph.add_node(i, pos=centroid)
-
-
-def create_edges(labels: Array) -> Edges:
-    """Create edges based on the labels of the clusters"""
-    max_cluster = max(labels) + 1
-    adjacency_matrix = create_adjacency_matrix(labels, max_cluster)
-    edges = extract_edges_from_matrix(adjacency_matrix, max_cluster)
-    
-    return edges
-    
-
-def create_adjacency_matrix(labels: Array, max_cluster:int) -> Matrix:
-    """Create an adjacency matrix from the cluster labels."""
-    adjacency_matrix: Matrix = [[0 for _ in range(max_cluster)] for _ in range(max_cluster)]
-    for i in range(0, len(labels), 2):
-        if labels[i] != labels[i + 1]:
-            cluster1, cluster2 = labels[i], labels[i + 1]
-            adjacency_matrix[cluster1][cluster2] += 1
-            
-    return adjacency_matrix
-
-
-def extract_edges_from_matrix(adjacency_matrix: Matrix, max_cluster: int) -> Edges:
-    """ Extract edges from the adjacency matrix. """
-    centroid_edges: Edges = []
-    for cluster1 in range(max_cluster):
-        for cluster2 in range(max_cluster):
-            if adjacency_matrix[cluster1][cluster2] + adjacency_matrix[cluster2][cluster1] >= 2:
-                centroid_edges.append((cluster1, cluster2))
-
-    return centroid_edges
-
-
-def remove_nodes_with_no_edges(graph: Graph) -> None:
-    """Remove nodes from the graph that have no edges."""
-    nodes_to_remove = [node for node in graph.nodes() if graph.degree[node] == 0]
-    graph.remove_nodes_from(nodes_to_remove)
-
-
-def simplify_graph(graph: Graph, epsilon: float) -> Graph:
-    """Simplify the graph by removing nodes with exactly two edges if the angle between the edges is near 180 degrees"""
-    nodes_to_remove = find_nodes_to_remove(graph, epsilon)
-    remove_nodes(graph, nodes_to_remove)
-
-    return graph 
-
-            
-def find_nodes_to_remove(graph: Graph, epsilon: float) -> Nodes:
-    """Returns the list of nodes which should be simplified"""
-    nodes_to_remove: Nodes = []
-    for node in list(graph.nodes):
-        neighbors = list(graph.neighbors(node))
-        if len(neighbors) == 2:
-            point1, point2, point3 = graph.nodes[neighbors[0]]['pos'], graph.nodes[node]['pos'], graph.nodes[neighbors[1]]['pos']
-            angle = calculate_angle(point1, point2, point3)
-            if abs(angle - 180) < epsilon:
-                nodes_to_remove.append((node, neighbors[0], neighbors[1]))
-                
-    return nodes_to_remove
-
-
-def remove_nodes(graph: Graph, nodes_to_remove: Nodes) -> None:
-    """Remove nodes from the graph and connect their neighbors."""
-    for node, neighbor1, neighbor2 in nodes_to_remove:
-        if graph.has_node(node) and graph.has_node(neighbor1) and graph.has_node(neighbor2):
-            if not graph.has_edge(neighbor1, neighbor2):
-                graph.add_edge(neighbor1, neighbor2)
-            graph.remove_node(node)
-
-
-def calculate_angle(p1: list[float], p2: list[float], p3: list[float]) -> float:
-    """Calculate the angle between three points p1, p2, and p3 with p2 being the vertex"""
-    vector1 = np.array([p1[0] - p2[0], p1[1] - p2[1]])
-    vector2 = np.array([p3[0] - p2[0], p3[1] - p2[1]])
-    cos_angle = np.dot(vector1, vector2) / (np.linalg.norm(vector1) * np.linalg.norm(vector2))
-    angle = degrees(acos(cos_angle))
-
-    return angle
\ No newline at end of file
+def simplify_edges(positions: Array, starts: Array, ends: Array, weights: Array, epsilon: float) -> tuple[Array, Array, Array, Array]:
+    """
+    Simplify a graph given as the rows of the ends of its edges and their weights (see simplify_graph).
+    Returns a mask of the removed rows and the edges of the simplified graph.
+    """
+    num_nodes = len(positions)
+    removed = np.zeros(num_nodes, dtype=bool)
+    rng = np.random.default_rng(0)
+    while True:
+        centers, neighbors, neighbor_weights = find_nodes_to_remove(positions, starts, ends, weights, epsilon)
+        if len(centers) == 0:
+            break
+        count("simplify_rounds")
+        selected = select_independent_nodes(centers, neighbors, num_nodes, rng)
+        centers, neighbors, neighbor_weights = centers[selected], neighbors[selected], neighbor_weights[selected]
+        removed[centers] = True
+        keep = ~(removed[starts] | removed[ends])
+        starts = np.concatenate((starts[keep], neighbors[:, 0]))
+        ends = np.concatenate((ends[keep], neighbors[:, 1]))
+        weights = np.concatenate((weights[keep], neighbor_weights.sum(axis=1)))
+        starts, ends, weights = merge_parallel_edges(starts, ends, weights, num_nodes)
+
+    count("simplify_nodes_removed", int(np.count_nonzero(removed)))
+    return removed, starts, ends, weights
+
+
+def find_nodes_to_remove(positions: Array, starts: Array, ends: Array, weights: Array, epsilon: float) -> tuple[Array, Array, Array]:
+    """
+    Return the nodes with exactly two edges whose angle is within epsilon degrees of 180 (or with a neighbor at the same
+    position), the two neighbors of each one and the weights of the two edges, all computed at once.
+    """
+    endpoints = np.concatenate((starts, ends))
+    degrees = np.bincount(endpoints, minlength=len(positions))
+    # Incidences sorted by node, so the two edges of a node with degree 2 are consecutive
+    order = np.argsort(endpoints, kind="stable")
+    others = np.concatenate((ends, starts))[order]
+    incident_weights = np.concatenate((weights, weights))[order]
+    first = np.concatenate(([0], np.cumsum(degrees)[:-1]))
+    centers = np.flatnonzero(degrees == 2)
+    neighbors = np.column_stack((others[first[centers]], others[first[centers] + 1]))
+    neighbor_weights = np.column_stack((incident_weights[first[centers]], incident_weights[first[centers] + 1]))
+    angles = calculate_angles(positions[neighbors[:, 0]], positions[centers], positions[neighbors[:, 1]])
+    removable = np.isnan(angles) | (np.abs(angles - 180) < epsilon)
+    return centers[removable], neighbors[removable], neighbor_weights[removable]
+
+
+def select_independent_nodes(centers: Array, neighbors: Array, num_nodes: int, rng: np.random.Generator) -> Array:
+    """
+    Return a mask of the nodes that can be removed in the same round: those whose neighbors are not removable
+    or have a lower random priority, so that no two neighbors are removed together.
+    """
+    priorities = np.full(num_nodes, -1.0)
+    priorities[centers] = rng.random(len(centers))
+    return (priorities[neighbors[:, 0]] < priorities[centers]) & (priorities[neighbors[:, 1]] < priorities[centers])
+
+
+def merge_parallel_edges(starts: Array, ends: Array, weights: Array, num_nodes: int) -> tuple[Array, Array, Array]:
+    """Keep only the lightest edge between each pair of nodes."""
+    low, high = np.minimum(starts, ends), np.maximum(starts, ends)
+    keys = low * num_nodes + high
+    order = np.lexsort((weights, keys))
+    first = np.concatenate(([True], keys[order][1:] != keys[order][:-1]))
+    kept = order[first]
+    return low[kept], high[kept], weights[kept]
+
+
+def calculate_angles(p1: Array, p2: Array, p3: Array) -> Array:
+    """Calculate the angles in degrees between rows of points p1, p2 and p3, with p2 being the vertex (nan if p1 or p3 is at p2)"""
+    vector1, vector2 = p1 - p2, p3 - p2
+    norms = np.linalg.norm(vector1, axis=1) * np.linalg.norm(vector2, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_angles = np.einsum("ij,ij->i", vector1, vector2) / norms
+    return np.degrees(np.arccos(np.clip(cos_angles, -1, 1)))
+
+
+def fit_centroids_by_chunks(read_chunks: PointChunks, num_points: int, num_clusters: int, method: str,
+                            sample_size: Optional[int] = None) -> tuple[Array, Labeler]:
+    """
+    Fit the centroids of the points given by read_chunks (which returns a new iterator of arrays of points on each call)
+    and return them with a function that labels points. Each method keeps a bounded amount of points in memory:
+    - "kmeans" and "minibatch": the model of cluster_points fitted on the same random sample of sample_size points
+      (CHUNKED_SAMPLE_SIZE if None), or on all of them in order if there aren't more. The points come in the order of the
+      file, grouped by area, so updating MiniBatchKMeans with partial_fit chunk by chunk leaves the centroids of the
+      first chunks where they started.
+    - "grid": the cells of perform_grid_clustering, with the bounding box and the means of the cells added up by chunks.
+    """
+    if method in ("kmeans", "minibatch"):
+        kmeans = KMeans(num_clusters) if method == "kmeans" else make_minibatch_kmeans(num_clusters)
+        kmeans.fit(gather_sample(read_chunks, num_points, sample_size or CHUNKED_SAMPLE_SIZE))
+        return kmeans.cluster_centers_, kmeans.predict
+    if method == "grid":
+        return fit_grid_by_chunks(read_chunks, num_clusters)
+    raise ValueError(f"Unknown clustering method: {method}. Use one of {', '.join(CLUSTERING_METHODS)}.")
+
+
+def gather_sample(read_chunks: PointChunks, num_points: int, sample_size: int) -> Array:
+    """Return a random sample of the points, gathered chunk by chunk in the order fit_clusters would use."""
+    sample = choose_sample(num_points, sample_size) if sample_size < num_points else np.arange(num_points)
+    order = np.argsort(sample)
+    sorted_sample = sample[order]
+    points_sample = np.empty((len(sample), 2))
+    offset = 0
+    for points in read_chunks():
+        low, high = np.searchsorted(sorted_sample, [offset, offset + len(points)])
+        points_sample[order[low:high]] = points[sorted_sample[low:high] - offset]
+        offset += len(points)
+    return points_sample
+
+
+def fit_grid_by_chunks(read_chunks: PointChunks, num_clusters: int) -> tuple[Array, Labeler]:
+    """Compute the centroids of the grid cells of perform_grid_clustering in two passes over the chunks."""
+    low, high = np.full(2, np.inf), np.full(2, -np.inf)
+    for points in read_chunks():
+        if len(points) > 0:
+            low, high = np.minimum(low, points.min(axis=0)), np.maximum(high, points.max(axis=0))
+    cell_size = grid_cell_size(high - low, num_clusters)
+    shape = np.floor((high - low) / cell_size).astype(np.int64) + 1
+    num_cells = int(np.prod(shape))
+    sums, counts = np.zeros((num_cells, 2)), np.zeros(num_cells)
+    for points in read_chunks():
+        keys = grid_cell_keys(points, low, cell_size, shape)
+        counts += np.bincount(keys, minlength=num_cells)
+        for i in range(2):
+            sums[:, i] += np.bincount(keys, weights=points[:, i], minlength=num_cells)
+    # Occupied cells in increasing key order are in the order of np.unique over the (x, y) cells
+    occupied = np.flatnonzero(counts)
+    centroids = sums[occupied] / counts[occupied, None]
+    return centroids, partial(grid_labels, low=low, cell_size=cell_size, shape=shape, occupied=occupied)
+
+
+def grid_cell_keys(points: Array, low: Array, cell_size: float, shape: Array) -> Array:
+    """Return the number of the grid cell of every point, row by row of x cells."""
+    cells = np.floor((points - low) / cell_size).astype(np.int64)
+    return cells[:, 0] * shape[1] + cells[:, 1]
+
+
+def grid_labels(points: Array, low: Array, cell_size: float, shape: Array, occupied: Array) -> Array:
+    """Return the label of the grid cell of every point among the occupied cells."""
+    return np.searchsorted(occupied, grid_cell_keys(points, low, cell_size, shape))
+
+
+def count_crossings_by_chunks(read_chunks: PointChunks, labeler: Labeler, num_clusters: int) -> tuple[Array, Array]:
+    """Count the segments joining each pair of different clusters like count_crossings, adding up the counts of every chunk."""
+    keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    for points in read_chunks():
+        pairs, chunk_counts = count_crossings(labeler(points))
+        keys, inverse = np.unique(np.concatenate((keys, pairs[:, 0] * num_clusters + pairs[:, 1])), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate((counts, chunk_counts)), minlength=len(keys)).astype(np.int64)
+    return np.column_stack((keys // num_clusters, keys % num_clusters)), counts
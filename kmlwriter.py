@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+from typing import Iterator, TextIO, TypeAlias
+from xml.sax.saxutils import escape
+import numpy as np
+import io, zipfile
+
+
+Array: TypeAlias = np.ndarray
+Styles: TypeAlias = dict[str, str]
+
+
+@contextmanager
+def kml_document(filename: str, name: str, styles: Styles) -> Iterator[TextIO]:
+    """
+    Open a KML document for writing (zipped as KMZ if filename ends with .kmz), write its header and shared styles,
+    and yield the file so placemarks are written to it as they are produced. The document is closed at the end.
+    """
+    if filename.endswith(".kmz"):
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("doc.kml", "w", force_zip64=True) as binary:
+                with io.TextIOWrapper(binary, encoding="utf-8") as file:
+                    yield from write_document(file, name, styles)
+    else:
+        with open(filename, "w", encoding="utf-8") as file:
+            yield from write_document(file, name, styles)
+
+
+def write_document(file: TextIO, name: str, styles: Styles) -> Iterator[TextIO]:
+    """Write the start of the document, yield the file and then write the end of the document."""
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n')
+    file.write(f"<Document><name>{escape(name)}</name>\n")
+    for style_id, style in styles.items():
+        file.write(f'<Style id="{style_id}">{style}</Style>\n')
+    yield file
+    file.write("</Document>\n</kml>\n")
+
+
+def icon_style(color: str, scale: float) -> str:
+    """Return the content of a style for points with the given aabbggrr color."""
+    return f"<IconStyle><color>{color}</color><scale>{scale}</scale></IconStyle>"
+
+
+def line_style(color: str, width: float) -> str:
+    """Return the content of a style for lines with the given aabbggrr color."""
+    return f"<LineStyle><color>{color}</color><width>{width}</width></LineStyle>"
+
+
+def write_point(file: TextIO, name: str, lon: float, lat: float, style_id: str = "") -> None:
+    """Write a point placemark."""
+    style = f"<styleUrl>#{style_id}</styleUrl>" if style_id else ""
+    file.write(f"<Placemark><name>{escape(name)}</name>{style}<Point><coordinates>{lon},{lat}</coordinates></Point></Placemark>\n")
+
+
+def write_points(file: TextIO, names: list[str], positions: Array, style_id: str = "") -> None:
+    """Write a point placemark for every (lon, lat) row."""
+    for name, (lon, lat) in zip(names, positions.tolist()):
+        write_point(file, name, lon, lat, style_id)
+
+
+def write_lines(file: TextIO, name: str, polylines: list[Array], style_id: str = "") -> None:
+    """Write all the polylines ((lon, lat) rows) as the LineStrings of a single MultiGeometry placemark."""
+    style = f"<styleUrl>#{style_id}</styleUrl>" if style_id else ""
+    file.write(f"<Placemark><name>{escape(name)}</name>{style}<MultiGeometry>\n")
+    for polyline in polylines:
+        coordinates = " ".join(f"{lon},{lat}" for lon, lat in polyline.tolist())
+        file.write(f"<LineString><coordinates>{coordinates}</coordinates></LineString>\n")
+    file.write("</MultiGeometry></Placemark>\n")
@@ -1,43 +1,54 @@
 from yogi import read
-from graphmaker import make_graph, Graph
+from graphmaker import get_graph, CLUSTERING_METHODS
+from compactgraph import CompactGraph
 from viewer import export_png, export_kml
-from segments import Box, Point, Segments, get_segments
-from monuments import get_monuments, load_monuments, Monuments
-from routes import find_routes
+from segments import Box, Point, SegmentArray, get_segment_array, get_array_filename
+from monuments import get_monuments, refresh_monuments, Monuments
+from routes import find_routes, choose_backend
+from tours import plan_tour
+from batch import run_jobs, load_jobs, make_box, prepare_segments, prepare_graph, get_segments_filename, timed, Timings, MONUMENTS_FILENAME
+from tiles import TileSource, set_tile_source
+from metrics import enable_metrics, save_metrics, PROFILE_MODES
+from exports import submit_export, wait_for_exports, set_export_workers
+from typing import Optional
+import argparse, os, requests
+import numpy as np
 
 
-def main() -> None:
+def main(rebuild: bool = False) -> None:
+    """Run the interactive program. If rebuild is True, graphs are made again instead of loading the saved ones."""
     introduction()
-    
+    while run_session(rebuild) == "restart":
+        pass
+
+
+def run_session(rebuild: bool) -> str:
+    """Process one box chosen by the user. Returns 'restart' if the user wants to define a new box, else 'exit'."""
     print("Please enter the coordinates of the region you would like to process:")
     box = get_user_input_box()
     
-    segments = get_segments_in_box(box)
-    if segments:
-        print("Creating the graph from the segments...")
-        graph = create_graph(segments)
-        
-        export_option = get_export_option()
-        export_graph(graph, export_option)
-        
-        print("Now, we will download the monuments data from Medieval Catalunya.")
-        filename_monuments = get_filename('monuments')
-        print("Please wait...")
-        get_monuments(box, f'{filename_monuments}.dat')
-        print("Download complete! You can now find optimal routes to nearby monuments within the region.")
-        monuments_of_the_box = load_monuments(box, f'{filename_monuments}.dat')
-        
-        while True:
-            find_optimal_routes(monuments_of_the_box, graph)
-            decision = input("Introduce 'exit' if you would like to exit.\nIntroduce 'restart' if you would like to define a new box.\nIf you want to continue, introduce any character: \n")
-            if decision == "exit": break
-            if decision == "restart": 
-                main() 
-                return
-    else:
+    filename_segments, segments = get_segments_in_box(box)
+    if len(segments) == 0:
         print("No segments downloaded. Try again with another box!")
-        main()
-        return
+        return "restart"
+
+    print("Creating the graph from the segments...")
+    graph = create_graph(filename_segments, rebuild)
+    
+    export_option = get_export_option()
+    export_graph(graph, export_option)
+    
+    print("Now, we will download the monuments data from Medieval Catalunya.")
+    filename_monuments = get_filename('monuments')
+    print("Please wait...")
+    monuments_of_the_box = get_monuments(box, f'{filename_monuments}.dat')
+    print("Download complete! You can now find optimal routes to nearby monuments within the region.")
+    
+    while True:
+        find_optimal_routes(monuments_of_the_box, graph)
+        decision = input("Introduce 'exit' if you would like to exit.\nIntroduce 'restart' if you would like to define a new box.\nIf you want to continue, introduce any character: \n")
+        if decision in ("exit", "restart"):
+            return decision
 
 
 def introduction() -> None:
@@ -70,20 +81,25 @@ def get_filename(information: str) -> str:
     return input(f"Indicate the name of the file where you would like to save the {information}. If the name of the file is the same as any other existing file, we will only consider the file already created.\n")
 
 
-def get_segments_in_box(box: Box) -> Segments:
-    """Get the segments within the specified box."""
+def get_segments_in_box(box: Box) -> tuple[str, SegmentArray]:
+    """Get the segments within the specified box, and the name of their binary file."""
     filename_segments = get_filename('segments')
     print("Downloading segments for the specified region. This may take a few minutes...")
-    return get_segments(box, f'{filename_segments}.dat')
+    try:
+        segments = get_segment_array(box, f'{filename_segments}.dat')
+    except requests.RequestException as e:
+        print(e)
+        segments = np.empty((0, 4))
+    return get_array_filename(f'{filename_segments}.dat'), segments
 
 
-def create_graph(segments: Segments) -> Graph:
-    """Create a graph from the given segments."""
+def create_graph(filename_segments: str, rebuild: bool = False) -> CompactGraph:
+    """Create a graph from the segments of the given binary file, or load it if it was already created with the same number of clusters."""
     while True:
         print("Please, indicate the number of clusters:")
         try:
             num_clusters = read(int)
-            return make_graph(segments, num_clusters)
+            return get_graph(filename_segments, num_clusters, rebuild=rebuild, compact=True)
         except ValueError:
             print("Invalid value. Please, introduce a number") 
 
@@ -106,28 +122,23 @@ def get_export_option() -> int:
             print("Invalid input. Please enter a number between 1 and 4.")
             
 
-def export_graph(graph: Graph, export_option: int) -> None:
+def export_graph(graph: CompactGraph, export_option: int) -> None:
     """Export the graph routes based on the chosen export option."""
     if export_option == 4:
         print("No export selected.")
         return
-    if export_option == 1:
-        filename_png = get_filename('graph.png')
-        export_png(graph, f"{filename_png}.png")
-        print(f"Graph routes exported to {filename_png}.png")
-    elif export_option == 2:
-        filename_kml = get_filename('graph.kml')
-        export_kml(graph, f"{filename_kml}.kml")
-        print(f"Graph routes exported to {filename_kml}.kml")
-    else:
-        filename_png = get_filename('graph.png')
-        filename_kml = get_filename('graph.kml')
-        export_png(graph, f"{filename_png}.png")
-        export_kml(graph, f"{filename_kml}.kml")
-        print(f"Graph routes exported to {filename_png}.png and {filename_kml}.kml")
+    futures = []
+    if export_option in (1, 3):
+        futures.append(submit_export(export_png, f"{get_filename('graph.png')}.png", graph))
+    if export_option in (2, 3):
+        futures.append(submit_export(export_kml, f"{get_filename('graph.kml')}.kml", graph))
+    # Both files are written at the same time
+    exported = [result.filename for result in wait_for_exports(futures) if result.error is None]
+    if exported:
+        print(f"Graph routes exported to {' and '.join(exported)}")
 
 
-def find_optimal_routes(monuments: Monuments, graph: Graph) -> None:
+def find_optimal_routes(monuments: Monuments, graph: CompactGraph) -> None:
     """Prompt the user to input an initial point and find optimal routes to nearby monuments within the region."""
     while True:    
         try:
@@ -137,7 +148,7 @@ def find_optimal_routes(monuments: Monuments, graph: Graph) -> None:
             point = Point(lat, lon)
             filename_routes = get_filename('routes')
             print(f"Calculating optimal routes from ({lat}, {lon}) to nearby monuments...")
-            contains_monuments = find_routes(graph, point, monuments, filename_routes)
+            contains_monuments = find_routes(graph, point, monuments, filename_routes, choose_backend(graph, 1, monuments))
             if contains_monuments == 1:
                 print(f"Done! To watch the results, look the {filename_routes} documents (.png and .kml)")
             return
@@ -145,8 +156,149 @@ def find_optimal_routes(monuments: Monuments, graph: Graph) -> None:
             print("Invalid input. Please enter numeric values for latitude and longitude.")    
 
 
+def parse_arguments(arguments: Optional[list[str]] = None) -> argparse.Namespace:
+    """Parse the command line. Without a command, the interactive program runs."""
+    parser = argparse.ArgumentParser(description="Medieval Routes Project")
+    parser.add_argument("--rebuild", action="store_true", help="make the graphs again instead of loading the saved ones")
+    parser.add_argument("--data-dir", default=".", help="directory of the segments, graphs and monuments files")
+    parser.add_argument("--tiles", help="URL or local path template ({z}/{x}/{y}) of the map tiles")
+    parser.add_argument("--metrics", help="save the counters and stage times to this file (.jsonl: JSON lines, else Prometheus text)")
+    parser.add_argument("--profile", choices=PROFILE_MODES, help="also profile every stage (needs --metrics)")
+    parser.add_argument("--export-workers", type=int, help="number of .png and .kml files written at the same time")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("interactive", help="answer the questions of the program (default)")
+
+    download_segments = commands.add_parser("download-segments", help="download the segments of a box")
+    add_box_argument(download_segments)
+
+    build_graph = commands.add_parser("build-graph", help="build (or load) the graph of a box")
+    add_graph_arguments(build_graph)
+
+    commands.add_parser("download-monuments", help="download the monuments catalog, or update it if the page changed")
+
+    route = commands.add_parser("route", help="save the routes from a start point to the monuments of a box")
+    add_graph_arguments(route)
+    route.add_argument("--start", nargs=2, type=float, required=True, metavar=("LAT", "LON"))
+    route.add_argument("--output", default="routes", help="name of the .png and .kml files of the routes")
+
+    tour = commands.add_parser("tour", help="print a short order to visit all the monuments of a box from a start point")
+    add_graph_arguments(tour)
+    tour.add_argument("--start", nargs=2, type=float, required=True, metavar=("LAT", "LON"))
+    tour.add_argument("--workers", type=int, default=1, help="number of processes that compute the distances")
+
+    render = commands.add_parser("render", help="export the graph of a box to .png and/or .kml")
+    add_graph_arguments(render)
+    render.add_argument("--png", help="name of the .png file")
+    render.add_argument("--kml", help="name of the .kml or .kmz file")
+
+    batch = commands.add_parser("batch", help="run the jobs of a JSON or CSV file (see batch.load_jobs)")
+    batch.add_argument("jobs", help="JSON or CSV file of jobs")
+    batch.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of processes")
+    batch.add_argument("--output-dir", default=".", help="directory where each job saves its files")
+    namespace = parser.parse_args(arguments)
+    if namespace.profile and namespace.metrics is None:
+        parser.error("--profile needs --metrics, the file where the profile is saved")
+    return namespace
+
+
+def add_box_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the box argument to a command."""
+    parser.add_argument("--box", nargs=4, type=float, required=True, metavar=("LAT1", "LON1", "LAT2", "LON2"),
+                        help="bottom left and top right corners")
+
+
+def add_graph_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments that choose a graph to a command."""
+    add_box_argument(parser)
+    parser.add_argument("--clusters", type=int, default=100, help="number of clusters")
+    parser.add_argument("--method", choices=CLUSTERING_METHODS, default="kmeans", help="clustering method")
+    parser.add_argument("--chunk-size", type=int, help="build the graph reading this many segments at a time, for inputs larger than the memory")
+
+
+def run_command(arguments: argparse.Namespace) -> None:
+    """Run a command of the command line and save its metrics, if asked."""
+    if arguments.tiles:
+        set_tile_source(TileSource(arguments.tiles))
+    if arguments.export_workers:
+        set_export_workers(arguments.export_workers)
+    if arguments.metrics is None:
+        run_stages(arguments)
+        return
+    enable_metrics(arguments.profile)
+    try:
+        run_stages(arguments)
+    finally:
+        save_metrics(arguments.metrics)
+        print(f"Metrics saved to {arguments.metrics}")
+
+
+def run_stages(arguments: argparse.Namespace) -> None:
+    """Run a command of the command line and print the time it took."""
+    if arguments.command in (None, "interactive"):
+        main(arguments.rebuild)
+        return
+    if arguments.command == "batch":
+        try:
+            jobs = load_jobs(arguments.jobs)
+        except (OSError, ValueError) as e:
+            print(f"The jobs could not be loaded: {e}")
+            return
+        run_jobs(jobs, arguments.data_dir, arguments.output_dir, arguments.workers, arguments.rebuild)
+        return
+    timings: Timings = {}
+    monuments_filename = os.path.join(arguments.data_dir, MONUMENTS_FILENAME)
+    if arguments.command == "download-monuments":
+        with timed(timings, "monuments"):
+            changes = refresh_monuments(monuments_filename)
+        if changes.not_modified:
+            print(f"The monuments in {monuments_filename} are up to date")
+        else:
+            print(f"Monuments saved to {monuments_filename}: {changes.added} added, {changes.changed} moved, {changes.removed} removed")
+    else:
+        box = make_box(arguments.box)
+        with timed(timings, "segments"):
+            num_segments = prepare_segments(box, arguments.data_dir)
+        print(f"{num_segments} segments in {get_segments_filename(box, arguments.data_dir)}")
+        if arguments.command != "download-segments" and num_segments > 0:
+            with timed(timings, "graph"):
+                graph = prepare_graph(box, arguments.clusters, arguments.method, arguments.data_dir, arguments.rebuild,
+                                      arguments.chunk_size)
+            print(f"Graph with {graph.number_of_nodes()} nodes and {graph.number_of_edges()} edges")
+            if arguments.command == "route":
+                with timed(timings, "monuments"):
+                    monuments = get_monuments(box, monuments_filename)
+                with timed(timings, "routes"):
+                    find_routes(graph, Point(*arguments.start), monuments, arguments.output, choose_backend(graph, 1, monuments))
+            elif arguments.command == "tour":
+                with timed(timings, "monuments"):
+                    monuments = get_monuments(box, monuments_filename)
+                with timed(timings, "tour"):
+                    tour, length = plan_tour(graph, monuments, Point(*arguments.start), arguments.workers)
+                print_tour(tour, length)
+            elif arguments.command == "render":
+                with timed(timings, "render"):
+                    futures = [submit_export(export, filename, graph)
+                               for export, filename in ((export_png, arguments.png), (export_kml, arguments.kml)) if filename]
+                    wait_for_exports(futures)
+    print(", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in timings.items()))
+
+
+def print_tour(tour: Monuments, length: float) -> None:
+    """Print the monuments of a tour in the order to visit them and its length."""
+    if not tour:
+        print('No monuments found in the selected box.')
+        return
+    for i, monument in enumerate(tour, 1):
+        print(f"{i}. {monument.name} ({monument.location.lat}, {monument.location.lon})")
+    if np.isinf(length):
+        print("Some monuments can't be reached from the start point on the graph.")
+    else:
+        print(f"Tour of {len(tour)} monuments: {length:.2f} km")
+
+
 if __name__ == "__main__":
-    main()
+    run_command(parse_arguments())
+
     
 #Box(Point(40.5363713, 0.5739316671), Point(40.79886535, 0.9021482)
 #Box(Point(40.5363713, 0.8139316671), Point(40.79886535, 0.90211422)
\ No newline at end of file
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional, TypeAlias
+import cProfile, pstats, json, threading, time, tracemalloc
+
+
+Snapshot: TypeAlias = dict[str, dict[str, float]]
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+# Prefix of the names of the metrics in the Prometheus text format
+METRICS_PREFIX = "medieval_routes"
+
+# Metrics are only collected after enable_metrics, so the hooks cost a single check otherwise
+_enabled = False
+_profile_mode: Optional[str] = None
+_counters: dict[str, float] = {}
+_stages: dict[str, dict[str, float]] = {}
+_profiles: dict[str, pstats.Stats] = {}
+_lock = threading.Lock()
+
+
+def enable_metrics(profile: Optional[str] = None) -> None:
+    """
+    Start collecting the counters and the time of the stages. If profile is "cprofile", every stage is also run under
+    cProfile (which only sees the thread that runs the stage). If it is "tracemalloc", the memory peak of every stage is recorded.
+    """
+    global _enabled, _profile_mode
+    if profile is not None and profile not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {profile}. Use one of {', '.join(PROFILE_MODES)}.")
+    _enabled, _profile_mode = True, profile
+
+
+def metrics_enabled() -> bool:
+    """Check if metrics are being collected."""
+    return _enabled
+
+
+def profile_mode() -> Optional[str]:
+    """Return how the stages are profiled, or None if they are only timed."""
+    return _profile_mode
+
+
+def reset_metrics() -> None:
+    """Forget all the collected metrics."""
+    with _lock:
+        _counters.clear()
+        _stages.clear()
+        _profiles.clear()
+
+
+def count(name: str, value: float = 1) -> None:
+    """Add value to a counter."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Measure the time (and the profile, if enabled) of a stage of the pipeline. Stages inside a profiled stage are only timed."""
+    if not _enabled:
+        yield
+        return
+    profiler = cProfile.Profile() if _profile_mode == "cprofile" else None
+    tracing = _profile_mode == "tracemalloc" and not tracemalloc.is_tracing()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running (a stage inside another stage)
+            profiler = None
+    if tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracing else None
+        if tracing:
+            tracemalloc.stop()
+        if profiler is not None:
+            profiler.disable()
+        record_stage(name, elapsed, peak, profiler)
+
+
+def record_stage(name: str, elapsed: float, peak: Optional[int], profiler: Optional[cProfile.Profile]) -> None:
+    """Add a run of a stage to its totals."""
+    with _lock:
+        totals = _stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+        totals["calls"] += 1
+        totals["seconds"] += elapsed
+        if peak is not None:
+            totals["peak_bytes"] = max(totals.get("peak_bytes", 0), peak)
+        if profiler is not None:
+            if name in _profiles:
+                _profiles[name].add(profiler)
+            else:
+                _profiles[name] = pstats.Stats(profiler)
+
+
+def get_metrics() -> Snapshot:
+    """Return a copy of the counters and the totals of every stage."""
+    with _lock:
+        return {"counters": dict(_counters), **{f"stage:{name}": dict(totals) for name, totals in _stages.items()}}
+
+
+def merge_metrics(snapshot: Snapshot) -> None:
+    """Add the metrics collected somewhere else (for example, in another process) to the ones of this process."""
+    with _lock:
+        for name, value in snapshot.get("counters", {}).items():
+            _counters[name] = _counters.get(name, 0) + value
+        for key, totals in snapshot.items():
+            if key.startswith("stage:"):
+                current = _stages.setdefault(key[len("stage:"):], {"calls": 0, "seconds": 0.0})
+                current["calls"] += totals["calls"]
+                current["seconds"] += totals["seconds"]
+                if "peak_bytes" in totals:
+                    current["peak_bytes"] = max(current.get("peak_bytes", 0), totals["peak_bytes"])
+
+
+def format_metrics() -> str:
+    """Return the metrics in the Prometheus text format."""
+    snapshot = get_metrics()
+    lines: list[str] = []
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = f"{METRICS_PREFIX}_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value:g}"]
+    stages = sorted((key[len("stage:"):], totals) for key, totals in snapshot.items() if key.startswith("stage:"))
+    for field, kind in (("calls", "counter"), ("seconds", "counter"), ("peak_bytes", "gauge")):
+        metric = f"{METRICS_PREFIX}_stage_{field}" + ("_total" if kind == "counter" else "")
+        values = [f'{metric}{{stage="{name}"}} {totals[field]:g}' for name, totals in stages if field in totals]
+        if values:
+            lines += [f"# TYPE {metric} {kind}"] + values
+    return "\n".join(lines) + "\n"
+
+
+def format_metrics_log() -> str:
+    """Return the metrics as one JSON line, for structured logs."""
+    return json.dumps({"time": time.time(), **get_metrics()}, sort_keys=True)
+
+
+def save_metrics(filename: str) -> None:
+    """
+    Save the metrics to a file: as JSON lines appended to it if its name ends with .jsonl, otherwise in the Prometheus text
+    format. The cProfile statistics of every stage are saved next to it as <filename>.<stage>.prof.
+    """
+    if filename.endswith(".jsonl"):
+        with open(filename, "a") as file:
+            file.write(format_metrics_log() + "\n")
+    else:
+        with open(filename, "w") as file:
+            file.write(format_metrics())
+    with _lock:
+        for name, stats in _profiles.items():
+            stats.dump_stats(f"{filename}.{name}.prof")
@@ -1,9 +1,13 @@
-from dataclasses import dataclass
-from typing import TypeAlias
-from bs4 import BeautifulSoup
+from dataclasses import dataclass, field
+from typing import TypeAlias, Optional, Iterable
 from segments import Point, Box
+from metrics import stage, count
+from files import atomic_write
+from sklearn.neighbors import BallTree
+from math import cos, radians
 from re import findall
-import requests, os, time
+import numpy as np
+import requests, os, time, haversine, json
 
 
 @dataclass
@@ -13,43 +17,190 @@ class Monument:
 
 
 Monuments: TypeAlias = list[Monument]
+Array: TypeAlias = np.ndarray
 
 
-def download_monuments(filename: str) -> None:
+@dataclass
+class MonumentCatalog:
+    """
+    All the monuments of a file in columns, with a grid index: the monuments sorted by the key of their grid cell, so the
+    monuments of a row of cells are a contiguous slice of order.
+    """
+    names: Array
+    lats: Array
+    lons: Array
+    order: Array
+    keys: Array
+    tree: Optional[BallTree] = field(default=None, repr=False)
+
+
+@dataclass
+class MonumentChanges:
+    """How many monuments a refresh added, moved and removed, or if the page didn't change at all."""
+    added: int = 0
+    changed: int = 0
+    removed: int = 0
+    not_modified: bool = False
+
+
+MONUMENTS_URL = "https://www.catalunyamedieval.es/comarques/"
+
+# Start of the script of the page that contains the monuments
+MONUMENTS_KEYWORD = "var aCasaForta"
+
+# Size in degrees of the cells of the grid index of the catalogs
+CATALOG_CELL_SIZE = 0.1
+
+# Catalogs already loaded in this process, with the size and modification time of their file
+_catalogs: dict[str, tuple[int, float, MonumentCatalog]] = {}
+
+
+def download_monuments(filename: str, url: str = MONUMENTS_URL) -> None:
     """ Download monuments from Catalunya Medieval and it saves them to a file. """
-    url = "https://www.catalunyamedieval.es/comarques/"
-    content = fetch_page_content(url)
-    script_content = extract_script_tag(content, "var aCasaForta")    
+    with stage("fetch_monuments"):
+        script_content, validators = fetch_monuments_script(url, {})
     if script_content:
         save_monuments_to_file(parse_monument_data(script_content), filename)
+        save_validators(validators, filename)
+
+
+def refresh_monuments(filename: str, url: str = MONUMENTS_URL) -> MonumentChanges:
+    """
+    Update the monuments file with the current page. The page is only downloaded if it changed since the last download
+    (conditional request with its ETag and Last-Modified), and the file is only rewritten if some monument changed.
+    """
+    validators = load_validators(filename) if os.path.exists(filename) else {}
+    with stage("fetch_monuments"):
+        script_content, new_validators = fetch_monuments_script(url, validators)
+    if script_content is None:
+        count("monuments_not_modified")
+        return MonumentChanges(not_modified=True)
+    new_monuments = parse_monument_data(script_content)
+    if not new_monuments:
+        # Probably the page changed its format: keep the saved monuments
+        print(f"No monuments found in {url}. The monuments file has not been changed.")
+        return MonumentChanges()
+    old_monuments = read_all_monuments(filename) if os.path.exists(filename) else []
+    monuments, changes = merge_monuments(old_monuments, new_monuments)
+    count("monuments_added", changes.added)
+    count("monuments_changed", changes.changed)
+    count("monuments_removed", changes.removed)
+    if changes.added or changes.changed or changes.removed or not os.path.exists(filename):
+        save_monuments_to_file(monuments, filename)
+    save_validators(new_validators, filename)
+    return changes
 
 
-def fetch_page_content(url: str) -> bytes:
-    """ Fetch the content of a web page. """
+def fetch_monuments_script(url: str, validators: dict[str, str]) -> tuple[Optional[str], dict[str, str]]:
+    """
+    Fetch the script of the page with the monuments, reading the page as a stream and stopping at the end of the script.
+    If the validators of a previous download are given and the page didn't change, returns None and the same validators.
+    Connection errors and 5xx responses are retried; other HTTP errors are raised at once.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
     attempts = 0 
     delay, retries = 5, 10
     while attempts < retries:
         try:
-            response = requests.get(url, timeout=20)
-            return response.content
+            with requests.get(url, headers=headers, timeout=20, stream=True) as response:
+                if response.status_code == 304:
+                    return None, validators
+                response.raise_for_status()
+                script_content = extract_script_from_stream(response.iter_content(1 << 16), MONUMENTS_KEYWORD)
+                new_validators = {"etag": response.headers.get("ETag", ""), "last_modified": response.headers.get("Last-Modified", "")}
+                return script_content, new_validators
         except requests.RequestException as e: 
+            # Only connection errors and errors of the server can go away: a wrong URL or a refused request won't
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code < 500:
+                raise
             attempts += 1
             print(f"Attempt {attempts} failed with error: {e}. Retrying in {delay} seconds...")
             time.sleep(delay)
     raise requests.RequestException(f"Failed to fetch page content from {url} after {retries} attempts.")
 
 
-def extract_script_tag(content: bytes, keyword: str) -> str:
-    """Extract the script tag containing the specified keyword."""
-    soup = BeautifulSoup(content, "html.parser")
-    script_tags = soup.find_all("script")
-    
-    for script_tag in script_tags:
-        if keyword in script_tag.text:
-            return script_tag.text
+def extract_script_from_stream(chunks: Iterable[bytes], keyword: str) -> str:
+    """
+    Extract the content of the script tag containing the keyword from the chunks of an HTML page, without parsing the page.
+    Only the script being read is kept in memory, and no more chunks are read once it ends.
+    """
+    keyword_bytes = keyword.encode()
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            position = buffer.find(keyword_bytes)
+            if position < 0:
+                buffer = trim_buffer(buffer, len(keyword_bytes))
+                break
+            opening = buffer.rfind(b"<script", 0, position)
+            if opening < 0 or buffer.find(b"</script", opening, position) >= 0:
+                # The keyword is outside of any script
+                buffer = buffer[position + len(keyword_bytes):]
+                continue
+            closing = buffer.find(b"</script", position)
+            if closing < 0:
+                break
+            return buffer[buffer.index(b">", opening) + 1:closing].decode("utf-8", "replace")
     return ""
 
 
+def trim_buffer(buffer: bytes, keyword_length: int) -> bytes:
+    """Drop the start of the buffer that can't contain the script: keep the last open script tag, or the bytes that may start the keyword."""
+    opening = buffer.rfind(b"<script")
+    if opening >= 0 and buffer.find(b"</script", opening) < 0:
+        return buffer[opening:]
+    return buffer[-(keyword_length + len(b"<script")):]
+
+
+def merge_monuments(old_monuments: Monuments, new_monuments: Monuments) -> tuple[Monuments, MonumentChanges]:
+    """
+    Merge the downloaded monuments into the saved ones: the monuments that are still there keep their order (with their
+    new location) and the new ones go at the end. Monuments with the same name are matched in order of appearance.
+    """
+    new_by_key = dict(zip(monument_keys(new_monuments), new_monuments))
+    changes = MonumentChanges()
+    merged: Monuments = []
+    for key, monument in zip(monument_keys(old_monuments), old_monuments):
+        new_monument = new_by_key.pop(key, None)
+        if new_monument is None:
+            changes.removed += 1
+            continue
+        changes.changed += new_monument.location != monument.location
+        merged.append(new_monument)
+    changes.added = len(new_by_key)
+    return merged + list(new_by_key.values()), changes
+
+
+def monument_keys(monuments: Monuments) -> list[tuple[str, int]]:
+    """Return the name of each monument and how many monuments with the same name come before it."""
+    seen: dict[str, int] = {}
+    keys = []
+    for monument in monuments:
+        keys.append((monument.name, seen.get(monument.name, 0)))
+        seen[monument.name] = keys[-1][1] + 1
+    return keys
+
+
+def load_validators(filename: str) -> dict[str, str]:
+    """Load the ETag and Last-Modified of the page the monuments file was downloaded from (empty if unknown)."""
+    try:
+        with open(f"{filename}.http.json", "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validators(validators: dict[str, str], filename: str) -> None:
+    """Save the ETag and Last-Modified of the page the monuments file was downloaded from."""
+    with open(f"{filename}.http.json", "w") as file:
+        json.dump(validators, file)
+
+
 def parse_monument_data(script_content: str) -> Monuments:
     """ Parse monument data from the script content. """
     title_pattern = r'"title":"(.*?)"'
@@ -74,38 +225,154 @@ def decode_title(title: str) -> str:
 
 def save_monuments_to_file(monuments: Monuments, filename: str) -> None:
     """Save a list of monuments to a file."""
-    with open(filename, 'w') as f:
+    with atomic_write(filename) as f:
         for monument in monuments:
             f.write(f"{monument.name} - {monument.location.lat},{monument.location.lon}\n")
 
 
+def read_all_monuments(filename: str) -> Monuments:
+    """Read all the monuments of a file."""
+    catalog = load_catalog(filename)
+    return get_catalog_monuments(catalog, np.arange(len(catalog.names)))
+
+
 def load_monuments(box: Box, filename: str) -> Monuments:
     """Load monuments from a file and filter by location within the given box."""
-    monuments: Monuments = []
-    with open(filename, "r") as file:    
+    catalog = load_catalog(filename)
+    return get_catalog_monuments(catalog, monuments_in_box(catalog, box))
+
+
+def load_catalog(filename: str) -> MonumentCatalog:
+    """
+    Return the catalog of the monuments of a file. It is read once per process, and from a binary .npz file next to it
+    (written the first time) as long as the file doesn't change.
+    """
+    status = os.stat(filename)
+    cached = _catalogs.get(filename)
+    if cached is not None and cached[:2] == (status.st_size, status.st_mtime):
+        return cached[2]
+    array_filename = f"{os.path.splitext(filename)[0]}.npz"
+    catalog = load_catalog_arrays(array_filename, status.st_size, status.st_mtime)
+    if catalog is None:
+        with stage("read_monuments"):
+            catalog = read_catalog(filename)
+        save_catalog_arrays(catalog, array_filename, status.st_size, status.st_mtime)
+    _catalogs[filename] = status.st_size, status.st_mtime, catalog
+    return catalog
+
+
+def read_catalog(filename: str) -> MonumentCatalog:
+    """Read the monuments of a text file into a catalog. Lines with the wrong format are ignored."""
+    names: list[str] = []
+    coordinates: list[tuple[float, float]] = []
+    with open(filename, "r") as file:
         for line in file:
             try:
-                monument_name, lat, lon = get_data_from_file(line)                
-                if monument_in_box(box, lat, lon): 
-                    monuments.append(Monument(monument_name, Point(lat, lon)))
-            except ValueError as e:
+                monument_name, lat, lon = get_data_from_file(line)
+                names.append(monument_name)
+                coordinates.append((lat, lon))
+            except (ValueError, IndexError) as e:
                 print(f"Error processing line: {line.strip()} - {e}. This line will be ignored.")
-    return monuments
+    return make_catalog(names, np.array(coordinates, dtype=np.float64).reshape(-1, 2))
+
+
+def make_catalog(names: list[str], coordinates: Array) -> MonumentCatalog:
+    """Create the catalog of the monuments with the given names and (lat, lon) rows, building its grid index."""
+    lats, lons = np.ascontiguousarray(coordinates[:, 0]), np.ascontiguousarray(coordinates[:, 1])
+    cell_keys = grid_keys(grid_cells(lats), grid_cells(lons))
+    order = np.argsort(cell_keys, kind="stable")
+    return MonumentCatalog(np.array(names, dtype=str), lats, lons, order, cell_keys[order])
+
+
+def grid_cells(coordinates: Array) -> Array:
+    """Return the grid cell of each coordinate."""
+    return np.floor(np.asarray(coordinates) / CATALOG_CELL_SIZE).astype(np.int64)
+
+
+def grid_keys(rows: Array, cols: Array) -> Array:
+    """Return the key of each cell: cells of the same row are consecutive, in order of column."""
+    cols_per_row = int(round(360 / CATALOG_CELL_SIZE)) + 2
+    return (rows + cols_per_row) * cols_per_row + cols + cols_per_row // 2
+
+
+def save_catalog_arrays(catalog: MonumentCatalog, filename: str, size: int, mtime: float) -> None:
+    """Save the catalog to a .npz file, with the size and modification time of the text file it was read from."""
+    with atomic_write(filename, "wb") as file:
+        np.savez(file, names=catalog.names, lats=catalog.lats, lons=catalog.lons, order=catalog.order,
+                 keys=catalog.keys, source=np.array([size, mtime]))
+
+
+def load_catalog_arrays(filename: str, size: int, mtime: float) -> Optional[MonumentCatalog]:
+    """Load a catalog from a .npz file. Returns None if it doesn't exist or was saved from another version of the text file."""
+    try:
+        with np.load(filename) as data:
+            if data["source"].tolist() != [size, mtime]:
+                return None
+            return MonumentCatalog(data["names"], data["lats"], data["lons"], data["order"], data["keys"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_catalog_monuments(catalog: MonumentCatalog, indices: Array) -> Monuments:
+    """Return the monuments of the catalog at the given indices."""
+    return [Monument(name, Point(lat, lon)) for name, lat, lon in
+            zip(catalog.names[indices].tolist(), catalog.lats[indices].tolist(), catalog.lons[indices].tolist())]
+
+
+def monuments_in_box(catalog: MonumentCatalog, box: Box) -> Array:
+    """
+    Return the indices of the monuments inside the box, in the order of the file.
+    Only the monuments in the cells that intersect the box are checked: one slice of the index per row of cells.
+    """
+    first_row, last_row = grid_cells(np.array([box.bottom_left.lat, box.top_right.lat])).tolist()
+    first_col, last_col = grid_cells(np.array([box.bottom_left.lon, box.top_right.lon])).tolist()
+    if last_row < first_row or last_col < first_col:
+        return np.empty(0, dtype=np.int64)
+    rows = np.arange(first_row, last_row + 1)
+    starts = np.searchsorted(catalog.keys, grid_keys(rows, first_col), side="left")
+    ends = np.searchsorted(catalog.keys, grid_keys(rows, last_col), side="right")
+    candidates = np.concatenate([catalog.order[start:end] for start, end in zip(starts.tolist(), ends.tolist())] + [np.empty(0, dtype=np.int64)])
+    lats, lons = catalog.lats[candidates], catalog.lons[candidates]
+    inside = ((box.bottom_left.lat <= lats) & (lats <= box.top_right.lat) &
+              (box.bottom_left.lon <= lons) & (lons <= box.top_right.lon))
+    return np.sort(candidates[inside])
+
+
+def monuments_within(catalog: MonumentCatalog, point: Point, radius: float) -> Array:
+    """Return the indices of the monuments at most radius km away from the point, in the order of the file."""
+    lat_margin = radius / 111.19
+    lon_margin = min(180.0, radius / max(111.19 * cos(radians(min(abs(point.lat) + lat_margin, 90.0))), 1e-9))
+    box = Box(Point(point.lat - lat_margin, point.lon - lon_margin), Point(point.lat + lat_margin, point.lon + lon_margin))
+    candidates = monuments_in_box(catalog, box)
+    if len(candidates) == 0:
+        return candidates
+    return candidates[get_distances(catalog, point, candidates) <= radius]
+
+
+def nearest_monuments(catalog: MonumentCatalog, point: Point, k: int) -> tuple[Array, Array]:
+    """Return the indices of the k monuments closest to the point and their distances in km, from the closest."""
+    k = min(k, len(catalog.names))
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    if catalog.tree is None:
+        catalog.tree = BallTree(np.radians(np.column_stack((catalog.lats, catalog.lons))), metric='haversine')
+    indices = catalog.tree.query(np.radians([[point.lat, point.lon]]), k=k, return_distance=False)[0]
+    return indices, get_distances(catalog, point, indices)
+
+
+def get_distances(catalog: MonumentCatalog, point: Point, indices: Array) -> Array:
+    """Return the haversine distance in km from the point to the monuments at the given indices."""
+    coordinates = np.column_stack((catalog.lats[indices], catalog.lons[indices]))
+    return haversine.haversine_vector(np.array([[point.lat, point.lon]]), coordinates, comb=True).ravel()
 
 
 def get_data_from_file(line: str) -> tuple[str, float, float]:
-    """Extract the monument name and coordinates from a line in the file."""
-    name_and_coords = line.strip().split(" - ")
-    monument_name = name_and_coords[0]
-    lat, lon = map(float, name_and_coords[1].split(","))
+    """Extract the monument name and coordinates from a line in the file. The name may contain " - " too."""
+    monument_name, coordinates = line.strip().rsplit(" - ", 1)
+    lat, lon = map(float, coordinates.split(","))
     return monument_name, lat, lon
                  
 
-def monument_in_box(box: Box, lat: float, lon: float) -> bool:
-    """Check if the monument is inside the specified box."""
-    return box.bottom_left.lat <= lat <= box.top_right.lat and box.bottom_left.lon <= lon <= box.top_right.lon
-
-
 def get_monuments(box: Box, filename: str) -> Monuments:
     """
     Get all monuments in the box. If filename exists, load monuments from the file.
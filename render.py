@@ -0,0 +1,82 @@
+from PIL import Image, ImageDraw
+from typing import Optional, TypeAlias
+from tiles import make_static_map
+import numpy as np
+
+
+Array: TypeAlias = np.ndarray
+Polylines: TypeAlias = list[Array]
+
+TILE_SIZE = 256
+MAX_ZOOM = 17
+
+
+def render_map(width: int, height: int, lines: Polylines | Array, line_color: str, line_width: int,
+               markers: Optional[Array] = None, marker_color: str = "blue", marker_width: int = 0) -> Image.Image:
+    """
+    Render lines and circle markers over the map tiles, like StaticMap. The lines are a list of polylines (arrays of
+    (lon, lat) rows) or an (N, 2, 2) array of N two-point lines, and the markers are (lon, lat) rows. All the coordinates
+    are projected to pixels at once and every feature is drawn in a single pass, without one object per line.
+    """
+    points, offsets = flatten_lines(lines)
+    has_markers = markers is not None and len(markers) > 0
+    if has_markers:
+        points = np.concatenate((points, markers))
+    if len(points) == 0:
+        raise RuntimeError("cannot render empty map, add lines / markers first")
+    low, high = points.min(axis=0), points.max(axis=0)
+    zoom = calculate_zoom(low, high, width, height, marker_width if has_markers else 0)
+    center = [(low[0] + high[0]) / 2, (low[1] + high[1]) / 2]
+    image = make_static_map(width, height).render(zoom=zoom, center=center)
+    pixels = to_pixels(points, zoom, center, width, height).tolist()
+
+    # Features are drawn at twice the size and then scaled down, so they look antialiased (as StaticMap does)
+    features = Image.new("RGBA", (width * 2, height * 2), (255, 0, 0, 0))
+    draw = ImageDraw.Draw(features)
+    radius = line_width - 1
+    for x, y in pixels[:offsets[-1]]:
+        # A dot at every point makes the joints between lines look nice
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=line_color)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        draw.line(pixels[start:end], fill=line_color, width=line_width * 2)
+    for x, y in pixels[offsets[-1]:]:
+        draw.ellipse((x - marker_width, y - marker_width, x + marker_width, y + marker_width), fill=marker_color)
+    features = features.resize((width, height), Image.LANCZOS)
+    image.paste(features, (0, 0), features)
+    return image
+
+
+def flatten_lines(lines: Polylines | Array) -> tuple[Array, list[int]]:
+    """Return all the points of the lines in one array and the offset where each line starts (plus the total)."""
+    if isinstance(lines, np.ndarray):
+        return lines.reshape(-1, 2), list(range(0, 2 * len(lines) + 1, 2))
+    lengths = [len(polyline) for polyline in lines if len(polyline) > 0]
+    points = np.concatenate([polyline for polyline in lines if len(polyline) > 0]) if lengths else np.empty((0, 2))
+    return points, [0] + np.cumsum(lengths).tolist()
+
+
+def calculate_zoom(low: Array, high: Array, width: int, height: int, margin: int) -> int:
+    """Return the highest zoom level at which the extent (plus a margin in pixels at each side) fits in the image."""
+    for zoom in range(MAX_ZOOM, -1, -1):
+        extent_width = float(lon_to_x(high[0], zoom) - lon_to_x(low[0], zoom)) * TILE_SIZE + 2 * margin
+        extent_height = float(lat_to_y(low[1], zoom) - lat_to_y(high[1], zoom)) * TILE_SIZE + 2 * margin
+        if extent_width <= width and extent_height <= height:
+            return zoom
+    return 0
+
+
+def to_pixels(coordinates: Array, zoom: int, center: list[float], width: int, height: int) -> Array:
+    """Project (lon, lat) rows to pixel rows of the image drawn at twice the size, with the center in the middle."""
+    x = (lon_to_x(coordinates[:, 0], zoom) - lon_to_x(center[0], zoom)) * TILE_SIZE + width / 2
+    y = (lat_to_y(coordinates[:, 1], zoom) - lat_to_y(center[1], zoom)) * TILE_SIZE + height / 2
+    return np.rint(np.column_stack((x, y))) * 2
+
+
+def lon_to_x(lon: Array, zoom: int) -> Array:
+    """Convert longitudes to Web Mercator tile x coordinates."""
+    return (lon + 180) / 360 * 2 ** zoom
+
+
+def lat_to_y(lat: Array, zoom: int) -> Array:
+    """Convert latitudes to Web Mercator tile y coordinates."""
+    return (1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * 2 ** zoom
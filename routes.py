@@ -1,34 +1,223 @@
 import networkx as nx
+from dataclasses import dataclass
 from segments import Point
-from graphmaker import Graph
+from graphmaker import Graph, Array, is_same_graph
+from compactgraph import CompactGraph, as_networkx
 from monuments import Monuments
-from typing import Optional
+from typing import Optional, TypeAlias, TextIO
 from staticmap import StaticMap, CircleMarker, Line
+from tiles import make_static_map
+from metrics import stage, count
+from files import atomic_write
+from exports import ExportResult, submit_export, wait_for_exports
+from concurrent.futures import Future
+from viewer import graph_polylines
+from kmlwriter import kml_document, icon_style, line_style, write_point, write_lines
 from math import sin, cos, atan2, sqrt, radians
-import simplekml
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from sklearn.neighbors import BallTree
+import numpy as np
+import json, os
 
 
+ShortestPaths: TypeAlias = tuple[dict[int, float], dict[int, list[int]]]
 
-def find_routes(graph: Graph, start_point: Point, monuments: Monuments, filename: str) -> int:
-    """Generate routes and save visualizations. Returns 1 if it has found monuments in the selected box, else -1."""
-    start_node = find_closest_node(graph, start_point)
-    shortest_paths = nx.single_source_dijkstra(graph, source=start_node, weight='weight')
-    monuments_nodes = get_monuments_nodes(graph, monuments)
+# Radius of the Earth in kilometers
+EARTH_RADIUS = 6371.0
+
+# Queries from which the route trees pay off: computing them costs about as much as 35 runs of the csr backend
+# (python benchmark.py route_trees 100000 50 100)
+ROUTE_TREES_MIN_QUERIES = 35
+
+# Largest number of monuments × nodes of the route trees: 12 bytes each (distance and predecessor), about 240 MB
+ROUTE_TREES_MAX_CELLS = 20_000_000
+
+# File of the route trees in the directory of a graph saved by graphmaker.get_graph
+ROUTE_TREES_FILENAME = "route_trees.npz"
+
+
+@dataclass
+class RouteTrees:
+    """Shortest path trees rooted at some nodes: the distance and predecessor of every CSR row in each tree."""
+    roots: list[int]
+    distances: Array
+    predecessors: Array
+
+
+def find_routes(graph: Graph | CompactGraph, start_point: Point, monuments: Monuments, filename: str, backend: str = "csr",
+                max_distance: Optional[float] = None, exports: Optional[list[Future[ExportResult]]] = None) -> int:
+    """
+    Generate routes and save visualizations. Returns 1 if it has found monuments in the selected box, else -1.
+    Monuments farther than max_distance km from every node of the graph are ignored.
+    The .png and .kml files are written at the same time in the background (see exports.submit_export). If a list of
+    exports is given, their futures are appended to it and the function returns without waiting for them.
+    """
+    with stage("find_routes"):
+        start_node = find_closest_node(graph, start_point)
+        monuments_nodes = get_monuments_nodes(graph, monuments, max_distance)
+        shortest_paths = find_shortest_paths(graph, start_node, monuments_nodes, backend)
     
     if contains_node(monuments_nodes, shortest_paths):
         route_graph = build_route_graph(graph, monuments_nodes, shortest_paths)
-        save_static_map(route_graph, start_node, monuments_nodes, f'{filename}.png')
-        save_kml(route_graph, start_node, monuments_nodes,  f'{filename}.kml')
+        futures = [submit_export(save_static_map, f'{filename}.png', route_graph, start_node, monuments_nodes),
+                   submit_export(save_kml, f'{filename}.kml', route_graph, start_node, monuments_nodes)]
+        if exports is None:
+            wait_for_exports(futures)
+        else:
+            exports.extend(futures)
         return 1
     else:
         print('No monuments found in the selected box.')
         return -1
     
     
+def find_shortest_paths(graph: Graph | CompactGraph, source: int, targets: set[int], backend: str = "csr") -> ShortestPaths:
+    """
+    Find the shortest paths (by edge weight) from the source, like nx.single_source_dijkstra.
+    With the "networkx" backend the distances and paths of all the nodes are returned. With the "csr" backend Dijkstra runs
+    on the compressed sparse row arrays of the graph and only the reachable targets are returned. The "trees" backend reads the paths
+    from the shortest path trees of the targets (see prepare_route_trees), so repeated queries don't run Dijkstra.
+    """
+    if backend == "networkx":
+        return nx.single_source_dijkstra(as_networkx(graph), source=source, weight='weight')
+    if backend == "trees":
+        return query_route_trees(graph, prepare_route_trees(graph, targets), source, targets)
+    if backend != "csr":
+        raise ValueError(f"Unknown routing backend: {backend}. Use 'csr', 'trees' or 'networkx'.")
+    csr, nodes, index = get_csr(graph)
+    target_indices = [index[target] for target in targets if target in index]
+    distances, predecessors = dijkstra(csr, indices=index[source], return_predecessors=True)
+    # Dijkstra runs until the whole component of the source is settled
+    count("dijkstra_nodes_settled", int(np.count_nonzero(np.isfinite(distances))))
+    return get_paths_to_targets(distances, predecessors, nodes, target_indices)
+
+
+def get_csr(graph: Graph | CompactGraph) -> tuple[csr_matrix, list[int], dict[int, int]]:
+    """
+    Return the weighted adjacency matrix of the graph in CSR format, the node of each row and the row of each node,
+    cached in the graph attributes. A CompactGraph already has it: its arrays are used without copying them.
+    """
+    if 'csr' not in graph.graph and isinstance(graph, CompactGraph):
+        graph.graph['csr'] = graph.csr(), graph.nodes.tolist(), graph.index
+    elif 'csr' not in graph.graph:
+        nodes = list(graph.nodes())
+        csr = nx.to_scipy_sparse_array(graph, nodelist=nodes, weight='weight', format='csr')
+        graph.graph['csr'] = csr_matrix(csr), nodes, {node: i for i, node in enumerate(nodes)}
+    return graph.graph['csr']
+
+
+def choose_backend(graph: Graph | CompactGraph, num_queries: int, monuments: Monuments) -> str:
+    """
+    Return the routing backend for num_queries routes to the monuments on the graph: the route trees if they are already
+    computed or saved with the graph for all the monuments (then they are loaded), or if there are enough queries to pay
+    for them (see ROUTE_TREES_MIN_QUERIES), else csr.
+    The trees take O(monuments × nodes) memory, as a saved file is loaded whole, so they are only used up to
+    ROUTE_TREES_MAX_CELLS.
+    """
+    if len(monuments) * graph.number_of_nodes() > ROUTE_TREES_MAX_CELLS:
+        return "csr"
+    if num_queries >= ROUTE_TREES_MIN_QUERIES or 'route_trees' in graph.graph:
+        return "trees"
+    filename = get_route_trees_filename(graph)
+    trees = load_route_trees(filename, graph.graph['key'], sorted(get_monuments_nodes(graph, monuments))) if filename else None
+    if trees is None:
+        return "csr"
+    graph.graph['route_trees'] = trees
+    return "trees"
+
+
+def prepare_route_trees(graph: Graph | CompactGraph, monument_nodes: set[int]) -> RouteTrees:
+    """
+    Return the shortest path trees rooted at the monument nodes, cached in the graph attributes.
+    If the graph was saved by graphmaker.get_graph, the trees are also saved in its directory and loaded from there
+    when they were computed for the same graph (the same key) and for all the monuments.
+    As the graph is undirected, the tree of a monument gives the shortest path from any start node to that monument.
+    """
+    trees: Optional[RouteTrees] = graph.graph.get('route_trees')
+    if trees is not None and monument_nodes <= set(trees.roots):
+        return trees
+    csr, nodes, index = get_csr(graph)
+    roots = sorted(node for node in monument_nodes if node in index)
+    filename = get_route_trees_filename(graph)
+    trees = load_route_trees(filename, graph.graph['key'], roots) if filename else None
+    if trees is None:
+        distances, predecessors = np.empty((0, len(nodes))), np.empty((0, len(nodes)), dtype=np.int32)
+        if roots:
+            distances, predecessors = dijkstra(csr, indices=[index[root] for root in roots], return_predecessors=True)
+            count("dijkstra_nodes_settled", int(np.count_nonzero(np.isfinite(distances))))
+        trees = RouteTrees(roots, distances.reshape(len(roots), len(nodes)), predecessors.reshape(len(roots), len(nodes)))
+        if filename:
+            save_route_trees(trees, graph.graph['key'], filename)
+    graph.graph['route_trees'] = trees
+    return trees
+
+
+def get_route_trees_filename(graph: Graph | CompactGraph) -> Optional[str]:
+    """Return the file of the route trees of a graph saved by graphmaker.get_graph, or None if it wasn't saved."""
+    directory = graph.graph.get('directory')
+    return os.path.join(directory, ROUTE_TREES_FILENAME) if directory else None
+
+
+def save_route_trees(trees: RouteTrees, key: dict, filename: str) -> None:
+    """Save the shortest path trees and the key of the graph they were computed on to a .npz file."""
+    with atomic_write(filename, "wb") as file:
+        np.savez(file, roots=np.array(trees.roots, dtype=np.int64), key=json.dumps(key),
+                 distances=trees.distances, predecessors=trees.predecessors)
+
+
+def load_route_trees(filename: str, key: dict, roots: list[int]) -> Optional[RouteTrees]:
+    """
+    Load the shortest path trees from a .npz file. Returns None if there is no file or the trees were computed for another
+    graph (see graphmaker.is_same_graph) or without some of the roots.
+    """
+    try:
+        with np.load(filename) as data:
+            if not is_same_graph(json.loads(str(data['key'])), key) or not set(roots) <= set(data['roots'].tolist()):
+                return None
+            return RouteTrees(data['roots'].tolist(), data['distances'], data['predecessors'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def query_route_trees(graph: Graph | CompactGraph, trees: RouteTrees, source: int, targets: set[int]) -> ShortestPaths:
+    """Read the distances and paths from the source to the reachable targets from their shortest path trees."""
+    _, nodes, index = get_csr(graph)
+    rows = {root: row for row, root in enumerate(trees.roots)}
+    distances: dict[int, float] = {}
+    paths: dict[int, list[int]] = {}
+    for target in targets:
+        row = rows.get(target)
+        if row is None or np.isinf(trees.distances[row, index[source]]):
+            continue
+        # A memoryview gives plain ints, much faster to follow than NumPy scalars
+        predecessors = memoryview(np.ascontiguousarray(trees.predecessors[row]))
+        path = [index[source]]
+        while predecessors[path[-1]] >= 0:
+            path.append(predecessors[path[-1]])
+        distances[target] = float(trees.distances[row, index[source]])
+        paths[target] = [nodes[i] for i in path]
+    return distances, paths
+
+
+def get_paths_to_targets(distances: Array, predecessors: Array, nodes: list[int], targets: list[int]) -> ShortestPaths:
+    """Build the distances and paths (as node lists) of the reachable targets from the result of Dijkstra."""
+    target_distances: dict[int, float] = {}
+    paths: dict[int, list[int]] = {}
+    for target in targets:
+        if np.isinf(distances[target]):
+            continue
+        path = [target]
+        while predecessors[path[-1]] >= 0:
+            path.append(int(predecessors[path[-1]]))
+        target_distances[nodes[target]] = float(distances[target])
+        paths[nodes[target]] = [nodes[i] for i in reversed(path)]
+    return target_distances, paths
+
+
 def haversine_distance(point1: Point, point2: Point) -> float:
     """Calculate the Haversine distance between two points."""
-    # Radius of the Earth in kilometers
-    R = 6371.0
+    R = EARTH_RADIUS
     lat1, lon1, lat2, lon2 = convert_to_radians(point1, point2)
     dlat = lat2 - lat1
     dlon = lon2 - lon1
@@ -45,71 +234,114 @@ def convert_to_radians(point1: Point, point2: Point)->tuple[float,float,float,fl
     return radians(point1.lat), radians(point1.lon), radians(point2.lat), radians(point2.lon)
 
 
-def find_closest_node(graph: Graph, point: Point) -> int:
+def find_closest_node(graph: Graph | CompactGraph, point: Point) -> int:
     """Find the closest node in the graph to a given point. Returns -1 if there isn't any Node close."""
-    closest_node = -1
-    min_distance = float('inf')
-    for node, data in graph.nodes(data=True):
-        lat, lon = data['pos'][1], data['pos'][0]
-        distance = haversine_distance(point, Point(lat, lon))
-        if distance < min_distance:
-            min_distance = distance
-            closest_node = node
-    return closest_node
+    return find_closest_nodes(graph, [point])[0]
+
 
+def find_closest_nodes(graph: Graph | CompactGraph, points: list[Point], max_distance: Optional[float] = None) -> list[int]:
+    """
+    Find the closest node in the graph to each point with a single query to the spatial index of the graph.
+    A point gets -1 if the graph is empty or its closest node is farther than max_distance km.
+    """
+    if len(graph) == 0 or not points:
+        return [-1] * len(points)
+    tree, nodes = get_spatial_index(graph)
+    coordinates = np.radians([[point.lat, point.lon] for point in points])
+    distances, indices = tree.query(coordinates, k=1)
+    closest_nodes = [nodes[i] for i in indices[:, 0].tolist()]
+    if max_distance is not None:
+        closest_nodes = [node if distance * EARTH_RADIUS <= max_distance else -1
+                         for node, distance in zip(closest_nodes, distances[:, 0].tolist())]
+    return closest_nodes
 
-def get_monuments_nodes(G: Graph, monuments: Monuments) -> set[int]:
-    """Get the set of nodes corresponding to the monuments."""
-    return {find_closest_node(G, monument.location) for monument in monuments}
 
+def get_spatial_index(graph: Graph | CompactGraph) -> tuple[BallTree, list[int]]:
+    """Return a haversine BallTree of the node positions and the node of each row, cached in the graph attributes."""
+    if 'spatial_index' not in graph.graph:
+        if isinstance(graph, CompactGraph):
+            nodes, positions = graph.nodes.tolist(), graph.positions
+        else:
+            nodes = list(graph.nodes())
+            positions = np.array([graph.nodes[node]['pos'] for node in nodes], dtype=np.float64).reshape(-1, 2)
+        # Positions are (lon, lat) and the tree expects (lat, lon)
+        coordinates = np.radians(positions[:, ::-1])
+        graph.graph['spatial_index'] = BallTree(coordinates, metric='haversine'), nodes
+    return graph.graph['spatial_index']
 
-def map_monuments_to_nodes(graph: Graph, monuments: Monuments) -> dict[str, int]:
+
+def get_monuments_nodes(G: Graph | CompactGraph, monuments: Monuments, max_distance: Optional[float] = None) -> set[int]:
+    """Get the set of nodes corresponding to the monuments, ignoring monuments farther than max_distance km from the graph."""
+    nodes = find_closest_nodes(G, [monument.location for monument in monuments], max_distance)
+    return {node for node in nodes if node != -1}
+
+
+def map_monuments_to_nodes(graph: Graph | CompactGraph, monuments: Monuments) -> dict[str, int]:
     """Map each monument to the closest node in the graph."""
-    return {monument.name: find_closest_node(graph, monument.location) for monument in monuments}
+    nodes = find_closest_nodes(graph, [monument.location for monument in monuments])
+    return {monument.name: node for monument, node in zip(monuments, nodes)}
       
 
-def contains_node(monument_nodes: set, shortest_paths) -> bool:
-    """Returns if it contains nodes"""
-    return any(monument_node in path for path in shortest_paths[1].values() for monument_node in monument_nodes)
+def contains_node(monument_nodes: set, shortest_paths: ShortestPaths) -> bool:
+    """Returns if any monument node is reachable, that is, if it has a shortest path"""
+    return any(monument_node in shortest_paths[1] for monument_node in monument_nodes)
 
 
-def get_node_position(G: Graph, node: int) -> Optional[tuple[float, float]]:
+def get_node_position(G: Graph | CompactGraph, node: int) -> Optional[tuple[float, float]]:
     """Get the position of a node in the graph."""
+    if isinstance(G, CompactGraph):
+        return tuple(G.position(node).tolist()) if node in G else None
     return G.nodes[node]['pos'] if node in G.nodes else None
 
 
-def build_route_graph(G: Graph, monument_nodes: set, shortest_paths) -> Graph:
-    """Build a graph containing only the nodes and edges of the shortest paths to monuments."""
+def build_route_graph(G: Graph | CompactGraph, monument_nodes: set, shortest_paths: ShortestPaths) -> Graph:
+    """
+    Build a graph containing only the nodes and edges of the shortest paths to monuments.
+    The paths form a tree, so each path is followed backwards only until it reaches a node already in the graph.
+    """
     route_graph = nx.Graph()
-    for monument_node in list(monument_nodes):
-            for path in list(shortest_paths[1].values()):
-                if monument_node in path:
-                    path = list(shortest_paths[1][monument_node])
-                    add_nodes_and_edges(G, route_graph, path)
+    for monument_node in monument_nodes:
+        path = shortest_paths[1].get(monument_node)
+        if path:
+            add_nodes_and_edges(G, route_graph, path)
     return route_graph
 
 
-def add_nodes_and_edges(G: Graph, route_graph: Graph, path)-> None:
-    """Add nodes and edges to the route graph."""
-    for i in range(len(path) - 1):
-        u, v = path[i], path[i + 1]
-        pos_u, pos_v = get_node_position(G,u), get_node_position(G,v)
-        if pos_u and pos_v:
-            lat1, lon1 = pos_u
-            lat2, lon2 = pos_v
-            weight = haversine_distance(Point(lat1, lon1), Point(lat2, lon2))
-            route_graph.add_edge(u, v, weight=weight)
-            route_graph.add_node(u, pos=(lat1,lon1))
-            route_graph.add_node(v, pos=(lat2,lon2))
+def add_nodes_and_edges(G: Graph | CompactGraph, route_graph: Graph, path: list[int]) -> None:
+    """Add the nodes and edges of a path to the route graph, from its end until a node already in the route graph."""
+    if path[-1] in route_graph:
+        return
+    route_graph.add_node(path[-1], pos=tuple(get_node_position(G, path[-1])))
+    for i in range(len(path) - 1, 0, -1):
+        u, v = path[i - 1], path[i]
+        reached = u in route_graph
+        if not reached:
+            route_graph.add_node(u, pos=tuple(get_node_position(G, u)))
+        route_graph.add_edge(u, v, weight=get_edge_weight(G, u, v))
+        if reached:
+            return
+
+
+def get_edge_weight(G: Graph | CompactGraph, u: int, v: int) -> float:
+    """Get the weight of an edge of the graph, or its Haversine length if it has no weight."""
+    if isinstance(G, CompactGraph):
+        return G.weight(u, v)
+    weight = G.edges[u, v].get('weight')
+    if weight is None:
+        lat1, lon1 = G.nodes[u]['pos']
+        lat2, lon2 = G.nodes[v]['pos']
+        weight = haversine_distance(Point(lat1, lon1), Point(lat2, lon2))
+    return weight
         
 
 def save_static_map(G: Graph, start_node: int, monument_nodes: set[int], filename: str) -> None:
     """Generate and save a static map image."""
-    static_map = StaticMap(800, 800)
-    add_nodes_to_static_map(G, static_map, start_node, monument_nodes)
-    add_edges_to_static_map(G, static_map)    
-    image = static_map.render()
-    image.save(filename)
+    with stage("export_routes_png"):
+        static_map = make_static_map(800, 800)
+        add_nodes_to_static_map(G, static_map, start_node, monument_nodes)
+        add_edges_to_static_map(G, static_map)    
+        image = static_map.render()
+        image.save(filename)
 
 
 def add_nodes_to_static_map(graph: Graph, static_map: StaticMap, start_node: int, monument_nodes: set[int]) -> None:
@@ -130,27 +362,24 @@ def add_edges_to_static_map(graph: Graph, static_map: StaticMap) -> None:
 
 
 def save_kml(graph: Graph, start_node: int, monument_nodes: set[int], filename: str) -> None:
-    """Generate and save a KML file for visualization in Google Earth."""
-    kml = simplekml.Kml()
-    add_nodes_to_kml(graph, kml, start_node, monument_nodes)
-    add_edges_to_kml(graph, kml)
-    kml.save(filename)
+    """
+    Generate and save a KML file (or KMZ if filename ends with .kmz) for visualization in Google Earth.
+    Nodes share one style per kind (start, monument or other) and the edges are merged into chains in a single placemark.
+    """
+    styles = {"start": icon_style('ff00ff00', 1), "monument": icon_style('ff0000ff', 1),
+              "node": icon_style('ffff0000', 1), "route": line_style('ff000000', 2)}
+    with stage("export_routes_kml"), kml_document(filename, "Routes", styles) as file:
+        add_nodes_to_kml(graph, file, start_node, monument_nodes)
+        add_edges_to_kml(graph, file)
 
 
-def add_nodes_to_kml(graph: Graph, kml: simplekml.Kml, start_node: int, monument_nodes: set[int]) -> None:
-    """Add the nodes of a graph to a KML as Placemarks."""
+def add_nodes_to_kml(graph: Graph, file: TextIO, start_node: int, monument_nodes: set[int]) -> None:
+    """Write the nodes of a graph to a KML as Placemarks."""
     for node, data in graph.nodes(data=True):
-        pos = data['pos']
-        color = 'ff00ff00' if node == start_node else 'ff0000ff' if node in monument_nodes else 'ffff0000'
-        point = kml.newpoint(name=str(node), coords=[(pos[0], pos[1])])
-        point.style.iconstyle.color = color
-        point.style.iconstyle.scale = 1
+        style = 'start' if node == start_node else 'monument' if node in monument_nodes else 'node'
+        write_point(file, str(node), float(data['pos'][0]), float(data['pos'][1]), style)
 
 
-def add_edges_to_kml(graph: Graph, kml: simplekml.Kml) -> None:
-    """Add the edges of a graph to a KML as LineStrings."""
-    for u, v in graph.edges():
-        pos_u, pos_v = graph.nodes[u]['pos'], graph.nodes[v]['pos']
-        line = kml.newlinestring(name=f"{u}-{v}", coords=[(pos_u[0], pos_u[1]), (pos_v[0], pos_v[1])])
-        line.style.linestyle.color = 'ff000000'  # Black
-        line.style.linestyle.width = 2
\ No newline at end of file
+def add_edges_to_kml(graph: Graph, file: TextIO) -> None:
+    """Write the edges of a graph to a KML as the LineStrings of a single Placemark."""
+    write_lines(file, "routes", graph_polylines(graph), "route")
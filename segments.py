@@ -1,8 +1,18 @@
-from typing import TypeAlias
+from typing import TypeAlias, Optional, Iterable, Iterator
 from dataclasses import dataclass
-from staticmap import StaticMap, Line
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from staticmap import Line
+from tiles import make_static_map
+from render import render_map
+from metrics import stage, count
+from files import atomic_write
 from datetime import datetime
-import requests, haversine, os, gpxpy.gpx
+from math import floor, ceil, cos, radians
+from itertools import chain, islice
+from xml.etree import ElementTree
+import requests, requests.adapters, haversine, os, json, time, contextlib, gpxpy.gpx, gpxpy.gpxfield
+import numpy as np
 
 
 @dataclass
@@ -24,52 +34,241 @@ class Box:
 
 
 Segments: TypeAlias = list[Segment]
+SegmentArray: TypeAlias = np.ndarray
+Array: TypeAlias = np.ndarray
 point: TypeAlias = gpxpy.gpx.GPXTrackPoint
+Tile: TypeAlias = tuple[int, int]
+TileIndex: TypeAlias = dict[str, dict[str, float]]
 
+TRACKPOINTS_URL = "https://api.openstreetmap.org/api/0.6/trackpoints"
 
-def download_segments(box: Box, filename: str) -> None:
-    """Download all segments in the box and save them to the file."""
-    page = 0
-    tries = 0
-    limit_tries = 5
+# A pair of points is valid if both are from LIMIT_YEAR or later and they are at most MAX_DISTANCE km apart
+LIMIT_YEAR = 2015
+MAX_DISTANCE = 0.1
+
+# Segments are downloaded and cached in square tiles of TILE_SIZE degrees
+TILE_SIZE = 0.05
+TILE_CACHE_DIR = "segment_tiles"
+TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+TILE_MAX_AGE = 30 * 24 * 3600
+# Pages of trackpoints downloaded at the same time, for all the missing tiles together
+TILE_DOWNLOAD_WORKERS = 4
+# Tiles of older versions are downloaded again (version 2 downloads a margin around the tile)
+TILE_FORMAT_VERSION = 2
+KM_PER_DEGREE = 111.19
+
+# Segments read at a time from the segment files (see iter_segment_chunks)
+SEGMENT_CHUNK_SIZE = 1_000_000
+
+
+def download_segments(box: Box, filename: str, workers: int = 4, base_url: str = TRACKPOINTS_URL,
+                      session: Optional[requests.Session] = None, executor: Optional[ThreadPoolExecutor] = None) -> bool:
+    """
+    Download all segments in the box and save them to the file. Returns False if a page could not be downloaded.
+    The first page is fetched alone, so an empty box costs a single request. After it, up to `workers` pages are fetched
+    at the same time, but they are written in order. The session and the executor of the pages can be shared with other
+    downloads (see get_tiles).
+    A checkpoint is saved before the first page and after every written page, so an interrupted download resumes from
+    the last finished page. The checkpoint is removed only when the download is complete.
+    """
     bbox = f"{box.bottom_left.lon},{box.bottom_left.lat},{box.top_right.lon},{box.top_right.lat}"
-    with open(filename, "w") as f:
-        while tries < limit_tries:
+    page, offset = read_checkpoint(filename)
+    # The output was removed or cut after the checkpoint was written, so the pages it recorded are lost
+    if page > 0 and (not os.path.exists(filename) or os.path.getsize(filename) < offset):
+        page, offset = 0, 0
+    # The checkpoint exists until the download finishes, so a download that fails on its first page is not complete
+    write_checkpoint(filename, page, offset)
+    session = session or make_session(workers)
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        f = stack.enter_context(open(filename, "r+" if page > 0 else "w"))
+        f.seek(offset)
+        f.truncate()
+        pending = deque([executor.submit(download_page, session, base_url, bbox, page)])
+        next_page = page + 1
+        while pending:
             try:
-                url = f"https://api.openstreetmap.org/api/0.6/trackpoints?bbox={bbox}&page={page}"
-                gpx_content = fetch_gpx_content(url)
-                gpx = gpxpy.parse(gpx_content)
-
-                # Break the loop if there are no more tracks to process                            
-                if len(gpx.tracks) == 0:
-                    break
-
-                for track in gpx.tracks:
-                    for segment in track.segments:
-                        if all(point.time is not None for point in segment.points):
-                            segment.points.sort(key=lambda p: p.time)  # type: ignore
-                            for i in range(len(segment.points) - 1):
-                                p1, p2 = segment.points[i], segment.points[i + 1]
-                                if is_valid(p1, p2):
-                                    f.write(f"{p1.latitude},{p1.longitude},{p2.latitude},{p2.longitude}\n")
-                page += 1
-                tries = 0
-            except Exception as e:
-                print(f"An error occurred while processing the GPX data: {e}")
-                tries += 1
-        if tries == limit_tries:
-            print("You have exceeded the limit of tries to download the GPX content. Check if there are any problems with the server or your connection.")
-            
+                content = pending.popleft().result()
+            except Exception:
+                print("You have exceeded the limit of tries to download the GPX content. Check if there are any problems with the server or your connection.")
+                cancel_pages(pending)
+                return False
+
+            # Stop when a page has no more tracks to process
+            if content is None:
+                cancel_pages(pending)
+                break
+
+            f.write(content)
+            f.flush()
+            page += 1
+            write_checkpoint(filename, page, f.tell())
+            while len(pending) < workers:
+                pending.append(executor.submit(download_page, session, base_url, bbox, next_page))
+                next_page += 1
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(checkpoint_filename(filename))
+    return True
+
+
+def make_session(workers: int) -> requests.Session:
+    """Create a session whose connection pool keeps one keep-alive connection per worker."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def download_page(session: requests.Session, base_url: str, bbox: str, page: int) -> Optional[str]:
+    """
+    Download one page of trackpoints and return its valid segments as lines of text.
+    The page is parsed while it is being received. Returns None if the page has no tracks. Raises the last error if every try fails.
+    """
+    limit_tries = 5
+    url = f"{base_url}?bbox={bbox}&page={page}"
+    for tries in range(1, limit_tries + 1):
+        try:
+            with session.get(url, stream=True) as response:
+                response.raise_for_status()
+                count("pages_fetched")
+                return get_stream_lines(counted_chunks(response.iter_content(chunk_size=64 * 1024), "bytes_fetched"))
+        except Exception as e:
+            print(f"An error occurred while processing the GPX data of page {page}: {e}")
+            if tries == limit_tries:
+                raise
+    return None
+
+
+def counted_chunks(chunks: Iterable[bytes], counter: str) -> Iterator[bytes]:
+    """Yield the chunks, adding their size to a counter."""
+    for chunk in chunks:
+        count(counter, len(chunk))
+        yield chunk
+
+
+def get_stream_lines(chunks: Iterable[bytes]) -> Optional[str]:
+    """
+    Return the valid segments of a GPX document received in chunks, one segment per line, or None if it has no tracks.
+    Each track segment is processed and discarded as soon as it ends, so the whole document is never kept in memory.
+    """
+    lines: list[str] = []
+    has_tracks = False
+    for tag, element in iter_gpx_elements(chunks, {"trk", "trkseg"}):
+        if tag == "trk":
+            has_tracks = True
+        else:
+            lines.extend(get_track_segment_lines(element))
+    return "".join(lines) if has_tracks else None
+
+
+def iter_gpx_elements(chunks: Iterable[bytes], tags: set[str]) -> Iterator[tuple[str, ElementTree.Element]]:
+    """Yield the (tag without namespace, element) of the elements with the given tags as soon as they end."""
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root: Optional[ElementTree.Element] = None
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            tag = element.tag.rpartition("}")[2]
+            if event == "end" and tag in tags:
+                yield tag, element
+                element.clear()
+                if tag == "trk":
+                    root.clear()
 
-def fetch_gpx_content(url: str) -> str:        
-    """Fetch GPX content from the given URL."""   
-    response = requests.get(url)
-    return response.content.decode("utf-8")
 
+def get_track_segment_lines(element: ElementTree.Element) -> list[str]:
+    """Return the lines of the valid pairs of a <trkseg> element, or none if any point has no time (as gpxpy would)."""
+    lats: list[float] = []
+    lons: list[float] = []
+    times: list[Optional[datetime]] = []
+    for trackpoint in element:
+        if trackpoint.tag.rpartition("}")[2] != "trkpt":
+            continue
+        lats.append(float(trackpoint.get("lat", "").strip()))
+        lons.append(float(trackpoint.get("lon", "").strip()))
+        time_text = next((child.text for child in trackpoint if child.tag.rpartition("}")[2] == "time"), None)
+        times.append(gpxpy.gpxfield.TIME_TYPE.from_string(time_text))  # type: ignore
+    if any(time is None for time in times):
+        return []
+    order = sorted(range(len(times)), key=times.__getitem__)
+    return get_valid_lines([lats[i] for i in order], [lons[i] for i in order], [times[i].year for i in order])  # type: ignore
+
+
+def get_page_lines(gpx: gpxpy.gpx.GPX) -> str:
+    """Return the valid segments of a GPX page parsed with gpxpy, one segment per line."""
+    lines: list[str] = []
+    for track in gpx.tracks:
+        for segment in track.segments:
+            if all(point.time is not None for point in segment.points):
+                segment.points.sort(key=lambda p: p.time)  # type: ignore
+                points = segment.points
+                lines.extend(get_valid_lines([p.latitude for p in points], [p.longitude for p in points],
+                                             [p.time.year for p in points]))  # type: ignore
+    return "".join(lines)
+
+
+def get_valid_lines(lats: list[float], lons: list[float], years: list[int]) -> list[str]:
+    """Return the lines of the valid pairs of consecutive points, validating all the pairs at once."""
+    if len(lats) < 2:
+        return []
+    valid = valid_pairs(np.array(lats), np.array(lons), np.array(years))
+    kept = int(np.count_nonzero(valid))
+    count("segments_kept", kept)
+    count("segments_rejected", len(valid) - kept)
+    return [f"{lats[i]},{lons[i]},{lats[i + 1]},{lons[i + 1]}\n" for i in np.flatnonzero(valid).tolist()]
+
+
+def valid_pairs(lats: Array, lons: Array, years: Array) -> Array:
+    """
+    Check which pairs of consecutive points are valid with the same criteria as is_valid.
+    Distances that are too close to the limit are computed again with the scalar haversine, so both give the same result.
+    """
+    coordinates = np.column_stack((lats, lons))
+    distances = haversine.haversine_vector(coordinates[:-1], coordinates[1:])
+    recent = years >= LIMIT_YEAR
+    valid = recent[:-1] & recent[1:] & (distances <= MAX_DISTANCE)
+    for i in np.flatnonzero(np.abs(distances - MAX_DISTANCE) < 1e-9).tolist():
+        distance = haversine.haversine(tuple(coordinates[i]), tuple(coordinates[i + 1]))
+        valid[i] = recent[i] and recent[i + 1] and distance <= MAX_DISTANCE
+    return valid
+
+
+def cancel_pages(pending: deque[Future]) -> None:
+    """Cancel the pages that are still waiting to be downloaded."""
+    for future in pending:
+        future.cancel()
+
+
+def checkpoint_filename(filename: str) -> str:
+    """Return the name of the checkpoint file of a download."""
+    return f"{filename}.checkpoint"
+
+
+def read_checkpoint(filename: str) -> tuple[int, int]:
+    """Return the next page to download and the size of the output written so far (0, 0 if there is no checkpoint)."""
+    try:
+        with open(checkpoint_filename(filename), "r") as file:
+            page, offset = map(int, file.read().strip().split(","))
+            return page, offset
+    except (OSError, ValueError):
+        return 0, 0
+
+
+def write_checkpoint(filename: str, page: int, offset: int) -> None:
+    """Atomically save the next page to download and the size of the output written so far."""
+    with atomic_write(checkpoint_filename(filename)) as file:
+        file.write(f"{page},{offset}\n")
+            
 
 def is_valid(p1: point, p2: point) -> bool:
     """Check if the data between two points is valid according to the specified criteria."""
-    LIMIT_YEAR = 2015
     t_point1 = datetime.strptime(str(p1.time), "%Y-%m-%d %H:%M:%S%z")
     t_point2 = datetime.strptime(str(p2.time), "%Y-%m-%d %H:%M:%S%z")
 
@@ -77,48 +276,289 @@ def is_valid(p1: point, p2: point) -> bool:
         return False
 
     distance = haversine.haversine((p1.latitude, p1.longitude), (p2.latitude, p2.longitude))
-    return distance <= 0.1
+    return distance <= MAX_DISTANCE
+
+
+def save_segment_array(segments: SegmentArray, filename: str) -> None:
+    """Save an (N, 4) array of segments (lat1, lon1, lat2, lon2) in binary .npy format."""
+    with atomic_write(filename, "wb") as file:
+        np.save(file, segments)
+
+
+def load_segment_array(filename: str) -> SegmentArray:
+    """Load an (N, 4) array of segments (lat1, lon1, lat2, lon2) memory-mapped from a .npy file."""
+    return np.load(filename, mmap_mode="r")
+
+
+def convert_segments_file(filename: str, array_filename: str, dtype: type = np.float64,
+                          chunk_size: int = SEGMENT_CHUNK_SIZE) -> None:
+    """
+    Convert a text file of segments to the binary .npy format. Lines with the wrong format are ignored.
+    The file is parsed chunk_size lines at a time into a raw file, so its size is not limited by the memory.
+    """
+    raw_filename = f"{array_filename}.raw"
+    num_segments = 0
+    with open(raw_filename, "wb") as file:
+        for segments in iter_segment_chunks(filename, chunk_size, dtype):
+            file.write(segments.tobytes())
+            num_segments += len(segments)
+    if num_segments > 0:
+        # np.save copies the memory-mapped raw file to the .npy without loading it
+        save_segment_array(np.memmap(raw_filename, dtype=dtype, mode="r", shape=(num_segments, 4)), array_filename)
+    else:
+        save_segment_array(np.empty((0, 4), dtype=dtype), array_filename)
+    os.remove(raw_filename)
 
 
-def load_segments(filename: str) -> Segments:
-    """Load segments from the file."""
-    segments: Segments = []
+def iter_segment_chunks(filename: str, chunk_size: int = SEGMENT_CHUNK_SIZE, dtype: type = np.float64) -> Iterator[SegmentArray]:
+    """
+    Yield the segments (lat1, lon1, lat2, lon2) of a binary .npy file or a text file as arrays of at most chunk_size rows,
+    so files larger than the memory can be processed. Lines of text files with the wrong format are ignored.
+    """
+    if filename.endswith(".npy"):
+        segments = load_segment_array(filename)
+        for start in range(0, len(segments), chunk_size):
+            yield np.array(segments[start:start + chunk_size], dtype=dtype)
+        return
     with open(filename, "r") as file:
-        for line in file:
+        while lines := list(islice(file, chunk_size)):
+            yield parse_segment_lines(lines, dtype)
+
+
+def count_segments(filename: str) -> int:
+    """Return the number of segments of a binary .npy file or of the valid lines of a text file."""
+    if filename.endswith(".npy"):
+        return len(load_segment_array(filename))
+    return sum(len(segments) for segments in iter_segment_chunks(filename))
+
+
+def parse_segment_lines(lines: list[str], dtype: type = np.float64) -> SegmentArray:
+    """Parse lines of text of segments into an (N, 4) array. Lines with the wrong format are ignored."""
+    try:
+        return np.loadtxt(lines, delimiter=",", dtype=dtype, ndmin=2).reshape(-1, 4)
+    except ValueError:
+        return np.array(read_valid_rows(lines), dtype=dtype).reshape(-1, 4)
+
+
+def read_valid_rows(lines: Iterable[str]) -> list[list[float]]:
+    """Read the lines of text of segments that have the correct format."""
+    rows: list[list[float]] = []
+    for line in lines:
+        try:
+            row = list(map(float, line.strip().split(",")))
+            if len(row) != 4:
+                raise ValueError(f"expected 4 values, found {len(row)}")
+            rows.append(row)
+        except ValueError as e:
+            print(f"Error processing line: {line.strip()} - {e}. This line will be ignored.")
+    return rows
+
+
+def get_segment_array(box: Box, filename: str, base_url: str = TRACKPOINTS_URL) -> SegmentArray:
+    """
+    Get all segments in the box as an (N, 4) array. If the binary file next to filename exists, load it.
+    Otherwise, get the text file of segments of the box and convert it to the binary file.
+    """
+    array_filename = get_array_filename(filename)
+    with stage("get_segments"):
+        if not os.path.exists(array_filename):
+            if not os.path.exists(filename):
+                merge_tiles(get_complete_tiles(box, base_url), box, filename)
+            convert_segments_file(filename, array_filename)
+        return load_segment_array(array_filename)
+
+
+def get_array_filename(filename: str) -> str:
+    """Return the name of the binary .npy file of segments next to a text file of segments."""
+    return f"{os.path.splitext(filename)[0]}.npy"
+
+
+def get_complete_tiles(box: Box, base_url: str = TRACKPOINTS_URL) -> list[str]:
+    """
+    Return the files of the tiles covering the box (see get_tiles). Raises requests.RequestException if some of them
+    could not be downloaded, so the file of the box is never made from incomplete tiles.
+    """
+    tile_filenames = get_tiles(box, base_url=base_url)
+    incomplete = [name for name in tile_filenames if os.path.exists(checkpoint_filename(name))]
+    if incomplete:
+        raise requests.RequestException(f"{len(incomplete)} of {len(tile_filenames)} tiles could not be downloaded. "
+                                        "Run it again to resume them.")
+    return tile_filenames
+
+
+def get_tiles(box: Box, cache_dir: str = TILE_CACHE_DIR, max_bytes: int = TILE_CACHE_MAX_BYTES,
+              base_url: str = TRACKPOINTS_URL, workers: int = TILE_DOWNLOAD_WORKERS) -> list[str]:
+    """
+    Return the files of the tiles covering the box, in the order of tiles_in_box, downloading the tiles that are missing
+    or too old. They are downloaded at the same time over one session, with at most `workers` pages in flight for all
+    of them. A tile that fails keeps its checkpoint and stays out of the index, so the next call resumes it.
+    The index of the cache is saved after every downloaded tile and the least recently used tiles are evicted if the
+    cache is too big.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index = load_tile_index(cache_dir)
+    tiles = tiles_in_box(box)
+    keys = [tile_key(tile) for tile in tiles]
+    filenames = [os.path.join(cache_dir, f"{key}.dat") for key in keys]
+    now = time.time()
+    missing = [(key, tile, tile_filename) for key, tile, tile_filename in zip(keys, tiles, filenames)
+               if not is_fresh_tile(index, key, tile_filename, now)]
+    if missing:
+        for key, _, _ in missing:
+            index.pop(key, None)
+        session = make_session(workers)
+        # The tiles wait for their pages in their own threads, so only the executor of the pages bounds the requests
+        with ThreadPoolExecutor(max_workers=workers) as pages, ThreadPoolExecutor(max_workers=workers) as downloads:
+            futures = {downloads.submit(download_segments, tile_download_box(tile), tile_filename, workers, base_url,
+                                        session, pages): key
+                       for key, tile, tile_filename in missing}
+            for future in as_completed(futures):
+                if future.result():
+                    index[futures[future]] = {"downloaded": now, "version": TILE_FORMAT_VERSION}
+                    save_tile_index(index, cache_dir)
+    for key, tile_filename in zip(keys, filenames):
+        if key in index:
+            index[key]["accessed"] = now
+            index[key]["size"] = os.path.getsize(tile_filename)
+    evict_tiles(index, cache_dir, max_bytes, set(keys))
+    save_tile_index(index, cache_dir)
+    return filenames
+
+
+def tiles_in_box(box: Box) -> list[Tile]:
+    """Return the (row, column) of every tile that intersects the box."""
+    first_row, last_row = tile_range(box.bottom_left.lat, box.top_right.lat)
+    first_col, last_col = tile_range(box.bottom_left.lon, box.top_right.lon)
+    return [(row, col) for row in range(first_row, last_row) for col in range(first_col, last_col)]
+
+
+def tile_range(low: float, high: float) -> tuple[int, int]:
+    """Return the first tile and one past the last tile between two coordinates."""
+    first = floor(low / TILE_SIZE + 1e-9)
+    last = ceil(high / TILE_SIZE - 1e-9)
+    return first, max(last, first + 1)
+
+
+def tile_key(tile: Tile) -> str:
+    """Return the name of a tile in the cache."""
+    return f"{tile[0]}_{tile[1]}"
+
+
+def tile_box(tile: Tile) -> Box:
+    """Return the box covered by a tile."""
+    row, col = tile
+    bottom_left = Point(round(row * TILE_SIZE, 6), round(col * TILE_SIZE, 6))
+    top_right = Point(round((row + 1) * TILE_SIZE, 6), round((col + 1) * TILE_SIZE, 6))
+    return Box(bottom_left, top_right)
+
+
+def tile_download_box(tile: Tile) -> Box:
+    """
+    Return the box downloaded for a tile: the tile and a margin of MAX_DISTANCE around it. The API only returns the
+    points inside the box, so without the margin the pairs of points on both sides of the border of two tiles are lost.
+    """
+    box = tile_box(tile)
+    lat_margin = MAX_DISTANCE / KM_PER_DEGREE
+    max_lat = min(max(abs(box.bottom_left.lat), abs(box.top_right.lat)), 89.0)
+    lon_margin = lat_margin / cos(radians(max_lat))
+    # Rounded outwards, so the margin is never smaller than MAX_DISTANCE
+    return Box(Point(floor((box.bottom_left.lat - lat_margin) * 1e6) / 1e6, floor((box.bottom_left.lon - lon_margin) * 1e6) / 1e6),
+               Point(ceil((box.top_right.lat + lat_margin) * 1e6) / 1e6, ceil((box.top_right.lon + lon_margin) * 1e6) / 1e6))
+
+
+def is_fresh_tile(index: TileIndex, key: str, tile_filename: str, now: float) -> bool:
+    """Check if a tile is in the cache, completely downloaded with the current format and not too old."""
+    return (key in index and os.path.exists(tile_filename)
+            and not os.path.exists(checkpoint_filename(tile_filename))
+            and index[key].get("version") == TILE_FORMAT_VERSION
+            and now - index[key]["downloaded"] <= TILE_MAX_AGE)
+
+
+def load_tile_index(cache_dir: str) -> TileIndex:
+    """Load the index of the tile cache. Returns an empty index if it doesn't exist or is damaged."""
+    try:
+        with open(os.path.join(cache_dir, "index.json"), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tile_index(index: TileIndex, cache_dir: str) -> None:
+    """Atomically save the index of the tile cache."""
+    filename = os.path.join(cache_dir, "index.json")
+    with atomic_write(filename) as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+
+
+def evict_tiles(index: TileIndex, cache_dir: str, max_bytes: int, keep: set[str]) -> None:
+    """Remove the least recently used tiles until the cache fits in max_bytes. Tiles in keep are never removed."""
+    total = sum(entry["size"] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]["accessed"]):
+        if total <= max_bytes:
+            break
+        if key not in keep:
+            total -= index.pop(key)["size"]
             try:
-                segment = get_data_from_file(line)
-                segments.append(segment)
-            except ValueError as e:
-                print(f"Error processing line: {line.strip()} - {e}. This line will be ignored.")
-    return segments
+                os.remove(os.path.join(cache_dir, f"{key}.dat"))
+            except FileNotFoundError:
+                pass
 
 
-def get_data_from_file(line: str) -> Segment:
-    """ Convert a line of text into a Segment object. """
-    bottom_left_lon, bottom_left_lat, top_right_lon, top_right_lat = map(float, line.strip().split(","))
-    start_point = Point(bottom_left_lat, bottom_left_lon)
-    end_point = Point(top_right_lat, top_right_lon)
-    return Segment(start_point, end_point)
+def merge_tiles(tile_filenames: list[str], box: Box, filename: str) -> None:
+    """
+    Write to the file the segments of the tiles that have both points inside the box. tile_filenames are the files of
+    tiles_in_box(box), in the same order (see get_tiles). Tiles are downloaded with a margin, so a segment near a border
+    is in several of them: it's only taken from the tile of its first point.
+    """
+    rows, cols = tile_range(box.bottom_left.lat, box.top_right.lat), tile_range(box.bottom_left.lon, box.top_right.lon)
+    with atomic_write(filename) as output:
+        for tile, tile_filename in zip(tiles_in_box(box), tile_filenames):
+            with open(tile_filename, "r") as file:
+                for line in file:
+                    try:
+                        lat1, lon1, lat2, lon2 = map(float, line.split(","))
+                    except ValueError:
+                        continue
+                    if (point_in_box(box, lat1, lon1) and point_in_box(box, lat2, lon2)
+                            and point_tile(lat1, lon1, rows, cols) == tile):
+                        output.write(line)
 
 
-def get_segments(box: Box, filename: str) -> Segments:
+def point_tile(lat: float, lon: float, rows: tuple[int, int], cols: tuple[int, int]) -> Tile:
     """
-    Get all segments in the box. If filename exists, load segments from the file.
-    Otherwise, download segments in the box and save them to the file.
+    Return the tile of a point, among the rows and columns of tile_range. Points on the border of the range
+    (within the rounding of tile_range) belong to the closest tile of the range.
     """
-    if not os.path.exists(filename):
-        download_segments(box, filename)
-    return load_segments(filename)
+    row = min(max(floor(lat / TILE_SIZE + 1e-9), rows[0]), rows[1] - 1)
+    col = min(max(floor(lon / TILE_SIZE + 1e-9), cols[0]), cols[1] - 1)
+    return row, col
+
+
+def point_in_box(box: Box, lat: float, lon: float) -> bool:
+    """Check if a point is inside the box."""
+    return box.bottom_left.lat <= lat <= box.top_right.lat and box.bottom_left.lon <= lon <= box.top_right.lon
 
 
-def show_segments(segments: Segments, filename: str) -> None:
-    """Show all segments in a PNG file using staticmaps."""
-    static_map = StaticMap(800, 600)
+def show_segments(segments: Segments | SegmentArray, filename: str, fast: bool = True) -> None:
+    """
+    Show all segments in a PNG file. The fast path projects and draws all the segments at once (see render.render_map).
+    Otherwise, every segment is added to a staticmap.
+    """
     width = 2
+    if isinstance(segments, np.ndarray):
+        # Rows are (lat1, lon1, lat2, lon2) and the map expects (lon, lat) points
+        lines = np.asarray(segments[:, [1, 0, 3, 2]], dtype=float).reshape(-1, 2, 2)
+    else:
+        # The points of segments loaded from a file hold the longitude in lat and the latitude in lon
+        lines = np.array([[[s.start.lat, s.start.lon], [s.end.lat, s.end.lon]] for s in segments], dtype=float).reshape(-1, 2, 2)
+
+    if fast:
+        render_map(800, 600, lines, "black", width).save(filename)
+        return
 
-    for segment in segments:
-        start_point, end_point = segment.start, segment.end
-        line = Line(((start_point.lat, start_point.lon), (end_point.lat, end_point.lon)), "black", width)
+    static_map = make_static_map(800, 600)
+    for start_point, end_point in lines.tolist():
+        line = Line((tuple(start_point), tuple(end_point)), "black", width)
         static_map.add_line(line)
 
     image = static_map.render()
@@ -0,0 +1,46 @@
+from batch import load_jobs, Job
+from segments import Box, Point
+import pytest
+
+
+DELTA = Box(Point(40.53, 0.57), Point(40.79, 0.9))
+
+
+def test_load_json_jobs(tmp_path):
+    filename = tmp_path / "jobs.json"
+    filename.write_text('[{"name": "delta", "box": [40.53, 0.57, 40.79, 0.90], "starts": [[40.6, 0.7], ["40.7", 0.8]],'
+                        ' "clusters": 50, "method": "grid", "render": true},'
+                        ' {"name": 7, "box": [41, 2, 41.1, 2.1]}]')
+    assert load_jobs(str(filename)) == [
+        Job("delta", DELTA, [Point(40.6, 0.7), Point(40.7, 0.8)], 50, "grid", True),
+        Job("7", Box(Point(41, 2), Point(41.1, 2.1))),
+    ]
+
+
+def test_load_csv_jobs(tmp_path):
+    filename = tmp_path / "jobs.csv"
+    filename.write_text("name,lat1,lon1,lat2,lon2,start_lat,start_lon,clusters,method,render\n"
+                        "delta,40.53,0.57,40.79,0.90,40.6,0.7,50,grid,yes\n"
+                        "other,41,2,41.1,2.1,,,,,\n"
+                        "delta,40.53,0.57,40.79,0.90,40.7,0.8,,,\n")
+    assert load_jobs(str(filename)) == [
+        Job("delta", DELTA, [Point(40.6, 0.7), Point(40.7, 0.8)], 50, "grid", True),
+        Job("other", Box(Point(41, 2), Point(41.1, 2.1))),
+    ]
+
+
+@pytest.mark.parametrize("name, content, error", [
+    ("jobs.json", '[{"name": "a", "box": [41, 2, 41.1, 2.1]}, {"name": "b", "box": [41, 2, 41.1]}]', "job 1 of"),
+    ("jobs.json", '[{"box": [41, 2, 41.1, 2.1]}]', "job 0 of"),
+    ("jobs.json", '[{"name": "a", "box": [41, 2, 41.1, 2.1], "starts": [[41.05]]}]', "job 0 of"),
+    ("jobs.json", '[{"name": "a", "box": [41, 2, 41.1, 2.1], "clusters": "many"}]', "job 0 of"),
+    ("jobs.csv", "name,lat1,lon1,lat2,lon2\na,41,2,41.1,2.1\nb,41,2,north,2.1\n", "line 3 of"),
+    ("jobs.csv", "name,lat1,lon1,lat2\na,41,2,41.1\n", "line 2 of"),
+    ("jobs.csv", "name,lat1,lon1,lat2,lon2,start_lat,start_lon\na,41,2,41.1,2.1,41.05,east\n", "line 2 of"),
+    ("jobs.csv", "name,lat1,lon1,lat2,lon2\na,41,2,41.1\n", "line 2 of"),
+])
+def test_bad_jobs_are_reported(tmp_path, name, content, error):
+    filename = tmp_path / name
+    filename.write_text(content)
+    with pytest.raises(ValueError, match=error):
+        load_jobs(str(filename))
@@ -0,0 +1,64 @@
+from compactgraph import CompactGraph, as_compact
+import haversine
+import networkx as nx
+import numpy as np
+import pytest
+
+
+def make_networkx_graph() -> nx.Graph:
+    """Return a small graph with labels that are not rows, (lon, lat) positions, weighted edges and one without weight."""
+    graph = nx.Graph()
+    for node, pos in ((10, (2.0, 41.0)), (7, (2.01, 41.0)), (42, (2.01, 41.01)), (3, (2.0, 41.02))):
+        graph.add_node(node, pos=np.array(pos))
+    graph.add_edge(10, 7, weight=0.5)
+    graph.add_edge(7, 42, weight=1.25)
+    graph.add_edge(42, 10, weight=2.0)
+    graph.add_edge(3, 42)
+    return graph
+
+
+def test_from_edges():
+    positions = np.array([[2.0, 41.0], [2.1, 41.0], [2.1, 41.1], [2.0, 41.1]])
+    graph = CompactGraph.from_edges(np.array([5, 6, 7, 8]), positions, np.array([2, 0, 1]), np.array([0, 1, 3]),
+                                    np.array([3.0, 1.0, 2.0]))
+    assert (graph.number_of_nodes(), graph.number_of_edges()) == (4, 3)
+    assert graph.degrees().tolist() == [2, 2, 1, 1]
+    assert graph.neighbors(5) == [6, 7] and graph.neighbors(8) == [6]
+    assert graph.weight(5, 7) == graph.weight(7, 5) == 3.0
+    assert graph.weight(6, 8) == 2.0
+    with pytest.raises(KeyError):
+        graph.weight(5, 8)
+    assert graph.position(7).tolist() == [2.1, 41.1]
+    assert 8 in graph and 4 not in graph
+    starts, ends, weights = graph.edge_arrays()
+    assert sorted(zip(starts.tolist(), ends.tolist(), weights.tolist())) == [(0, 1, 1.0), (0, 2, 3.0), (1, 3, 2.0)]
+
+
+def test_csr_is_the_weighted_adjacency_matrix():
+    nx_graph = make_networkx_graph()
+    graph = CompactGraph.from_networkx(nx_graph)
+    nx_graph.edges[3, 42]['weight'] = graph.weight(3, 42)
+    expected = nx.to_numpy_array(nx_graph, nodelist=graph.nodes.tolist(), weight='weight')
+    assert np.allclose(graph.csr().toarray(), expected)
+    assert np.shares_memory(graph.csr().data, graph.weights)
+
+
+def test_networkx_round_trip():
+    nx_graph = make_networkx_graph()
+    graph = CompactGraph.from_networkx(nx_graph)
+    assert graph.nodes.tolist() == [10, 7, 42, 3]
+    assert graph.weight(7, 42) == 1.25
+    # The edge without weight gets its haversine length, with the positions as (lon, lat)
+    assert graph.weight(3, 42) == pytest.approx(haversine.haversine((41.02, 2.0), (41.01, 2.01)), rel=1e-6)
+    assert as_compact(nx_graph) is graph
+
+    back = graph.to_networkx()
+    assert sorted(back.nodes()) == sorted(nx_graph.nodes())
+    assert {frozenset(edge) for edge in back.edges()} == {frozenset(edge) for edge in nx_graph.edges()}
+    for u, v, weight in nx_graph.edges(data='weight'):
+        assert back.edges[u, v]['weight'] == pytest.approx(graph.weight(u, v))
+        assert weight is None or graph.weight(u, v) == pytest.approx(weight)
+    for node in nx_graph.nodes():
+        assert back.nodes[node]['pos'].tolist() == nx_graph.nodes[node]['pos'].tolist()
+    # A graph made by to_networkx gives back the same arrays
+    assert CompactGraph.from_networkx(back) is graph
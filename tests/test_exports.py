@@ -0,0 +1,38 @@
+from exports import submit_export, wait_for_exports, failed_exports, set_export_workers, ExportResult
+import exports
+import os, threading, time
+
+
+def write_text(text: str, filename: str) -> None:
+    with open(filename, "w") as file:
+        file.write(text)
+
+
+def test_a_failed_export_does_not_stop_the_others(tmp_path, capsys):
+    workers = exports.EXPORT_WORKERS
+    set_export_workers(2)
+    try:
+        # The failing export and a slow one run at the same time
+        started = threading.Barrier(2, timeout=5)
+
+        def fail(text: str, filename: str) -> None:
+            started.wait()
+            raise OSError("No space left on device")
+
+        def write_slowly(text: str, filename: str) -> None:
+            started.wait()
+            time.sleep(0.05)
+            write_text(text, filename)
+
+        names = [str(tmp_path / name) for name in ("graph.png", "graph.kml", "routes.kml")]
+        futures = [submit_export(fail, names[0], "png"), submit_export(write_slowly, names[1], "kml"),
+                   submit_export(write_text, names[2], "routes")]
+        results = wait_for_exports(futures)
+    finally:
+        set_export_workers(workers)
+
+    assert all(future.exception() is None for future in futures)
+    assert results == [ExportResult(names[0], "OSError: No space left on device"), ExportResult(names[1]), ExportResult(names[2])]
+    assert failed_exports(results) == results[:1]
+    assert not os.path.exists(names[0]) and os.path.exists(names[1]) and os.path.exists(names[2])
+    assert f"Error saving {names[0]}: OSError: No space left on device" in capsys.readouterr().out
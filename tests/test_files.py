@@ -0,0 +1,21 @@
+from files import atomic_write
+import os, pytest
+
+
+def test_atomic_write(tmp_path):
+    filename = str(tmp_path / "index.json")
+    with atomic_write(filename) as file:
+        file.write("old")
+    # The file is only replaced when the block ends without errors
+    with pytest.raises(ValueError):
+        with atomic_write(filename) as file:
+            file.write("new")
+            raise ValueError
+    with open(filename) as file:
+        assert file.read() == "old"
+    with atomic_write(filename, "wb") as file:
+        file.write(b"new")
+        assert sorted(os.listdir(tmp_path)) == sorted(["index.json", os.path.basename(file.name)])
+    with open(filename) as file:
+        assert file.read() == "new"
+    assert os.listdir(tmp_path) == ["index.json"]
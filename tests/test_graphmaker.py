@@ -0,0 +1,47 @@
+from graphmaker import (get_graph, get_graph_directory, read_graph_key, make_graph, make_graph_from_file, SIMPLIFY_EPSILON,
+                        CHUNKED_SAMPLE_SIZE)
+from segments import save_segment_array
+import numpy as np
+import graphmaker
+
+
+def make_segments_file(filename: str, num_segments: int) -> None:
+    """Save random short segments (lat1, lon1, lat2, lon2) around a small box."""
+    rng = np.random.default_rng(0)
+    starts = np.column_stack((41.0 + rng.random(num_segments) * 0.05, 2.0 + rng.random(num_segments) * 0.05))
+    save_segment_array(np.hstack((starts, starts + rng.normal(0, 0.0005, starts.shape))), filename)
+
+
+def test_chunked_and_memory_graphs_are_not_mixed(tmp_path, monkeypatch):
+    segments_filename = str(tmp_path / "segments.npy")
+    make_segments_file(segments_filename, 1000)
+    directory = get_graph_directory(segments_filename, 20, "kmeans", SIMPLIFY_EPSILON)
+    builds = []
+    make_graph, make_graph_from_file = graphmaker.make_graph, graphmaker.make_graph_from_file
+    monkeypatch.setattr(graphmaker, "make_graph", lambda *args, **kwargs: builds.append("memory") or make_graph(*args, **kwargs))
+    monkeypatch.setattr(graphmaker, "make_graph_from_file",
+                        lambda *args, **kwargs: builds.append("chunked") or make_graph_from_file(*args, **kwargs))
+
+    get_graph(segments_filename, 20, compact=True)
+    get_graph(segments_filename, 20, compact=True, chunk_size=300)
+    assert read_graph_key(directory)["build"] == "chunked"
+    assert read_graph_key(directory)["sample_size"] == CHUNKED_SAMPLE_SIZE
+    # The chunk size doesn't change the graph
+    get_graph(segments_filename, 20, compact=True, chunk_size=500)
+    get_graph(segments_filename, 20, compact=True)
+    assert builds == ["memory", "chunked", "memory"]
+    assert read_graph_key(directory)["build"] == "memory"
+
+
+def test_grid_graph_by_chunks_is_the_same_as_in_memory(tmp_path):
+    segments_filename = str(tmp_path / "segments.npy")
+    make_segments_file(segments_filename, 5000)
+    expected = make_graph(np.load(segments_filename), 200, "grid", compact=True)
+    assert expected.number_of_edges() > 0
+    for chunk_size in (700, 5000):
+        graph = make_graph_from_file(segments_filename, 200, "grid", chunk_size=chunk_size, compact=True)
+        assert np.array_equal(graph.nodes, expected.nodes)
+        # The centroids are added up by chunks, so they can differ in the last bit
+        assert np.allclose(graph.positions, expected.positions, rtol=1e-14, atol=0)
+        for ours, theirs in zip(graph.edge_arrays(), expected.edge_arrays()):
+            assert np.array_equal(ours, theirs)
@@ -0,0 +1,58 @@
+from main import parse_arguments, run_command
+from monuments import refresh_monuments, read_all_monuments
+import main
+import metrics
+import os, pytest
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics(monkeypatch):
+    """Leave the metrics disabled and empty after every test."""
+    monkeypatch.setattr(metrics, "_enabled", False)
+    monkeypatch.setattr(metrics, "_profile_mode", None)
+    yield
+    metrics.reset_metrics()
+
+
+def test_parse_arguments():
+    arguments = parse_arguments(["--data-dir", "data", "route", "--box", "41", "2", "41.1", "2.1", "--start", "41.05", "2.05"])
+    assert (arguments.command, arguments.data_dir, arguments.box, arguments.start) == ("route", "data", [41, 2, 41.1, 2.1], [41.05, 2.05])
+    assert (arguments.clusters, arguments.method, arguments.output, arguments.metrics) == (100, "kmeans", "routes", None)
+    assert parse_arguments([]).command is None
+    arguments = parse_arguments(["--metrics", "metrics.prom", "--profile", "tracemalloc", "batch", "jobs.json"])
+    assert (arguments.profile, arguments.jobs) == ("tracemalloc", "jobs.json")
+
+
+@pytest.mark.parametrize("arguments", [
+    ["--profile", "cprofile", "download-monuments"],  # nowhere to save the profile
+    ["--metrics", "metrics.prom", "--profile", "perf", "download-monuments"],
+    ["route", "--box", "41", "2", "41.1", "2.1"],  # without --start
+    ["render", "--box", "41", "2", "41.1"],
+])
+def test_parse_arguments_rejects_wrong_commands(arguments, capsys):
+    with pytest.raises(SystemExit):
+        parse_arguments(arguments)
+    assert "error" in capsys.readouterr().err
+
+
+def test_run_command_saves_the_metrics(serve, tmp_path, monkeypatch):
+    with open(os.path.join(FIXTURES, "monuments_page.html"), "rb") as file:
+        page = file.read()
+    url = serve(lambda path, headers: (200, {"Content-Type": "text/html; charset=UTF-8"}, page))
+    monkeypatch.setattr(main, "refresh_monuments", lambda filename: refresh_monuments(filename, url))
+    metrics_filename = str(tmp_path / "metrics.prom")
+    run_command(parse_arguments(["--data-dir", str(tmp_path), "--metrics", metrics_filename, "download-monuments"]))
+    assert len(read_all_monuments(str(tmp_path / "monuments.dat"))) == 8
+    with open(metrics_filename) as file:
+        saved = file.read()
+    assert "medieval_routes_monuments_added_total 8" in saved
+    assert 'medieval_routes_stage_calls_total{stage="fetch_monuments"} 1' in saved
+
+
+def test_run_command_reports_a_wrong_jobs_file(tmp_path, capsys):
+    jobs_filename = tmp_path / "jobs.json"
+    jobs_filename.write_text('[{"name": "delta", "box": [40.5, 0.5, 40.8]}]')
+    run_command(parse_arguments(["batch", str(jobs_filename)]))
+    assert "The jobs could not be loaded: job 0 of" in capsys.readouterr().out
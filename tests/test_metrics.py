@@ -0,0 +1,67 @@
+from metrics import count, stage, get_metrics, merge_metrics, format_metrics, reset_metrics, enable_metrics, metrics_enabled
+import metrics
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics(monkeypatch):
+    """Start every test with no metrics, and leave them disabled after it."""
+    monkeypatch.setattr(metrics, "_enabled", False)
+    monkeypatch.setattr(metrics, "_profile_mode", None)
+    reset_metrics()
+    yield
+    reset_metrics()
+
+
+def test_nothing_is_recorded_when_metrics_are_off():
+    assert not metrics_enabled()
+    count("pages_fetched")
+    count("bytes_fetched", 100)
+    with stage("get_segments"):
+        count("segments_kept", 3)
+    assert get_metrics() == {"counters": {}}
+
+
+def test_counters_and_stages():
+    enable_metrics()
+    count("pages_fetched")
+    count("pages_fetched", 2)
+    with stage("get_segments"):
+        with stage("get_segments.parse"):
+            pass
+    with pytest.raises(ValueError):
+        with stage("get_segments"):
+            raise ValueError
+    snapshot = get_metrics()
+    assert snapshot["counters"] == {"pages_fetched": 3}
+    assert snapshot["stage:get_segments"]["calls"] == 2
+    assert snapshot["stage:get_segments.parse"]["calls"] == 1
+    assert snapshot["stage:get_segments"]["seconds"] >= snapshot["stage:get_segments.parse"]["seconds"] >= 0
+    with pytest.raises(ValueError):
+        enable_metrics("perf")
+
+
+def test_merge_and_format_metrics():
+    # Metrics of other processes are added even if this one doesn't collect any
+    merge_metrics({"counters": {"pages_fetched": 2, "bytes_fetched": 1500},
+                   "stage:find_routes": {"calls": 1, "seconds": 0.5},
+                   "stage:make_graph": {"calls": 2, "seconds": 1.25, "peak_bytes": 1000}})
+    merge_metrics({"counters": {"pages_fetched": 1},
+                   "stage:make_graph": {"calls": 1, "seconds": 0.25, "peak_bytes": 3000}})
+    assert get_metrics() == {"counters": {"pages_fetched": 3, "bytes_fetched": 1500},
+                             "stage:find_routes": {"calls": 1, "seconds": 0.5},
+                             "stage:make_graph": {"calls": 3, "seconds": 1.5, "peak_bytes": 3000}}
+    assert format_metrics() == """\
+# TYPE medieval_routes_bytes_fetched_total counter
+medieval_routes_bytes_fetched_total 1500
+# TYPE medieval_routes_pages_fetched_total counter
+medieval_routes_pages_fetched_total 3
+# TYPE medieval_routes_stage_calls_total counter
+medieval_routes_stage_calls_total{stage="find_routes"} 1
+medieval_routes_stage_calls_total{stage="make_graph"} 3
+# TYPE medieval_routes_stage_seconds_total counter
+medieval_routes_stage_seconds_total{stage="find_routes"} 0.5
+medieval_routes_stage_seconds_total{stage="make_graph"} 1.5
+# TYPE medieval_routes_stage_peak_bytes gauge
+medieval_routes_stage_peak_bytes{stage="make_graph"} 3000
+"""
@@ -0,0 +1,149 @@
+from monuments import (fetch_monuments_script, extract_script_from_stream, parse_monument_data, refresh_monuments,
+                       read_all_monuments, load_validators, make_catalog, monuments_in_box, monuments_within,
+                       nearest_monuments, Monument, MONUMENTS_KEYWORD)
+from segments import Box, Point
+import haversine
+import numpy as np
+import os, pytest, requests, time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# The monuments of fixtures/monuments_page.html, in the order of the page
+PAGE_MONUMENTS = [
+    Monument("Castell de Requesens", Point(42.410472, 2.998528)),
+    Monument("Castell de Montsoriu", Point(41.767222, 2.534167)),
+    Monument("Torre de la Mora – Tamarit", Point(41.126389, 1.354722)),
+    Monument("Església de Sant Climent de Taüll", Point(42.519722, 0.846389)),
+    Monument("Castell de Cardona - Torre Minyona", Point(41.915, 1.680278)),
+    Monument("Pont de Sant Miquel", Point(42.216667, 2.575)),
+    Monument("Pont de Sant Miquel", Point(41.701944, 1.829722)),
+    Monument("Castell de Miravet", Point(41.038333, 0.593611)),
+]
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+
+def monuments_site(pages: dict[str, bytes], current: list[str], requests_seen: list[dict[str, str]]):
+    """
+    Return a server that stands in for the monuments page: it serves pages[current[0]] with that name as its ETag and
+    Last-Modified, and answers 304 to conditional requests for the same ETag.
+    """
+    def respond(path: str, headers: dict[str, str]):
+        requests_seen.append(headers)
+        name = current[0]
+        validators = {"ETag": f'"{name}"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        if headers.get("If-None-Match") == f'"{name}"':
+            return 304, validators, b""
+        return 200, validators | {"Content-Type": "text/html; charset=UTF-8"}, pages[name]
+    return respond
+
+
+def test_fetch_and_parse_the_saved_page(serve):
+    url = serve(monuments_site({"page": read_fixture("monuments_page.html")}, ["page"], []))
+    script, validators = fetch_monuments_script(url, {})
+    assert script.lstrip().startswith(MONUMENTS_KEYWORD)
+    assert parse_monument_data(script) == PAGE_MONUMENTS
+    assert validators == {"etag": '"page"', "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+
+
+def test_extract_script_from_any_chunks():
+    page = read_fixture("monuments_page.html")
+    expected = extract_script_from_stream([page], MONUMENTS_KEYWORD)
+    assert MONUMENTS_KEYWORD in expected
+    for size in (1, 7, 16, 100, 4096):
+        chunks = [page[i:i + size] for i in range(0, len(page), size)]
+        assert extract_script_from_stream(chunks, MONUMENTS_KEYWORD) == expected
+
+
+def test_refresh_monuments(serve, tmp_path):
+    filename = str(tmp_path / "monuments.dat")
+    pages = {"page": read_fixture("monuments_page.html"), "updated": read_fixture("monuments_page_updated.html")}
+    current, requests_seen = ["page"], []
+    url = serve(monuments_site(pages, current, requests_seen))
+
+    changes = refresh_monuments(filename, url)
+    assert (changes.added, changes.changed, changes.removed, changes.not_modified) == (8, 0, 0, False)
+    assert read_all_monuments(filename) == PAGE_MONUMENTS
+    assert load_validators(filename)["etag"] == '"page"'
+
+    # The page didn't change: the server answers 304 and the file is not written
+    modified = os.stat(filename).st_mtime_ns
+    changes = refresh_monuments(filename, url)
+    assert changes.not_modified
+    assert requests_seen[-1]["If-None-Match"] == '"page"'
+    assert os.stat(filename).st_mtime_ns == modified
+
+    # One monument moved, one removed and one added: the others keep their order and the new one goes last
+    current[0] = "updated"
+    changes = refresh_monuments(filename, url)
+    assert (changes.added, changes.changed, changes.removed, changes.not_modified) == (1, 1, 1, False)
+    monuments = read_all_monuments(filename)
+    assert [monument.name for monument in monuments] == [monument.name for monument in PAGE_MONUMENTS[1:]] + ["Castell de Burriac"]
+    assert monuments[0].location == Point(41.7675, 2.534)
+    assert load_validators(filename)["etag"] == '"updated"'
+
+
+def random_catalog(num_monuments: int, seed: int):
+    """Return a catalog of random monuments around Catalonia and their (lat, lon) coordinates."""
+    rng = np.random.default_rng(seed)
+    coordinates = np.column_stack((40.5 + rng.random(num_monuments) * 2.5, 0.2 + rng.random(num_monuments) * 3.1))
+    return make_catalog([f"monument {i}" for i in range(num_monuments)], coordinates), coordinates
+
+
+def distances_by_scan(coordinates: np.ndarray, point: Point) -> np.ndarray:
+    """Return the haversine distance in km from the point to every monument, one at a time."""
+    return np.array([haversine.haversine((point.lat, point.lon), (lat, lon)) for lat, lon in coordinates.tolist()])
+
+
+def test_catalog_queries_match_a_linear_scan():
+    catalog, coordinates = random_catalog(3000, 1)
+    rng = np.random.default_rng(2)
+    # Points inside the monuments area, on its borders and outside it
+    for lat, lon in np.column_stack((40.0 + rng.random(30) * 3.5, -0.3 + rng.random(30) * 4.1)).tolist():
+        point = Point(lat, lon)
+        distances = distances_by_scan(coordinates, point)
+        for radius in (0.5, 5.0, 40.0):
+            assert monuments_within(catalog, point, radius).tolist() == np.flatnonzero(distances <= radius).tolist()
+        for k in (1, 10, 3000, 5000):
+            indices, nearest = nearest_monuments(catalog, point, k)
+            assert nearest.tolist() == pytest.approx(np.sort(distances)[:k].tolist())
+            assert nearest.tolist() == pytest.approx(distances[indices].tolist())
+            assert sorted(indices.tolist()) == sorted(np.argsort(distances)[:k].tolist())
+        box = Box(Point(lat - 0.2, lon - 0.3), Point(lat + 0.2, lon + 0.3))
+        inside = ((box.bottom_left.lat <= coordinates[:, 0]) & (coordinates[:, 0] <= box.top_right.lat) &
+                  (box.bottom_left.lon <= coordinates[:, 1]) & (coordinates[:, 1] <= box.top_right.lon))
+        assert monuments_in_box(catalog, box).tolist() == np.flatnonzero(inside).tolist()
+
+
+def test_catalog_queries_without_monuments():
+    catalog, _ = random_catalog(0, 3)
+    assert len(monuments_within(catalog, Point(41.0, 2.0), 10.0)) == 0
+    indices, distances = nearest_monuments(catalog, Point(41.0, 2.0), 5)
+    assert len(indices) == len(distances) == 0
+
+
+def test_fetch_retries_only_server_errors(serve, monkeypatch):
+    sleeps: list[float] = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    page = read_fixture("monuments_page.html")
+    statuses = [503, 500, 200]
+    requests_seen: list[dict[str, str]] = []
+
+    def respond(path: str, headers: dict[str, str]):
+        requests_seen.append(headers)
+        status = statuses.pop(0)
+        return status, {}, page if status == 200 else b"Server Error"
+
+    script, _ = fetch_monuments_script(serve(respond), {})
+    assert parse_monument_data(script) == PAGE_MONUMENTS
+    assert len(requests_seen) == 3 and len(sleeps) == 2
+
+    # A client error is not retried
+    requests_seen.clear()
+    statuses[:] = [404, 200]
+    with pytest.raises(requests.HTTPError):
+        fetch_monuments_script(serve(respond), {})
+    assert len(requests_seen) == 1 and len(sleeps) == 2
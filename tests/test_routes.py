@@ -0,0 +1,139 @@
+from compactgraph import CompactGraph
+from graphmaker import get_graph
+from segments import save_segment_array
+from segments import Point
+from monuments import Monument
+from routes import (find_shortest_paths, prepare_route_trees, choose_backend, get_route_trees_filename, find_closest_nodes,
+                    haversine_distance, ROUTE_TREES_MIN_QUERIES)
+import networkx as nx
+import numpy as np
+import os, pytest
+import routes
+
+
+def make_random_graph(num_nodes: int, seed: int) -> CompactGraph:
+    """Return a connected random geometric graph with (lon, lat) positions and random weights, so shortest paths are unique."""
+    rng = np.random.default_rng(seed)
+    positions = 2.0 + rng.random((num_nodes, 2)) * 0.1
+    graph = nx.random_geometric_graph(num_nodes, 0.2, pos=dict(enumerate(positions.tolist())), seed=seed)
+    graph.add_edges_from((i, i + 1) for i in range(num_nodes - 1))
+    for u, v in graph.edges():
+        graph.edges[u, v]['weight'] = float(rng.random()) + 0.01
+    for node, position in zip(graph.nodes(), positions):
+        graph.nodes[node]['pos'] = position
+    return CompactGraph.from_networkx(graph)
+
+
+def closest_node_by_scan(graph: CompactGraph, point: Point) -> tuple[int, float]:
+    """Return the closest node to the point and its distance, checking every node."""
+    distances = [haversine_distance(point, Point(lat, lon)) for lon, lat in graph.positions.tolist()]
+    row = int(np.argmin(distances))
+    return int(graph.nodes[row]), distances[row]
+
+
+def test_closest_nodes_match_a_linear_scan():
+    graph = make_random_graph(500, 6)
+    rng = np.random.default_rng(7)
+    # Points inside the graph and far from it
+    points = [Point(lat, lon) for lon, lat in (1.9 + rng.random((200, 2)) * 0.3).tolist()]
+    for max_distance in (None, 1.0):
+        closest_nodes = find_closest_nodes(graph, points, max_distance)
+        for point, node in zip(points, closest_nodes):
+            expected, distance = closest_node_by_scan(graph, point)
+            if max_distance is not None and distance > max_distance:
+                assert node == -1
+            else:
+                assert node == expected
+    # The networkx graph gets the same nodes
+    assert find_closest_nodes(graph.to_networkx(), points) == find_closest_nodes(graph, points)
+    assert find_closest_nodes(CompactGraph.from_networkx(nx.Graph()), points[:3]) == [-1, -1, -1]
+
+
+def test_route_trees_match_dijkstra():
+    graph = make_random_graph(300, 1)
+    nx_graph = nx.Graph(graph.to_networkx())
+    rng = np.random.default_rng(2)
+    monuments = set(rng.choice(300, 20, replace=False).tolist())
+    for source in rng.choice(300, 30, replace=False).tolist():
+        distances, paths = nx.single_source_dijkstra(nx_graph, source, weight='weight')
+        for backend in ("csr", "trees"):
+            backend_distances, backend_paths = find_shortest_paths(graph, source, monuments, backend)
+            assert backend_distances.keys() == monuments
+            for monument in monuments:
+                assert backend_distances[monument] == pytest.approx(distances[monument], rel=1e-6)
+                assert backend_paths[monument] == paths[monument]
+
+
+def test_route_trees_of_unreachable_monuments():
+    graph = make_random_graph(50, 3)
+    nx_graph = graph.to_networkx()
+    nx_graph.add_node(1000, pos=np.array([2.5, 2.5]))
+    distances, paths = find_shortest_paths(nx_graph, 0, {1000, 10}, "trees")
+    assert distances.keys() == paths.keys() == {10}
+
+
+def test_choose_backend(monkeypatch):
+    graph = make_random_graph(20, 4)
+    monuments = [Monument("monument", Point(41.0, 2.0))]
+    assert choose_backend(graph, 1, monuments) == "csr"
+    assert choose_backend(graph, ROUTE_TREES_MIN_QUERIES, monuments) == "trees"
+    prepare_route_trees(graph, {1, 2})
+    assert choose_backend(graph, 1, monuments) == "trees"
+    # Too many monuments × nodes for the trees
+    monkeypatch.setattr(routes, "ROUTE_TREES_MAX_CELLS", 19)
+    assert choose_backend(graph, ROUTE_TREES_MIN_QUERIES, monuments) == "csr"
+
+
+def make_segments_file(filename: str, num_segments: int) -> None:
+    """Save random short segments (lat1, lon1, lat2, lon2) around a small box."""
+    rng = np.random.default_rng(5)
+    starts = np.column_stack((41.0 + rng.random(num_segments) * 0.05, 2.0 + rng.random(num_segments) * 0.05))
+    ends = starts + rng.normal(0, 0.0005, starts.shape)
+    save_segment_array(np.hstack((starts, ends)), filename)
+
+
+def test_route_trees_are_saved_with_the_graph(tmp_path, monkeypatch):
+    segments_filename = str(tmp_path / "segments.npy")
+    make_segments_file(segments_filename, 2000)
+    graph = get_graph(segments_filename, 30, compact=True)
+    monuments = set(graph.nodes[:5].tolist())
+    trees = prepare_route_trees(graph, monuments)
+    filename = get_route_trees_filename(graph)
+    assert os.path.exists(filename)
+
+    def no_dijkstra(*args, **kwargs):
+        raise AssertionError("the saved trees should have been loaded")
+
+    # The same graph loads the saved trees
+    with monkeypatch.context() as patch:
+        patch.setattr(routes, "dijkstra", no_dijkstra)
+        loaded = prepare_route_trees(get_graph(segments_filename, 30, compact=True), monuments)
+    assert loaded.roots == trees.roots
+    assert np.array_equal(loaded.predecessors, trees.predecessors)
+
+    # Another graph, or the same one built again, doesn't
+    assert get_route_trees_filename(get_graph(segments_filename, 31, compact=True)) != filename
+    rebuilt = get_graph(segments_filename, 30, rebuild=True, compact=True)
+    assert not os.path.exists(filename)
+    with monkeypatch.context() as patch:
+        patch.setattr(routes, "dijkstra", no_dijkstra)
+        with pytest.raises(AssertionError):
+            prepare_route_trees(rebuilt, monuments)
+
+
+def test_saved_route_trees_are_used_by_single_queries(tmp_path, monkeypatch):
+    segments_filename = str(tmp_path / "segments.npy")
+    make_segments_file(segments_filename, 2000)
+    graph = get_graph(segments_filename, 30, compact=True)
+    monuments = [Monument(str(i), Point(lat, lon)) for i, (lon, lat) in enumerate(graph.positions[:5].tolist())]
+    assert choose_backend(graph, 1, monuments) == "csr"
+    prepare_route_trees(graph, set(graph.nodes[:5].tolist()))
+
+    # A new process loads the graph and finds the trees of its monuments next to it
+    loaded = get_graph(segments_filename, 30, compact=True)
+    assert choose_backend(loaded, 1, monuments) == "trees"
+    assert 'route_trees' in loaded.graph
+    # but not the trees of other monuments
+    other = get_graph(segments_filename, 30, compact=True)
+    assert choose_backend(other, 1, monuments + [Monument("other", Point(*graph.positions[-1].tolist()[::-1]))]) == "csr"
+    assert 'route_trees' not in other.graph
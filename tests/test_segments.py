@@ -0,0 +1,238 @@
+from urllib.parse import urlparse, parse_qs
+from segments import (Box, Point, download_segments, checkpoint_filename, read_checkpoint, get_tiles, get_segment_array,
+                      load_tile_index, tile_key, tiles_in_box, get_stream_lines, get_page_lines,
+                      get_valid_lines, is_valid, MAX_DISTANCE, LIMIT_YEAR)
+import os, pytest, requests, threading, time
+from datetime import datetime, timezone
+import gpxpy, gpxpy.gpx, haversine
+import numpy as np
+
+
+EMPTY_PAGE = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" creator="OpenStreetMap.org"/>'
+
+
+def gpx_page(tracks: list[list[tuple[float, float]]], time: str = "2020-01-01T00:00:00Z") -> str:
+    """Return a page of trackpoints like the ones of the OpenStreetMap API, with (lat, lon) points."""
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<gpx version="1.0" creator="OpenStreetMap.org" xmlns="http://www.topografix.com/GPX/1/0">']
+    for track in tracks:
+        lines.append("<trk><name>track</name><trkseg>")
+        lines.extend(f'<trkpt lat="{lat}" lon="{lon}"><time>{time}</time></trkpt>' for lat, lon in track)
+        lines.append("</trkseg></trk>")
+    lines.append("</gpx>")
+    return "\n".join(lines)
+
+
+def track_pages(num_pages: int):
+    """Return a server that answers pages 0 to num_pages - 1 with one track of two valid segments and then empty pages."""
+    def respond(path: str, headers: dict[str, str]):
+        page = int(parse_qs(urlparse(path).query)["page"][0])
+        if page >= num_pages:
+            return 200, {}, EMPTY_PAGE.encode()
+        lat = 41.0 + page * 0.001
+        return 200, {}, gpx_page([[(lat, 2.0), (lat + 0.0001, 2.0), (lat + 0.0002, 2.0)]]).encode()
+    return respond
+
+
+BOX = Box(Point(40.9, 1.9), Point(41.1, 2.1))
+
+
+def test_download_segments_writes_pages_in_order(serve, tmp_path):
+    filename = str(tmp_path / "segments.dat")
+    download_segments(BOX, filename, workers=3, base_url=serve(track_pages(7)))
+    with open(filename) as file:
+        lats = [float(line.split(",")[0]) for line in file]
+    assert len(lats) == 14
+    assert lats == sorted(lats)
+    assert not os.path.exists(checkpoint_filename(filename))
+
+
+def test_download_segments_with_empty_first_page(serve, tmp_path):
+    filename = str(tmp_path / "segments.dat")
+    download_segments(BOX, filename, base_url=serve(track_pages(0)))
+    assert os.path.getsize(filename) == 0
+    assert not os.path.exists(checkpoint_filename(filename))
+
+
+def test_download_segments_keeps_checkpoint_when_first_page_fails(serve, tmp_path):
+    filename = str(tmp_path / "segments.dat")
+    download_segments(BOX, filename, base_url=serve(lambda path, headers: (503, {}, b"Service Unavailable")))
+    assert os.path.exists(checkpoint_filename(filename))
+    assert read_checkpoint(filename) == (0, 0)
+
+
+def test_download_segments_resumes_from_checkpoint(serve, tmp_path):
+    filename = str(tmp_path / "segments.dat")
+    failing = {"page": 2}
+
+    def respond(path: str, headers: dict[str, str]):
+        page = int(parse_qs(urlparse(path).query)["page"][0])
+        if page == failing["page"]:
+            return 503, {}, b"Service Unavailable"
+        return track_pages(4)(path, headers)
+
+    url = serve(respond)
+    download_segments(BOX, filename, workers=2, base_url=url)
+    assert read_checkpoint(filename)[0] == 2
+    failing["page"] = -1
+    download_segments(BOX, filename, workers=2, base_url=url)
+    with open(filename) as file:
+        assert len(file.readlines()) == 8
+    assert not os.path.exists(checkpoint_filename(filename))
+
+
+def trackpoints_api(tracks: list[list[tuple[float, float]]], failing: set[float]):
+    """
+    Return a server that answers like the trackpoints API: page 0 has the points of the tracks inside the bbox.
+    Requests whose bbox starts above a latitude of failing fail.
+    """
+    def respond(path: str, headers: dict[str, str]):
+        query = parse_qs(urlparse(path).query)
+        min_lon, min_lat, max_lon, max_lat = map(float, query["bbox"][0].split(","))
+        if any(min_lat > lat for lat in failing):
+            return 503, {}, b"Service Unavailable"
+        if query["page"][0] != "0":
+            return 200, {}, EMPTY_PAGE.encode()
+        inside = [[(lat, lon) for lat, lon in track if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon] for track in tracks]
+        return 200, {}, gpx_page([track for track in inside if track]).encode()
+    return respond
+
+
+# Two tiles of 0.05 degrees, split at the latitude 41.05
+TWO_TILES = Box(Point(41.01, 2.01), Point(41.09, 2.04))
+# A track that crosses the border of the tiles: 3 segments, one of them across the border
+CROSSING_TRACK = [(41.0498, 2.02), (41.0499, 2.02), (41.0501, 2.02), (41.0502, 2.02)]
+
+
+def test_segments_across_tile_borders_are_kept_once(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    segments = get_segment_array(TWO_TILES, "box.dat", base_url=serve(trackpoints_api([CROSSING_TRACK], set())))
+    assert len(tiles_in_box(TWO_TILES)) == 2
+    assert sorted(segments[:, 0].tolist()) == [41.0498, 41.0499, 41.0501]
+
+
+def test_failed_tiles_are_not_cached(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bottom, top = tiles_in_box(TWO_TILES)
+    # The upper tile fails
+    failing = {41.04}
+    url = serve(trackpoints_api([CROSSING_TRACK], failing))
+    with pytest.raises(requests.RequestException):
+        get_segment_array(TWO_TILES, "box.dat", base_url=url)
+    assert not os.path.exists("box.dat") and not os.path.exists("box.npy")
+    index = load_tile_index("segment_tiles")
+    assert tile_key(bottom) in index and tile_key(top) not in index
+
+    # Only the failed tile is downloaded again
+    failing.clear()
+    get_tiles(TWO_TILES, base_url=url)
+    new_index = load_tile_index("segment_tiles")
+    assert new_index[tile_key(bottom)]["downloaded"] == index[tile_key(bottom)]["downloaded"]
+    assert tile_key(top) in new_index
+    assert len(get_segment_array(TWO_TILES, "box.dat", base_url=url)) == 3
+
+
+def test_empty_tiles_cost_one_request_each(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    box = Box(Point(41.01, 2.01), Point(41.14, 2.09))
+    in_flight, requested = [0, 0], []
+    lock = threading.Lock()
+
+    def respond(path: str, headers: dict[str, str]):
+        with lock:
+            requested.append(path)
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return 200, {}, EMPTY_PAGE.encode()
+
+    get_tiles(box, base_url=serve(respond), workers=3)
+    # Only the first page of every tile is requested, at most 3 at a time
+    assert len(tiles_in_box(box)) == 6
+    assert len(requested) == 6 and all(path.endswith("page=0") for path in requested)
+    assert 1 < in_flight[1] <= 3
+    assert len(load_tile_index("segment_tiles")) == 6
+
+
+@pytest.mark.parametrize("damage", ["remove", "truncate"])
+def test_download_segments_restarts_when_the_output_is_lost(serve, tmp_path, damage):
+    filename = str(tmp_path / "segments.dat")
+    failing = {"page": 2}
+
+    def respond(path: str, headers: dict[str, str]):
+        if int(parse_qs(urlparse(path).query)["page"][0]) == failing["page"]:
+            return 503, {}, b"Service Unavailable"
+        return track_pages(4)(path, headers)
+
+    url = serve(respond)
+    download_segments(BOX, filename, workers=2, base_url=url)
+    assert read_checkpoint(filename)[0] == 2
+    if damage == "remove":
+        os.remove(filename)
+    else:
+        os.truncate(filename, 10)
+    failing["page"] = -1
+    assert download_segments(BOX, filename, workers=2, base_url=url)
+    with open(filename) as file:
+        assert len(file.readlines()) == 8
+    assert not os.path.exists(checkpoint_filename(filename))
+
+
+# Track segments with (lat, lon, time) points: unsorted times, fractional seconds, a time zone, a point without time,
+# pairs too far apart and points older than LIMIT_YEAR
+MIXED_SEGMENTS = [
+    [(41.0001, 2.0001, "2020-05-01T10:00:02Z"), (41.0, 2.0, "2020-05-01T10:00:00.250Z"), (41.0003, 2.0002, "2020-05-01T10:00:01.5Z")],
+    [(41.01, 2.01, "2016-01-01T00:00:00+02:00"), (41.02, 2.01, "2016-01-01T00:00:10+02:00"), (41.0201, 2.0101, "2016-01-01T00:00:11+02:00")],
+    [(41.03, 2.03, "2014-12-31T23:59:59Z"), (41.0301, 2.03, "2015-01-01T00:00:01Z"), (41.0302, 2.03, "2015-01-01T00:00:02.999999Z")],
+    [(41.04, 2.04, "2020-01-01T00:00:00Z"), (41.0401, 2.04, None)],
+    [(41.05, 2.05, "2020-01-01T00:00:00.123Z")],
+]
+
+
+def mixed_page() -> bytes:
+    """Return a GPX page with two tracks of MIXED_SEGMENTS."""
+    def segment(points):
+        trackpoints = "".join(f'<trkpt lat="{lat}" lon="{lon}">' + (f"<time>{time}</time>" if time else "") + "</trkpt>"
+                              for lat, lon, time in points)
+        return f"<trkseg>{trackpoints}</trkseg>"
+    tracks = [MIXED_SEGMENTS[:2], MIXED_SEGMENTS[2:]]
+    body = "".join("<trk><name>track</name>" + "".join(segment(points) for points in track) + "</trk>" for track in tracks)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" creator="OpenStreetMap.org" '
+            f'xmlns="http://www.topografix.com/GPX/1/0">{body}</gpx>').encode()
+
+
+def test_stream_lines_match_gpxpy():
+    page = mixed_page()
+    expected = get_page_lines(gpxpy.parse(page.decode()))
+    assert expected.count("\n") == 4
+    for size in (1, 13, 100, len(page)):
+        assert get_stream_lines(page[i:i + size] for i in range(0, len(page), size)) == expected
+    assert get_stream_lines([EMPTY_PAGE.encode()]) is None
+    assert get_page_lines(gpxpy.parse(EMPTY_PAGE)) == ""
+
+
+def test_valid_pairs_match_is_valid(monkeypatch):
+    rng = np.random.default_rng(8)
+    lats, lons, years = [41.0], [2.0], [LIMIT_YEAR]
+    for i in range(400):
+        # Distances on both sides of MAX_DISTANCE, many of them closer to it than the 1e-9 km of the recheck
+        distance = MAX_DISTANCE * (1 + rng.choice([-1, 1]) * 10.0 ** rng.uniform(-15, -1))
+        lat, lon = haversine.inverse_haversine((lats[-1], lons[-1]), distance, rng.uniform(0, 2 * np.pi))
+        lats.append(lat)
+        lons.append(lon)
+        years.append(LIMIT_YEAR + int(rng.integers(-1, 2)))
+    points = [gpxpy.gpx.GPXTrackPoint(lat, lon, time=datetime(year, 6, 1, tzinfo=timezone.utc))
+              for lat, lon, year in zip(lats, lons, years)]
+    expected = [f"{lats[i]},{lons[i]},{lats[i + 1]},{lons[i + 1]}\n" for i in range(len(points) - 1)
+                if is_valid(points[i], points[i + 1])]
+    assert 0 < len(expected) < len(points) - 1
+    assert get_valid_lines(lats, lons, years) == expected
+    assert get_valid_lines(lats[:1], lons[:1], years[:1]) == []
+
+    # The vectorized distances may be rounded differently: the ones near the limit are checked again with is_valid's haversine
+    haversine_vector = haversine.haversine_vector
+    monkeypatch.setattr(haversine, "haversine_vector",
+                        lambda *args: haversine_vector(*args) + rng.uniform(-5e-10, 5e-10, len(args[0])))
+    assert get_valid_lines(lats, lons, years) == expected
@@ -0,0 +1,58 @@
+from tiles import CachedStaticMap, TileSource, prefetch_tiles, tiles_covering, blank_tile
+import os
+import tiles
+
+
+def tile_server(requested: list[str]):
+    """Return a server that stands in for a tile server: every tile is a blank PNG, and the requested paths are recorded."""
+    tile = blank_tile()
+
+    def respond(path: str, headers: dict[str, str]):
+        requested.append(path)
+        return 200, {"Content-Type": "image/png"}, tile
+    return respond
+
+
+def cached_tiles(cache_dir: str) -> set[str]:
+    return {os.path.relpath(os.path.join(directory, name), cache_dir)
+            for directory, _, names in os.walk(cache_dir) for name in names if name.endswith(".png")}
+
+
+def test_render_prefetches_and_caches_the_tiles(serve, tmp_path):
+    requested: list[str] = []
+    source = TileSource(serve(tile_server(requested)) + "/{z}/{x}/{y}.png", str(tmp_path / "tiles"))
+    image = CachedStaticMap(600, 400, source).render(zoom=12, center=[2.17, 41.38])
+    assert image.size == (600, 400)
+    # Every tile of the image is fetched once, before drawing
+    assert len(requested) == len(set(requested)) == len(cached_tiles(source.cache_dir)) > 0
+    CachedStaticMap(600, 400, source).render(zoom=12, center=[2.17, 41.38])
+    assert len(requested) == len(cached_tiles(source.cache_dir))
+
+
+def test_prefetch_tiles(serve, tmp_path):
+    requested: list[str] = []
+    source = TileSource(serve(tile_server(requested)) + "/{z}/{x}/{y}.png", str(tmp_path / "tiles"))
+    expected = sum(len(tiles_covering(2.0, 41.0, 2.3, 41.5, zoom)) for zoom in (10, 11))
+    assert prefetch_tiles(2.0, 41.0, 2.3, 41.5, [10, 11], source) == expected
+    assert prefetch_tiles(2.0, 41.0, 2.3, 41.5, [10, 11], source) == expected
+    assert len(requested) == expected
+
+
+def test_cache_is_only_walked_when_too_big(serve, tmp_path, monkeypatch):
+    requested: list[str] = []
+    tile_size = len(blank_tile())
+    source = TileSource(serve(tile_server(requested)) + "/{z}/{x}/{y}.png", str(tmp_path / "tiles"), 30 * tile_size)
+    walks = []
+    list_map_tiles = tiles.list_map_tiles
+    monkeypatch.setattr(tiles, "list_map_tiles", lambda source: walks.append(1) or list_map_tiles(source))
+
+    # The first render measures the cache, and the next ones within the limit don't walk it
+    for center in ([2.17, 41.38], [2.17, 41.38], [2.17, 41.38]):
+        CachedStaticMap(256, 256, source).render(zoom=12, center=center)
+    assert len(walks) == 1
+
+    # Going over the limit evicts the oldest tiles
+    for zoom in range(5, 12):
+        CachedStaticMap(768, 768, source).render(zoom=zoom, center=[2.17, 41.38])
+    assert len(cached_tiles(source.cache_dir)) * tile_size <= source.max_cache_bytes
+    assert len(walks) > 1
@@ -0,0 +1,68 @@
+from compactgraph import CompactGraph
+from monuments import Monument
+from routes import get_csr
+from segments import Point
+from tours import compute_route_matrix, get_matrix_path, order_tour, plan_tour, nearest_neighbor_tour, tour_length
+from scipy.sparse.csgraph import dijkstra
+import networkx as nx
+import numpy as np
+import pytest
+
+
+def make_graph(num_nodes: int, seed: int) -> CompactGraph:
+    """Return a random geometric graph with (lon, lat) positions and random weights, and one isolated node."""
+    rng = np.random.default_rng(seed)
+    positions = 2.0 + rng.random((num_nodes, 2)) * 0.1
+    graph = nx.random_geometric_graph(num_nodes, 0.25, pos=dict(enumerate(positions.tolist())), seed=seed)
+    for u, v in graph.edges():
+        graph.edges[u, v]['weight'] = float(rng.random()) + 0.01
+    for node, position in zip(graph.nodes(), positions):
+        graph.nodes[node]['pos'] = position
+    graph.add_node(num_nodes, pos=np.array([3.0, 3.0]))
+    return CompactGraph.from_networkx(graph)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_route_matrix_matches_dijkstra(workers):
+    graph = make_graph(200, 1)
+    csr, nodes, index = get_csr(graph)
+    sources, targets = [0, 5, 17, 200, 42], [3, 200, 99, 0]
+    matrix = compute_route_matrix(graph, sources, targets, workers)
+    expected = dijkstra(csr, indices=[index[source] for source in sources])[:, [index[target] for target in targets]]
+    assert matrix.distances.shape == (len(sources), len(targets))
+    assert np.allclose(matrix.distances, expected)
+    assert np.array_equal(np.isinf(matrix.distances), np.isinf(expected))
+    # The paths follow edges of the graph and are as long as their distance
+    for i in range(len(sources)):
+        for j in range(len(targets)):
+            path = get_matrix_path(graph, matrix, i, j)
+            if np.isinf(expected[i, j]):
+                assert path == []
+            else:
+                assert path[0] == sources[i] and path[-1] == targets[j]
+                assert sum(graph.weight(u, v) for u, v in zip(path, path[1:])) == pytest.approx(expected[i, j], rel=1e-5)
+
+
+def test_two_opt_is_never_longer_than_nearest_neighbor():
+    rng = np.random.default_rng(3)
+    for size in (1, 2, 5, 12, 30):
+        points = rng.random((size, 2))
+        distances = np.linalg.norm(points[:, None] - points[None, :], axis=2)
+        start = int(rng.integers(size))
+        tour = order_tour(distances, start)
+        assert tour[0] == start and sorted(tour) == list(range(size))
+        assert tour_length(distances, tour) <= tour_length(distances, nearest_neighbor_tour(distances, start)) + 1e-12
+
+
+def test_plan_tour():
+    graph = make_graph(200, 2)
+    lon, lat = graph.positions[graph.index[7]].tolist()
+    monuments = [Monument(str(node), Point(*graph.positions[graph.index[node]].tolist()[::-1])) for node in (50, 120, 9, 77)]
+    tour, length = plan_tour(graph, monuments, Point(lat, lon))
+    assert sorted(monument.name for monument in tour) == sorted(monument.name for monument in monuments)
+    # The length is the sum of the shortest distances between consecutive stops
+    csr, _, index = get_csr(graph)
+    stops = [7] + [int(monument.name) for monument in tour]
+    distances = dijkstra(csr, indices=[index[stop] for stop in stops])
+    assert length == pytest.approx(sum(distances[i, index[stops[i + 1]]] for i in range(len(stops) - 1)), rel=1e-6)
+    assert plan_tour(graph, [], Point(lat, lon)) == ([], 0.0)
@@ -0,0 +1,238 @@
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from staticmap import StaticMap
+from PIL import Image
+from io import BytesIO
+from math import floor, log, tan, cos, pi, radians, degrees, atan, sinh
+from metrics import count
+from files import atomic_write
+import requests, requests.adapters, os, threading
+
+
+@dataclass
+class TileSource:
+    """
+    Where the map tiles come from and where they are cached.
+    The url_template is an http(s) URL or a local path with {z}/{x}/{y} fields, so rendering can work without network.
+    Tiles are cached in cache_dir with a z/x/y.png layout, removing the least recently used ones above max_cache_bytes.
+    """
+    url_template: str = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+    cache_dir: str = "map_tiles"
+    max_cache_bytes: int = 256 * 1024 * 1024
+
+
+# Tile source used by all the renderers of the project (see set_tile_source)
+tile_source = TileSource()
+
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+_eviction_lock = threading.Lock()
+
+# Size in bytes of each tile cache directory, measured the first time and then updated with every tile written in this
+# process (see check_cache_size). Tiles written by other processes are counted at the next eviction.
+_cache_sizes: dict[str, int] = {}
+
+
+class CachedStaticMap(StaticMap):
+    """A StaticMap that takes its tiles from a TileSource through the on-disk tile cache."""
+
+    def __init__(self, width: int, height: int, source: Optional[TileSource] = None, **kwargs) -> None:
+        # The "URL" of each tile is just its z/x/y key, which get() resolves through the cache
+        super().__init__(width, height, url_template="{z}/{x}/{y}", **kwargs)
+        self.source = source or tile_source
+
+    def get(self, url: str, **kwargs) -> tuple[Optional[int], Optional[bytes]]:
+        """Return the status code and content of a tile, as StaticMap expects."""
+        z, x, y = map(int, url.split("/"))
+        content = get_tile(self.source, z, x, y)
+        if content is None and not is_remote(self.source):
+            # A local directory may not have every tile: leave it blank instead of retrying
+            return 200, blank_tile()
+        return (200, content) if content is not None else (404, None)
+
+    def render(self, zoom: Optional[int] = None, center: Optional[list[float]] = None):
+        """Render the map and then keep the tile cache within its size limit."""
+        image = super().render(zoom, center)
+        check_cache_size(self.source)
+        return image
+
+    def _draw_base_layer(self, image: Image.Image) -> None:
+        """Prefetch all the tiles of the image at the same time (see prefetch_tiles) and then draw them from the cache."""
+        half_width, half_height = 0.5 * self.width / self.tile_size, 0.5 * self.height / self.tile_size
+        prefetch_tiles(x_to_lon(self.x_center - half_width, self.zoom), y_to_lat(self.y_center + half_height, self.zoom),
+                       x_to_lon(self.x_center + half_width, self.zoom), y_to_lat(self.y_center - half_height, self.zoom),
+                       [self.zoom], self.source)
+        super()._draw_base_layer(image)
+
+
+def set_tile_source(source: TileSource) -> None:
+    """Change the tile source used by all the renderers of the project."""
+    global tile_source
+    tile_source = source
+
+
+def make_static_map(width: int, height: int) -> StaticMap:
+    """Create a static map that uses the current tile source and its cache."""
+    return CachedStaticMap(width, height, tile_source)
+
+
+def get_tile(source: TileSource, z: int, x: int, y: int) -> Optional[bytes]:
+    """Return the content of a tile from the cache, fetching and caching it if it's missing. Returns None if it can't be fetched."""
+    filename = tile_filename(source, z, x, y)
+    try:
+        with open(filename, "rb") as file:
+            return file.read()
+    except OSError:
+        pass
+    return fetch_and_cache_tile(source, z, x, y)
+
+
+def cache_tile(source: TileSource, z: int, x: int, y: int) -> bool:
+    """
+    Make sure a tile is in the cache, fetching it if it's missing, without reading it. Returns False if it can't be fetched.
+    Tiles found in the cache are marked as recently used.
+    """
+    filename = tile_filename(source, z, x, y)
+    try:
+        os.utime(filename)
+        count("tiles_cached")
+        return True
+    except OSError:
+        return fetch_and_cache_tile(source, z, x, y) is not None
+
+
+def fetch_and_cache_tile(source: TileSource, z: int, x: int, y: int) -> Optional[bytes]:
+    """Fetch a tile and save it to the cache. Returns None if it can't be fetched."""
+    content = fetch_tile(source, z, x, y)
+    if content is not None:
+        count("tiles_fetched")
+        filename = tile_filename(source, z, x, y)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with atomic_write(filename, "wb") as file:
+            file.write(content)
+        with _eviction_lock:
+            if source.cache_dir in _cache_sizes:
+                _cache_sizes[source.cache_dir] += len(content)
+    return content
+
+
+def tile_filename(source: TileSource, z: int, x: int, y: int) -> str:
+    """Return the file of a tile in the cache."""
+    return os.path.join(source.cache_dir, str(z), str(x), f"{y}.png")
+
+
+def is_remote(source: TileSource) -> bool:
+    """Check if the tiles of the source come from an http(s) server."""
+    return source.url_template.startswith(("http://", "https://"))
+
+
+def blank_tile() -> bytes:
+    """Return a transparent 256x256 PNG tile."""
+    buffer = BytesIO()
+    Image.new("RGBA", (256, 256), (0, 0, 0, 0)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def fetch_tile(source: TileSource, z: int, x: int, y: int) -> Optional[bytes]:
+    """Fetch a tile from an http(s) tile server or a local directory. Returns None if it's not available."""
+    location = source.url_template.format(z=z, x=x, y=y)
+    if is_remote(source):
+        try:
+            response = _session.get(location, timeout=20, headers={"User-Agent": "StaticMap"})
+        except requests.RequestException as e:
+            print(f"Error fetching the tile {location}: {e}")
+            return None
+        return response.content if response.status_code == 200 else None
+    try:
+        with open(location, "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def prefetch_tiles(min_lon: float, min_lat: float, max_lon: float, max_lat: float, zooms: list[int],
+                   source: Optional[TileSource] = None, workers: int = 8) -> int:
+    """
+    Download concurrently to the cache all the tiles covering the box at the given zoom levels. Returns how many tiles are available.
+    Every render prefetches the tiles of its image this way (see CachedStaticMap).
+    """
+    source = source or tile_source
+    tiles = [(z, x, y) for z in zooms for x, y in tiles_covering(min_lon, min_lat, max_lon, max_lat, z)]
+    with ThreadPoolExecutor(min(workers, max(1, len(tiles)))) as executor:
+        available = sum(executor.map(lambda tile: cache_tile(source, *tile), tiles))
+    check_cache_size(source)
+    return available
+
+
+def tiles_covering(min_lon: float, min_lat: float, max_lon: float, max_lat: float, zoom: int) -> list[tuple[int, int]]:
+    """Return the (x, y) of the tiles covering the box at the zoom level."""
+    max_tile = 2 ** zoom - 1
+    x_min, x_max = (min(max_tile, max(0, int(floor(lon_to_x(lon, zoom))))) for lon in (min_lon, max_lon))
+    y_min, y_max = (min(max_tile, max(0, int(floor(lat_to_y(lat, zoom))))) for lat in (max_lat, min_lat))
+    return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+
+def lon_to_x(lon: float, zoom: int) -> float:
+    """Convert a longitude to a Web Mercator tile x coordinate."""
+    return (lon + 180) / 360 * 2 ** zoom
+
+
+def lat_to_y(lat: float, zoom: int) -> float:
+    """Convert a latitude to a Web Mercator tile y coordinate."""
+    return (1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * 2 ** zoom
+
+
+def x_to_lon(x: float, zoom: int) -> float:
+    """Convert a Web Mercator tile x coordinate to a longitude."""
+    return x / 2 ** zoom * 360 - 180
+
+
+def y_to_lat(y: float, zoom: int) -> float:
+    """Convert a Web Mercator tile y coordinate to a latitude."""
+    return degrees(atan(sinh(pi * (1 - 2 * y / 2 ** zoom))))
+
+
+def check_cache_size(source: TileSource) -> None:
+    """
+    Evict tiles if the cache is over max_cache_bytes. The size of the cache is kept in memory, so the cache is only
+    walked the first time and when it's too big, not on every render.
+    """
+    with _eviction_lock:
+        if source.cache_dir not in _cache_sizes:
+            _cache_sizes[source.cache_dir] = sum(size for _, size, _ in list_map_tiles(source))
+        too_big = _cache_sizes[source.cache_dir] > source.max_cache_bytes
+    if too_big:
+        evict_map_tiles(source)
+
+
+def evict_map_tiles(source: TileSource) -> None:
+    """Remove the least recently used tiles of the cache until it fits in max_cache_bytes."""
+    with _eviction_lock:
+        files = list_map_tiles(source)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= source.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        _cache_sizes[source.cache_dir] = total
+
+
+def list_map_tiles(source: TileSource) -> list[tuple[float, int, str]]:
+    """Return the modification time, size and path of every tile of the cache."""
+    files = []
+    for directory, _, filenames in os.walk(source.cache_dir):
+        for filename in filenames:
+            if filename.endswith(".png"):
+                path = os.path.join(directory, filename)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((status.st_mtime, status.st_size, path))
+    return files
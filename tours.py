@@ -0,0 +1,133 @@
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from segments import Point
+from graphmaker import Graph, Array
+from monuments import Monuments
+from routes import get_csr, find_closest_nodes
+import numpy as np
+
+
+@dataclass
+class RouteMatrix:
+    """Shortest distances (km) between every source and target node, and the predecessors of each source tree to rebuild the paths."""
+    sources: list[int]
+    targets: list[int]
+    distances: Array
+    predecessors: Array
+
+
+# Cost given to unreachable pairs when ordering a tour
+UNREACHABLE_COST = 1e12
+
+# CSR matrix of the graph in each worker process, set once by init_worker
+_worker_csr: Optional[csr_matrix] = None
+
+
+def compute_route_matrix(graph: Graph, sources: list[int], targets: list[int], workers: int = 1) -> RouteMatrix:
+    """
+    Compute the shortest distances from every source node to every target node (inf if unreachable).
+    With more than one worker, the sources are split among a pool of processes that receive the graph once, when they start.
+    """
+    csr, _, index = get_csr(graph)
+    rows = [index[source] for source in sources]
+    if workers <= 1 or len(rows) <= 1:
+        distances, predecessors = run_dijkstra(csr, rows)
+    else:
+        chunks = [chunk.tolist() for chunk in np.array_split(rows, min(workers, len(rows)))]
+        with ProcessPoolExecutor(len(chunks), initializer=init_worker, initargs=(csr,)) as executor:
+            results = list(executor.map(run_worker_dijkstra, chunks))
+        distances = np.vstack([result[0] for result in results])
+        predecessors = np.vstack([result[1] for result in results])
+    target_rows = [index[target] for target in targets]
+    return RouteMatrix(sources, targets, distances[:, target_rows], predecessors)
+
+
+def init_worker(csr: csr_matrix) -> None:
+    """Keep the CSR matrix of the graph in the worker process."""
+    global _worker_csr
+    _worker_csr = csr
+
+
+def run_worker_dijkstra(rows: list[int]) -> tuple[Array, Array]:
+    """Run Dijkstra from the given rows on the CSR matrix of the worker process."""
+    assert _worker_csr is not None
+    return run_dijkstra(_worker_csr, rows)
+
+
+def run_dijkstra(csr: csr_matrix, rows: list[int]) -> tuple[Array, Array]:
+    """Run Dijkstra from each of the given rows. Returns one row of distances and predecessors per source."""
+    if not rows:
+        return np.empty((0, csr.shape[0])), np.empty((0, csr.shape[0]), dtype=np.int32)
+    distances, predecessors = dijkstra(csr, indices=rows, return_predecessors=True)
+    return distances.reshape(len(rows), -1), predecessors.reshape(len(rows), -1)
+
+
+def get_matrix_path(graph: Graph, matrix: RouteMatrix, i: int, j: int) -> list[int]:
+    """Return the nodes of the shortest path from the i-th source to the j-th target (empty if unreachable)."""
+    _, nodes, index = get_csr(graph)
+    if np.isinf(matrix.distances[i, j]):
+        return []
+    predecessors = matrix.predecessors[i]
+    path = [index[matrix.targets[j]]]
+    while predecessors[path[-1]] >= 0:
+        path.append(int(predecessors[path[-1]]))
+    return [nodes[row] for row in reversed(path)]
+
+
+def plan_tour(graph: Graph, monuments: Monuments, origin: Point, workers: int = 1) -> tuple[Monuments, float]:
+    """Return the monuments in a short order to visit them all starting at the origin, and the length of the tour in km."""
+    nodes = find_closest_nodes(graph, [origin] + [monument.location for monument in monuments])
+    matrix = compute_route_matrix(graph, nodes, nodes, workers)
+    tour = order_tour(matrix.distances, start=0)
+    return [monuments[i - 1] for i in tour[1:]], tour_length(matrix.distances, tour)
+
+
+def order_tour(distances: Array, start: int = 0) -> list[int]:
+    """
+    Return a short order to visit all the points of a square distance matrix beginning at start (an open path).
+    It is built with the nearest neighbor heuristic and then improved with 2-opt until no reversal shortens it.
+    Unreachable pairs (inf) are treated as very long.
+    """
+    costs = np.where(np.isfinite(distances), distances, UNREACHABLE_COST)
+    tour = nearest_neighbor_tour(costs, start)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(tour) - 1):
+            for j in range(i + 1, len(tour)):
+                if two_opt_gain(costs, tour, i, j) > 1e-12:
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    improved = True
+    return tour
+
+
+def nearest_neighbor_tour(costs: Array, start: int) -> list[int]:
+    """Build a tour that always goes to the closest point not yet visited."""
+    tour = [start]
+    visited = np.zeros(len(costs), dtype=bool)
+    visited[start] = True
+    for _ in range(len(costs) - 1):
+        remaining = np.where(visited, np.inf, costs[tour[-1]])
+        following = int(np.argmin(remaining))
+        tour.append(following)
+        visited[following] = True
+    return tour
+
+
+def two_opt_gain(costs: Array, tour: list[int], i: int, j: int) -> float:
+    """Return how much shorter the open tour gets by reversing tour[i..j]."""
+    before, first, last = tour[i - 1], tour[i], tour[j]
+    gain = costs[before, first] - costs[before, last]
+    if j + 1 < len(tour):
+        after = tour[j + 1]
+        gain += costs[last, after] - costs[first, after]
+    return float(gain)
+
+
+def tour_length(distances: Array, tour: list[int]) -> float:
+    """Return the length of an open tour."""
+    return float(sum(distances[a, b] for a, b in zip(tour, tour[1:])))
+
@@ -1,71 +1,111 @@
 from graphmaker import Graph
+from compactgraph import CompactGraph, as_compact
 from staticmap import StaticMap, CircleMarker, Line 
-from fastkml import KML, Document, Placemark
-from shapely.geometry import Point, LineString
+from tiles import make_static_map
+from render import render_map, Polylines
+from kmlwriter import kml_document, icon_style, line_style, write_points, write_lines
+from metrics import stage
+from typing import TextIO
+import numpy as np
 
 
-def export_png(graph: Graph, filename: str) -> None:
-    """Export the graph to a PNG file using staticmap."""
-    static_map = StaticMap(800, 600)
-    add_edges_to_static_map(graph, static_map)
-    add_nodes_to_static_map(graph, static_map)
-    image = static_map.render()
-    image.save(filename)
+def export_png(graph: Graph | CompactGraph, filename: str, fast: bool = True) -> None:
+    """
+    Export the graph to a PNG file. The fast path merges chains of edges into polylines and draws all of them at once
+    (see render.render_map). Otherwise, every edge and node is added to a staticmap.
+    """
+    with stage("export_png"):
+        graph = as_compact(graph)
+        if fast:
+            image = render_map(800, 600, graph_polylines(graph), "black", 2, graph.positions, "blue", 7)
+        else:
+            static_map = make_static_map(800, 600)
+            add_edges_to_static_map(graph, static_map)
+            add_nodes_to_static_map(graph, static_map)
+            image = static_map.render()
+        image.save(filename)
 
 
-def add_edges_to_static_map(graph: Graph, static_map: StaticMap) -> None:
+def graph_polylines(graph: Graph | CompactGraph) -> Polylines:
+    """
+    Merge the edges of the graph into polylines of (lon, lat) positions. Each polyline follows a chain of nodes with
+    two edges between two nodes that don't have two edges (or around a cycle), so every edge is drawn exactly once.
+    The chains are followed on the CSR arrays of the graph (see compactgraph.CompactGraph).
+    """
+    graph = as_compact(graph)
+    indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
+    degrees = graph.degrees()
+    polylines: Polylines = []
+    visited: set[int] = set()
+    num_nodes = len(graph)
+    for start in np.concatenate((np.flatnonzero(degrees != 2), np.flatnonzero(degrees == 2))).tolist():
+        for neighbor in indices[indptr[start]:indptr[start + 1]]:
+            if edge_key(start, neighbor, num_nodes) in visited:
+                continue
+            chain = follow_chain(indptr, indices, start, neighbor, visited)
+            polylines.append(graph.positions[chain])
+    return polylines
+
+
+def follow_chain(indptr: list[int], indices: list[int], start: int, following: int, visited: set[int]) -> list[int]:
+    """Follow the edges from the row start through following while the rows have two edges, marking the edges as visited."""
+    num_nodes = len(indptr) - 1
+    chain = [start]
+    previous, current = start, following
+    while True:
+        visited.add(edge_key(previous, current, num_nodes))
+        chain.append(current)
+        if indptr[current + 1] - indptr[current] != 2 or current == start:
+            return chain
+        first = indices[indptr[current]]
+        following = first if first != previous else indices[indptr[current] + 1]
+        if edge_key(current, following, num_nodes) in visited:
+            return chain
+        previous, current = current, following
+
+
+def edge_key(u: int, v: int, num_nodes: int) -> int:
+    """Return the same integer for the edge between two rows in either direction."""
+    return min(u, v) * num_nodes + max(u, v)
+
+
+def add_edges_to_static_map(graph: Graph | CompactGraph, static_map: StaticMap) -> None:
     """Add the edges of a graph to a StaticMap as Lines."""
+    graph = as_compact(graph)
     width = 2
-    for edge in graph.edges():
-        start_lat, start_lon = graph.nodes[edge[0]]["pos"]
-        end_lat, end_lon = graph.nodes[edge[1]]["pos"]
-        line = Line([(start_lat, start_lon), (end_lat, end_lon)], "black", width)
+    starts, ends, _ = graph.edge_arrays()
+    for start, end in zip(graph.positions[starts].tolist(), graph.positions[ends].tolist()):
+        line = Line([tuple(start), tuple(end)], "black", width)
         static_map.add_line(line)
 
 
-def add_nodes_to_static_map(graph: Graph, static_map: StaticMap) -> None:
+def add_nodes_to_static_map(graph: Graph | CompactGraph, static_map: StaticMap) -> None:
     """Add the nodes of a graph to a StaticMap as CircleMarkers."""
+    graph = as_compact(graph)
     width = 7
-    for node in graph.nodes():
-        pos = graph.nodes[node]["pos"]
-        marker = CircleMarker(pos, "blue", width)
+    for pos in graph.positions.tolist():
+        marker = CircleMarker(tuple(pos), "blue", width)
         static_map.add_marker(marker)
 
 
-def export_kml(graph: Graph, filename: str) -> None:
-    """Export the graph to a KML file."""
-    kml = KML()
-    namespace = '{http://www.opengis.net/kml/2.2}'
-    document = Document(namespace, 'docid', 'Graph', 'Graph KML')
-    kml.append(document)
-    add_nodes_to_kml(graph, document, namespace)
-    add_edges_to_kml(graph, document, namespace)
-    save_kml_to_file(filename, kml)
-
-
-def add_nodes_to_kml(graph: Graph, document: Document, namespace: str) -> None:
-    """Add the nodes of a graph to a KML as Placemarks."""
-    for node in graph.nodes():
-        lat, lon = graph.nodes[node]['pos']
-        point = Point(float(lat), float(lon))
-        placemark = Placemark(namespace, str(node), str(node))
-        placemark.geometry = point
-        document.append(placemark)
-
-
-def add_edges_to_kml(graph: Graph, document: Document, namespace: str) -> None:
-    """Add the edges of a graph to a KML as Placemarks."""
-    for edge in graph.edges():
-        start_pos = graph.nodes[edge[0]]['pos']
-        end_pos = graph.nodes[edge[1]]['pos']
-        line = LineString([start_pos, end_pos])
-        placemark = Placemark(namespace, f'edge_{edge[0]}_{edge[1]}', f'edge from {edge[0]} to {edge[1]}')
-        placemark.geometry = line
-        document.append(placemark)
-
-
-def save_kml_to_file(filename: str, kml: KML) -> None:
-    """Save the content of a KML object to a file."""
-    with open(filename, 'w') as file:
-        file.write(kml.to_string())
-        
\ No newline at end of file
+def export_kml(graph: Graph | CompactGraph, filename: str) -> None:
+    """
+    Export the graph to a KML file (or KMZ if filename ends with .kmz). The file is written while it's generated,
+    with shared styles, one placemark per node and all the edges merged into chains in a single placemark.
+    """
+    styles = {"node": icon_style("ffff0000", 1), "edge": line_style("ff000000", 2)}
+    with stage("export_kml"), kml_document(filename, "Graph", styles) as file:
+        graph = as_compact(graph)
+        add_nodes_to_kml(graph, file)
+        add_edges_to_kml(graph, file)
+
+
+def add_nodes_to_kml(graph: Graph | CompactGraph, file: TextIO) -> None:
+    """Write the nodes of a graph to a KML as Placemarks."""
+    graph = as_compact(graph)
+    write_points(file, [str(node) for node in graph.nodes.tolist()], graph.positions, "node")
+
+
+def add_edges_to_kml(graph: Graph | CompactGraph, file: TextIO) -> None:
+    """Write the edges of a graph to a KML as the LineStrings of a single Placemark."""
+    write_lines(file, "edges", graph_polylines(graph), "edge")